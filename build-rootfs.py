@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Build a microVM rootfs (ext4) from a Docker image.
+
+    sudo python3 build-rootfs.py claude-agent:latest claude-agent-runtime.ext4 5120
+
+- Layers are extracted once, in parallel, into a cache keyed by their digest
+  (diff_id). A rebuild only extracts the layers that changed, and skips
+  `docker save` entirely when every layer is cached.
+- Whiteouts are resolved in a single pass over all layers. The merged tree is
+  hard-linked from the cache (no file data is copied) and written into the
+  image by mkfs.ext4 -d, so no loop mount and no privileged container.
+- The image file is sparse: the unused part of its size takes no disk space.
+- Reproducible: the filesystem UUID, hash seed and superblock times derive
+  from the image, file contents, owners, modes and mtimes come from its layers,
+  and inode atimes/ctimes are set to the image's creation time afterwards.
+
+Runs as root so extracted files keep their owners, modes and device nodes.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+DEFAULT_CACHE_DIR = "/var/cache/rootfs-builder"
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+# Same filesystem layout the guest kernel has always booted.
+# -i 8192: one inode per 8KB, Python/Node packages are lots of small files
+MKFS_OPTIONS = [
+    "-O",
+    "^dir_index,^64bit,^dir_nlink,^metadata_csum,ext_attr,sparse_super2,"
+    "filetype,extent,flex_bg,large_file,huge_file,extra_isize",
+    "-b",
+    "4096",
+    "-m",
+    "0",
+    "-i",
+    "8192",
+]
+
+# Namespace for the filesystem UUID derived from the image id
+UUID_NAMESPACE = uuid.UUID("6f0c1b6e-3c2a-4a53-9d0e-2f1f8f5c7a10")
+
+
+def run(*args: str, **kwargs) -> subprocess.CompletedProcess:
+    return subprocess.run(args, check=True, **kwargs)
+
+
+def inspect_image(image: str) -> dict:
+    output = run(
+        "docker", "image", "inspect", image, capture_output=True, text=True
+    ).stdout
+    return json.loads(output)[0]
+
+
+def layer_dir(cache_dir: str, diff_id: str) -> str:
+    return f"{cache_dir}/layers/{diff_id.split(':')[-1]}"
+
+
+def save_layers(image: str, missing: list[str], cache_dir: str, jobs: int):
+    """docker save the image and extract the layers that aren't cached yet"""
+    with tempfile.TemporaryDirectory(dir=cache_dir) as save_dir:
+        print(f"📦 Saving {image} ({len(missing)} layers to extract)...")
+        save = subprocess.Popen(["docker", "save", image], stdout=subprocess.PIPE)
+        run("tar", "-x", "-C", save_dir, stdin=save.stdout)
+        if save.wait() != 0:
+            raise RuntimeError(f"docker save {image} failed")
+
+        with open(f"{save_dir}/manifest.json") as f:
+            manifest = json.load(f)[0]
+        with open(f"{save_dir}/{manifest['Config']}") as f:
+            diff_ids = json.load(f)["rootfs"]["diff_ids"]
+
+        # Identical layers (e.g. empty ones) show up more than once
+        tarballs = dict(zip(diff_ids, manifest["Layers"]))
+
+        def extract(diff_id: str):
+            target = layer_dir(cache_dir, diff_id)
+            tmp_target = f"{target}.tmp-{os.getpid()}"
+            shutil.rmtree(tmp_target, ignore_errors=True)
+            os.makedirs(tmp_target)
+            start = time.time()
+            run(
+                "tar",
+                "-x",
+                "--numeric-owner",
+                "--same-permissions",
+                "--xattrs",
+                "--xattrs-include=*",
+                "-f",
+                f"{save_dir}/{tarballs[diff_id]}",
+                "-C",
+                tmp_target,
+            )
+            os.replace(tmp_target, target)
+            print(f"  ✓ Extracted {diff_id[:19]} ({time.time() - start:.1f}s)")
+
+        with ThreadPoolExecutor(jobs) as pool:
+            list(pool.map(extract, missing))
+
+
+class MergedTree:
+    """Paths of the final filesystem and the layer each one comes from"""
+
+    def __init__(self):
+        self.source: dict[str, str] = {}  # path -> layer dir
+        self.children: dict[str, set[str]] = {"": set()}
+
+    def remove(self, path: str):
+        for child in self.children.pop(path, ()):
+            self.remove(child)
+        self.source.pop(path, None)
+        self.children.get(os.path.dirname(path), set()).discard(path)
+
+    def add(self, path: str, layer: str, is_dir: bool):
+        # A file replacing a directory takes the directory's content with it
+        if not is_dir and path in self.children:
+            for child in self.children.pop(path):
+                self.remove(child)
+
+        self.source[path] = layer
+        self.children[os.path.dirname(path)].add(path)
+        if is_dir:
+            self.children.setdefault(path, set())
+
+    def apply_layer(self, layer: str):
+        for root, dirs, files in os.walk(layer):
+            base = os.path.relpath(root, layer)
+            base = "" if base == "." else base
+
+            # Whiteouts hide what the layers below have, never this layer's own files
+            names = dirs + files
+            if OPAQUE_WHITEOUT in names:
+                for child in list(self.children.get(base, ())):
+                    self.remove(child)
+            for name in names:
+                if name.startswith(WHITEOUT_PREFIX) and name != OPAQUE_WHITEOUT:
+                    self.remove(os.path.join(base, name[len(WHITEOUT_PREFIX) :]))
+
+            for name in names:
+                if name.startswith(WHITEOUT_PREFIX):
+                    continue
+                # os.walk lists symlinks to directories as directories
+                is_dir = name in dirs and not os.path.islink(os.path.join(root, name))
+                self.add(os.path.join(base, name), layer, is_dir)
+
+    def materialize(self, staging: str):
+        """Create the merged tree in staging: directories copied, everything else hard-linked"""
+        directories = []
+        for path in sorted(self.source):
+            src = os.path.join(self.source[path], path)
+            dst = os.path.join(staging, path)
+            if path in self.children:
+                os.mkdir(dst)
+                directories.append((src, dst))
+            else:
+                os.link(src, dst, follow_symlinks=False)
+
+        # Children first, creating their entries changed the parents' mtimes
+        for src, dst in reversed(directories):
+            stat = os.lstat(src)
+            os.chown(dst, stat.st_uid, stat.st_gid)
+            os.chmod(dst, stat.st_mode & 0o7777)
+            os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def make_image(staging: str, output: str, size_mb: int, fs_uuid: str, timestamp: int):
+    tmp_output = f"{output}.tmp"
+    if os.path.exists(tmp_output):
+        os.remove(tmp_output)
+
+    # Sparse: only blocks mkfs actually writes take up disk space
+    with open(tmp_output, "wb") as f:
+        f.truncate(size_mb * 1024 * 1024)
+
+    run(
+        "mkfs.ext4",
+        "-q",
+        "-F",
+        *MKFS_OPTIONS,
+        "-U",
+        fs_uuid,
+        "-E",
+        f"hash_seed={fs_uuid},root_owner=0:0",
+        "-d",
+        staging,
+        tmp_output,
+        env={**os.environ, "E2FSPROGS_FAKE_TIME": str(timestamp)},
+    )
+    fix_inode_times(tmp_output, timestamp)
+    os.replace(tmp_output, output)
+
+
+def used_inodes(image: str) -> list[int]:
+    """Allocated inodes, from the free ranges dumpe2fs lists per group"""
+    output = run("dumpe2fs", image, capture_output=True, text=True).stdout
+    per_group = int(re.search(r"^Inodes per group:\s+(\d+)", output, re.M)[1])
+
+    used = []
+    for group, ranges in enumerate(re.findall(r"^  Free inodes: (.*)$", output, re.M)):
+        free = set()
+        for item in filter(None, ranges.replace(" ", "").split(",")):
+            first, _, last = item.partition("-")
+            free.update(range(int(first), int(last or first) + 1))
+        first_ino = group * per_group + 1
+        used += [
+            ino for ino in range(first_ino, first_ino + per_group) if ino not in free
+        ]
+    return used
+
+
+def fix_inode_times(image: str, timestamp: int):
+    """
+    Set the atime and ctime of the populated inodes to timestamp.
+
+    mkfs.ext4 -d copies them from the staged files, whose ctime is when they
+    were hard-linked into staging and whose atime changes when they are read.
+    Inodes below 12 other than the root are created by mkfs at the fake time.
+    """
+    inodes = [ino for ino in used_inodes(image) if ino == 2 or ino >= 12]
+    with tempfile.NamedTemporaryFile("w", suffix=".debugfs") as script:
+        for ino in inodes:
+            script.write(f"sif <{ino}> atime @{timestamp}\n")
+            script.write(f"sif <{ino}> ctime @{timestamp}\n")
+        script.flush()
+        run(
+            "debugfs",
+            "-w",
+            "-f",
+            script.name,
+            image,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, "E2FSPROGS_FAKE_TIME": str(timestamp)},
+        )
+
+
+def prune_cache(cache_dir: str, keep: list[str]):
+    """Drop cached layers other than keep"""
+    keep_dirs = {os.path.basename(layer_dir(cache_dir, diff_id)) for diff_id in keep}
+    for name in os.listdir(f"{cache_dir}/layers"):
+        if name not in keep_dirs:
+            shutil.rmtree(f"{cache_dir}/layers/{name}", ignore_errors=True)
+            print(f"  ✓ Pruned cached layer {name[:12]}")
+
+
+def build(
+    image: str, output: str, size_mb: int, cache_dir: str, jobs: int, prune: bool
+):
+    start = time.time()
+    os.makedirs(f"{cache_dir}/layers", exist_ok=True)
+
+    info = inspect_image(image)
+    diff_ids = info["RootFS"]["Layers"]
+    unique = list(dict.fromkeys(diff_ids))
+    missing = [d for d in unique if not os.path.isdir(layer_dir(cache_dir, d))]
+
+    if missing:
+        save_layers(image, missing, cache_dir, jobs)
+    print(f"🗂️  {len(unique) - len(missing)}/{len(unique)} layers from cache")
+
+    tree = MergedTree()
+    for diff_id in diff_ids:
+        tree.apply_layer(layer_dir(cache_dir, diff_id))
+
+    staging = f"{cache_dir}/staging-{os.getpid()}"
+    try:
+        os.mkdir(staging, 0o755)
+        tree.materialize(staging)
+        print(f"🧩 Merged {len(tree.source)} paths")
+
+        created = (
+            datetime.fromisoformat(info["Created"][:19])
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+        )
+        fs_uuid = str(uuid.uuid5(UUID_NAMESPACE, info["Id"]))
+        make_image(staging, output, size_mb, fs_uuid, int(created))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if prune:
+        prune_cache(cache_dir, unique)
+
+    allocated = os.stat(output).st_blocks * 512 // (1024 * 1024)
+    print(
+        f"✅ Created {output}: {size_mb}MB filesystem, {allocated}MB on disk "
+        f"({time.time() - start:.1f}s)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("image", help="Docker image, e.g. claude-agent:latest")
+    parser.add_argument("output", help="ext4 image to write")
+    parser.add_argument("size_mb", type=int, help="Filesystem size in MB")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--prune", action="store_true", help="Drop cached layers this image doesn't use"
+    )
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("build-rootfs.py must run as root to keep file owners (use sudo)")
+
+    build(
+        args.image,
+        os.path.abspath(args.output),
+        args.size_mb,
+        args.cache_dir,
+        args.jobs,
+        args.prune,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -57,7 +57,7 @@ func (a *API) PostInit(w http.ResponseWriter, r *http.Request) {
 		}
 	}
 
-	// Removed MMDS polling - we don't use Firecracker metadata service
+	// MMDS is read once at startup (LoadMMDS), no polling
 
 	w.Header().Set("Cache-Control", "no-store")
 	w.Header().Set("Content-Type", "")
@@ -0,0 +1,94 @@
+package api
+
+import (
+	"context"
+	"encoding/json"
+	"errors"
+	"fmt"
+	"io"
+	"net/http"
+	"time"
+)
+
+const (
+	mmdsAddress  = "http://169.254.169.254"
+	mmdsTokenTTL = "60"
+
+	// MMDS answers from inside Firecracker, so it is either there right away or not at all
+	mmdsTimeout = 1 * time.Second
+)
+
+var errNoMMDSConfig = errors.New("no envd config in MMDS")
+
+// mmdsConfig is what the host stores in Firecracker's MMDS before boot. The envd
+// part is the same body the host would otherwise POST to /init.
+type mmdsConfig struct {
+	Envd *PostInitJSONBody `json:"envd"`
+}
+
+// LoadMMDS applies the boot config the host stored in MMDS (MMDS v2: session
+// token first, then the metadata as JSON).
+func (a *API) LoadMMDS(ctx context.Context) error {
+	ctx, cancel := context.WithTimeout(ctx, mmdsTimeout)
+	defer cancel()
+
+	tokenReq, err := http.NewRequestWithContext(ctx, http.MethodPut, mmdsAddress+"/latest/api/token", nil)
+	if err != nil {
+		return err
+	}
+	tokenReq.Header.Set("X-metadata-token-ttl-seconds", mmdsTokenTTL)
+
+	token, err := mmdsDo(tokenReq)
+	if err != nil {
+		return fmt.Errorf("error getting MMDS token: %w", err)
+	}
+
+	req, err := http.NewRequestWithContext(ctx, http.MethodGet, mmdsAddress+"/", nil)
+	if err != nil {
+		return err
+	}
+	req.Header.Set("X-metadata-token", string(token))
+	req.Header.Set("Accept", "application/json")
+
+	body, err := mmdsDo(req)
+	if err != nil {
+		return fmt.Errorf("error reading MMDS: %w", err)
+	}
+
+	var config mmdsConfig
+	if err := json.Unmarshal(body, &config); err != nil {
+		return fmt.Errorf("error decoding MMDS config: %w", err)
+	}
+
+	if config.Envd == nil {
+		return errNoMMDSConfig
+	}
+
+	a.initLock.Lock()
+	defer a.initLock.Unlock()
+
+	if config.Envd.Timestamp == nil || a.lastSetTime.SetToGreater(config.Envd.Timestamp.UnixNano()) {
+		return a.SetData(*a.logger, *config.Envd)
+	}
+
+	return nil
+}
+
+func mmdsDo(req *http.Request) ([]byte, error) {
+	resp, err := http.DefaultClient.Do(req)
+	if err != nil {
+		return nil, err
+	}
+	defer resp.Body.Close()
+
+	body, err := io.ReadAll(resp.Body)
+	if err != nil {
+		return nil, err
+	}
+
+	if resp.StatusCode != http.StatusOK {
+		return nil, fmt.Errorf("status %d: %s", resp.StatusCode, body)
+	}
+
+	return body, nil
+}
@@ -2,36 +2,312 @@ package filesystem
 
 import (
 	"context"
+	"crypto/rand"
+	"encoding/hex"
+	"errors"
+	"fmt"
+	"io/fs"
+	"os"
+	"path/filepath"
+	"strings"
 	"sync"
+	"unsafe"
 
 	"connectrpc.com/connect"
+	"golang.org/x/sys/unix"
 
+	"envd-mini/internal/permissions"
 	rpc "envd-mini/spec/grpc/envd/filesystem"
 )
 
-// FileWatcher - stub structure (file watching not used)
+const (
+	// Events we translate into FilesystemEvents. IN_CLOSE_WRITE instead of IN_MODIFY
+	// so a file being written reports once, when it is complete.
+	watchMask = unix.IN_CREATE | unix.IN_CLOSE_WRITE | unix.IN_DELETE | unix.IN_MOVED_FROM |
+		unix.IN_MOVED_TO | unix.IN_ATTRIB | unix.IN_DELETE_SELF
+
+	// Max events buffered between two GetWatcherEvents calls. Past this the watcher
+	// reports an error and the caller is expected to resync with ListDir.
+	maxWatcherEvents = 10000
+)
+
+var errWatcherOverflow = errors.New("watcher event buffer overflowed")
+
+// FileWatcher - inotify watcher polled through GetWatcherEvents
 type FileWatcher struct {
 	Events []*rpc.FilesystemEvent
 	Error  error
 	Lock   sync.Mutex
+
+	root      string
+	recursive bool
+	fd        int
+	file      *os.File
+	dirs      map[int]string // watch descriptor -> absolute dir path
+}
+
+func newFileWatcher(root string, recursive bool) (*FileWatcher, error) {
+	fd, err := unix.InotifyInit1(unix.IN_CLOEXEC | unix.IN_NONBLOCK)
+	if err != nil {
+		return nil, fmt.Errorf("error creating inotify instance: %w", err)
+	}
+
+	w := &FileWatcher{
+		root:      root,
+		recursive: recursive,
+		fd:        fd,
+		// Non-blocking fd goes through the runtime poller, so Close unblocks Read
+		file: os.NewFile(uintptr(fd), "inotify"),
+		dirs: make(map[int]string),
+	}
+
+	if err := w.addTree(root, false); err != nil {
+		w.file.Close()
+		return nil, err
+	}
+
+	go w.readEvents()
+
+	return w, nil
+}
+
+// addTree watches dir (and its subdirectories when recursive). With synthesize set,
+// existing entries are reported as created - they may have appeared before the watch.
+func (w *FileWatcher) addTree(dir string, synthesize bool) error {
+	if !w.recursive {
+		return w.addWatch(dir)
+	}
+
+	return filepath.WalkDir(dir, func(path string, d fs.DirEntry, err error) error {
+		if err != nil {
+			// Entry vanished while walking
+			if os.IsNotExist(err) {
+				return nil
+			}
+
+			return err
+		}
+
+		if synthesize && path != dir {
+			w.push(path, rpc.EventType_EVENT_TYPE_CREATE)
+		}
+
+		if !d.IsDir() {
+			return nil
+		}
+
+		return w.addWatch(path)
+	})
+}
+
+func (w *FileWatcher) addWatch(dir string) error {
+	wd, err := unix.InotifyAddWatch(w.fd, dir, watchMask|unix.IN_ONLYDIR)
+	if err != nil {
+		if errors.Is(err, unix.ENOENT) {
+			return nil
+		}
+
+		return fmt.Errorf("error watching %s: %w", dir, err)
+	}
+
+	w.Lock.Lock()
+	w.dirs[wd] = dir
+	w.Lock.Unlock()
+
+	return nil
+}
+
+func (w *FileWatcher) readEvents() {
+	buf := make([]byte, unix.SizeofInotifyEvent*4096)
+
+	for {
+		n, err := w.file.Read(buf)
+		if err != nil {
+			if !errors.Is(err, os.ErrClosed) {
+				w.fail(fmt.Errorf("error reading inotify events: %w", err))
+			}
+
+			return
+		}
+
+		for offset := 0; offset+unix.SizeofInotifyEvent <= n; {
+			raw := (*unix.InotifyEvent)(unsafe.Pointer(&buf[offset]))
+			nameStart := offset + unix.SizeofInotifyEvent
+			name := strings.TrimRight(string(buf[nameStart:nameStart+int(raw.Len)]), "\x00")
+			offset = nameStart + int(raw.Len)
+
+			w.handle(int(raw.Wd), raw.Mask, name)
+		}
+	}
+}
+
+func (w *FileWatcher) handle(wd int, mask uint32, name string) {
+	if mask&unix.IN_Q_OVERFLOW != 0 {
+		w.fail(errWatcherOverflow)
+
+		return
+	}
+
+	w.Lock.Lock()
+	dir, ok := w.dirs[wd]
+	if mask&unix.IN_IGNORED != 0 {
+		delete(w.dirs, wd)
+	}
+	w.Lock.Unlock()
+
+	if !ok || name == "" {
+		return
+	}
+
+	path := filepath.Join(dir, name)
+
+	switch {
+	case mask&(unix.IN_CREATE|unix.IN_MOVED_TO) != 0:
+		w.push(path, rpc.EventType_EVENT_TYPE_CREATE)
+
+		if mask&unix.IN_ISDIR != 0 && w.recursive {
+			if err := w.addTree(path, true); err != nil {
+				w.fail(err)
+			}
+		}
+	case mask&unix.IN_CLOSE_WRITE != 0:
+		w.push(path, rpc.EventType_EVENT_TYPE_WRITE)
+	case mask&unix.IN_DELETE != 0:
+		w.push(path, rpc.EventType_EVENT_TYPE_REMOVE)
+	case mask&unix.IN_MOVED_FROM != 0:
+		w.push(path, rpc.EventType_EVENT_TYPE_RENAME)
+	case mask&unix.IN_ATTRIB != 0:
+		w.push(path, rpc.EventType_EVENT_TYPE_CHMOD)
+	}
+}
+
+// push records an event named relative to the watched root, dropping exact repeats.
+func (w *FileWatcher) push(path string, eventType rpc.EventType) {
+	name, err := filepath.Rel(w.root, path)
+	if err != nil {
+		return
+	}
+
+	w.Lock.Lock()
+	defer w.Lock.Unlock()
+
+	if w.Error != nil {
+		return
+	}
+
+	if last := len(w.Events) - 1; last >= 0 && w.Events[last].GetName() == name && w.Events[last].GetType() == eventType {
+		return
+	}
+
+	if len(w.Events) >= maxWatcherEvents {
+		w.Error = errWatcherOverflow
+		w.Events = nil
+
+		return
+	}
+
+	w.Events = append(w.Events, &rpc.FilesystemEvent{Name: name, Type: eventType})
+}
+
+func (w *FileWatcher) fail(err error) {
+	w.Lock.Lock()
+	defer w.Lock.Unlock()
+
+	if w.Error == nil {
+		w.Error = err
+		w.Events = nil
+	}
+}
+
+// drain returns and clears the buffered events.
+func (w *FileWatcher) drain() ([]*rpc.FilesystemEvent, error) {
+	w.Lock.Lock()
+	defer w.Lock.Unlock()
+
+	if w.Error != nil {
+		return nil, w.Error
+	}
+
+	events := w.Events
+	w.Events = nil
+
+	return events, nil
+}
+
+func (w *FileWatcher) Close() error {
+	return w.file.Close()
+}
+
+func newWatcherID() (string, error) {
+	b := make([]byte, 16)
+	if _, err := rand.Read(b); err != nil {
+		return "", err
+	}
+
+	return hex.EncodeToString(b), nil
 }
 
-// CreateWatcher - stub method (not used in our system)
 func (s Service) CreateWatcher(ctx context.Context, req *connect.Request[rpc.CreateWatcherRequest]) (*connect.Response[rpc.CreateWatcherResponse], error) {
-	return nil, connect.NewError(connect.CodeUnimplemented, nil)
+	u, err := permissions.GetAuthUser(ctx, s.defaults.User)
+	if err != nil {
+		return nil, err
+	}
+
+	watchPath, err := permissions.ExpandAndResolve(req.Msg.GetPath(), u, s.defaults.Workdir)
+	if err != nil {
+		return nil, connect.NewError(connect.CodeInvalidArgument, err)
+	}
+
+	err = checkIfDirectory(watchPath)
+	if err != nil {
+		return nil, err
+	}
+
+	watcherID, err := newWatcherID()
+	if err != nil {
+		return nil, connect.NewError(connect.CodeInternal, fmt.Errorf("error generating watcher id: %w", err))
+	}
+
+	w, err := newFileWatcher(watchPath, req.Msg.GetRecursive())
+	if err != nil {
+		if errors.Is(err, unix.ENOSPC) {
+			return nil, connect.NewError(connect.CodeResourceExhausted, err)
+		}
+
+		return nil, connect.NewError(connect.CodeInternal, err)
+	}
+
+	s.watchers.Store(watcherID, w)
+
+	return connect.NewResponse(&rpc.CreateWatcherResponse{WatcherId: watcherID}), nil
 }
 
-// GetWatcherEvents - stub method (not used in our system)
 func (s Service) GetWatcherEvents(ctx context.Context, req *connect.Request[rpc.GetWatcherEventsRequest]) (*connect.Response[rpc.GetWatcherEventsResponse], error) {
-	return nil, connect.NewError(connect.CodeUnimplemented, nil)
+	w, ok := s.watchers.Load(req.Msg.GetWatcherId())
+	if !ok {
+		return nil, connect.NewError(connect.CodeNotFound, fmt.Errorf("watcher not found: %s", req.Msg.GetWatcherId()))
+	}
+
+	events, err := w.drain()
+	if err != nil {
+		return nil, connect.NewError(connect.CodeDataLoss, err)
+	}
+
+	return connect.NewResponse(&rpc.GetWatcherEventsResponse{Events: events}), nil
 }
 
-// RemoveWatcher - stub method (not used in our system)
 func (s Service) RemoveWatcher(ctx context.Context, req *connect.Request[rpc.RemoveWatcherRequest]) (*connect.Response[rpc.RemoveWatcherResponse], error) {
-	return nil, connect.NewError(connect.CodeUnimplemented, nil)
+	w, ok := s.watchers.LoadAndDelete(req.Msg.GetWatcherId())
+	if !ok {
+		return nil, connect.NewError(connect.CodeNotFound, fmt.Errorf("watcher not found: %s", req.Msg.GetWatcherId()))
+	}
+
+	w.Close()
+
+	return connect.NewResponse(&rpc.RemoveWatcherResponse{}), nil
 }
 
-// WatchDir - stub method (not used in our system)  
+// WatchDir - stub method (not used in our system, use CreateWatcher + GetWatcherEvents)
 func (s Service) WatchDir(ctx context.Context, req *connect.Request[rpc.WatchDirRequest], stream *connect.ServerStream[rpc.WatchDirResponse]) error {
 	return connect.NewError(connect.CodeUnimplemented, nil)
 }
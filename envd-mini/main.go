@@ -63,7 +63,7 @@ func main() {
 	// STEP 4: Register gRPC services
 	// ========================================
 	// Filesystem service: /filesystem.Filesystem/*
-	// Handles: ListDir, Stat, MakeDir, Move, Remove
+	// Handles: ListDir, Stat, MakeDir, Move, Remove, CreateWatcher, GetWatcherEvents, RemoveWatcher
 	fsLogger := logger.With().Str("service", "filesystem").Logger()
 	filesystemRpc.Handle(m, &fsLogger, defaults)
 
@@ -80,6 +80,13 @@ func main() {
 	service := api.New(&apiLogger, defaults) // Removed: mmdsChan, isNotFC
 	handler := api.HandlerFromMux(service, m)
 
+	// Boot config (env vars) from Firecracker MMDS, applied before we serve so
+	// anything that sees envd ready also sees the config. VMs without MMDS get
+	// it through POST /init instead.
+	if err := service.LoadMMDS(ctx); err != nil {
+		apiLogger.Info().Err(err).Msg("No boot config from MMDS, waiting for /init")
+	}
+
 	// ========================================
 	// STEP 6: Create HTTP server
 	// ========================================
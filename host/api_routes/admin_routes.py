@@ -1,5 +1,4 @@
 import asyncio
-from connectrpc.client import ConnectClient
 from connectrpc.method import MethodInfo, IdempotencyLevel
 import process_pb2
 import filesystem_pb2
@@ -7,20 +6,56 @@ from fastapi import HTTPException, Depends, APIRouter
 import subprocess
 import os
 import signal
+from typing import Optional
 import time
 from auth import verify_api_key
+from tasks import tasks
+from workspace_snapshots import (
+    SNAPSHOT_KILL_TIMEOUT,
+    list_snapshots,
+    snapshot_workspace,
+)
+from package_cache import (
+    package_cache_info,
+    package_cache_state,
+    refresh_package_cache,
+    save_manifest,
+    load_manifest,
+)
+from guest_transport import guest_rpc_client
+from hugepages import (
+    hugepage_pool_info,
+    hugepage_reservations,
+    hugepages_for,
+    release_hugepages,
+    set_hugepage_pool,
+)
+from ksm import ksm_info, tune_ksm, vm_ksm_info
+from vm_telemetry import TELEMETRY_WINDOW_SECONDS, telemetry_summary
+from boot_prefetch import (
+    boot_prefetch_info,
+    boot_prefetch_state,
+    prefetch_image,
+    record_boot_trace,
+)
 from models import (
     microvms,
     CreateMicroVMRequest,
     TaskRequest,
     KillMicroVMRequest,
+    PackageCacheRequest,
+    SnapshotRequest,
+    HugepagePoolRequest,
+    BootTraceRequest,
     FIRECRACKER_BIN,
     KERNEL_PATH,
     WORK_DIR,
     ROOTFS_IMAGES,
     next_ip,
     START_METHOD,
+    run_in_background,
 )
+from log import bind_log_context, log
 
 router = APIRouter()
 
@@ -33,9 +68,20 @@ async def get_status(_: str = Depends(verify_api_key)):
     return {
         "active_microvms": len(microvms),
         "available_runtimes": list(ROOTFS_IMAGES.keys()),
+        "running_tasks": sum(1 for t in tasks.values() if t.status == "running"),
+        "hugepages": hugepage_pool_info(),
+        "ksm": ksm_info(),
         "microvms": {
             user_id: {
                 "ip": vm["ip"],
+                "transport": "vsock" if vm.get("vsock_path") else "tap",
+                "rootfs_mode": vm.get("rootfs_mode", "overlay"),
+                "hugepages": vm.get("hugepages", False),
+                "ksm": vm_ksm_info(vm["process"].pid) if vm.get("ksm") else None,
+                "guest_init": vm.get("guest_init", "systemd"),
+                "guest_boot": vm.get("guest_boot"),
+                "guest_startup": vm.get("guest_startup"),
+                "boot_phases": vm.get("boot_phases"),
                 "runtime": vm["runtime"],
                 "pid": vm["process"].pid,
                 "alive": vm["process"].poll() is None,
@@ -51,16 +97,181 @@ async def get_status(_: str = Depends(verify_api_key)):
     }
 
 
+@router.post("/hugepage_pool")
+async def post_hugepage_pool(
+    request: HugepagePoolRequest, _: str = Depends(verify_api_key)
+):
+    """
+    Resize the host's 2 MiB hugepage pool.
+
+    Can't shrink below what running hugepage VMs hold. The kernel may grant
+    fewer pages than asked for when host memory is fragmented.
+    """
+    pages = hugepages_for(request.size_mib)
+    reserved = sum(hugepage_reservations.values())
+    if pages < reserved:
+        raise HTTPException(
+            status_code=409,
+            detail=f"{reserved} hugepages are in use by running VMs, can't shrink the pool to {pages}",
+        )
+
+    await asyncio.to_thread(set_hugepage_pool, pages)
+    return hugepage_pool_info()
+
+
+@router.get("/ksm")
+async def get_ksm(_: str = Depends(verify_api_key)):
+    """
+    Memory merged by KSM, host-wide and per density-mode VM.
+
+    extra_vms_fit is how many more VMs of the average ksm VM's size the merged
+    memory makes room for.
+    """
+    host = ksm_info()
+    ksm_vms = {user_id: vm for user_id, vm in microvms.items() if vm.get("ksm")}
+
+    extra_vms_fit = 0
+    if ksm_vms and host.get("saved_mib"):
+        average_mib = sum(vm["mem_size_mib"] for vm in ksm_vms.values()) / len(ksm_vms)
+        extra_vms_fit = int(host["saved_mib"] // average_mib)
+
+    return {
+        "host": host,
+        "microvms": {
+            user_id: {
+                "mem_size_mib": vm["mem_size_mib"],
+                **(vm_ksm_info(vm["process"].pid) or {}),
+            }
+            for user_id, vm in ksm_vms.items()
+        },
+        "extra_vms_fit": extra_vms_fit,
+    }
+
+
+@router.get("/telemetry")
+async def get_telemetry(
+    window_seconds: int = 300,
+    user_id: Optional[str] = None,
+    _: str = Depends(verify_api_key),
+):
+    """
+    Resource usage per VM over the last window_seconds, busiest CPU first.
+
+    Host side (Firecracker process and TAP device): CPU, RSS, disk IO, network.
+    Guest side (envd): CPU, memory and disk as the guest sees them.
+    """
+    if user_id and user_id not in microvms:
+        raise HTTPException(404, f"No microVM for {user_id}")
+    if not 0 < window_seconds <= TELEMETRY_WINDOW_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"window_seconds must be between 1 and {TELEMETRY_WINDOW_SECONDS}",
+        )
+
+    return telemetry_summary(window_seconds, user_id)
+
+
+@router.get("/boot_prefetch")
+async def get_boot_prefetch(_: str = Depends(verify_api_key)):
+    """Boot traces per runtime and the last prefetch of each"""
+    return boot_prefetch_info()
+
+
+@router.post("/boot_trace")
+async def post_boot_trace(request: BootTraceRequest, _: str = Depends(verify_api_key)):
+    """
+    Record which parts of a runtime's image a boot reads, for prefetching.
+
+    Drops the image from the page cache and boots a throwaway VM until its agent
+    server is ready. Traces of the same image build are merged, so tracing once
+    per guest_init covers both. Run it on a quiet host: other VMs reading the
+    image meanwhile end up in the trace.
+    """
+    if request.runtime not in ROOTFS_IMAGES:
+        raise HTTPException(404, f"Unknown runtime: {request.runtime}")
+    if boot_prefetch_state["recording"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Already tracing {boot_prefetch_state['recording']}",
+        )
+
+    try:
+        return await record_boot_trace(
+            request.runtime, request.guest_init, request.rootfs_mode, request.env_vars
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Boot trace failed: {str(e)}")
+
+
+@router.post("/boot_prefetch")
+async def post_boot_prefetch(
+    runtime: str, force: bool = False, _: str = Depends(verify_api_key)
+):
+    """Read a runtime's traced boot blocks into the page cache now"""
+    if runtime not in ROOTFS_IMAGES:
+        raise HTTPException(404, f"Unknown runtime: {runtime}")
+
+    return await asyncio.to_thread(prefetch_image, runtime, force)
+
+
+@router.get("/package_cache")
+async def get_package_cache(_: str = Depends(verify_api_key)):
+    """Package cache image, manifest and last refresh"""
+    return package_cache_info()
+
+
+@router.post("/refresh_package_cache")
+async def post_refresh_package_cache(
+    request: PackageCacheRequest, _: str = Depends(verify_api_key)
+):
+    """
+    Re-download the manifest's packages and rebuild the package cache image.
+
+    Runs in the background; new VMs get the new image once it is built, running
+    VMs keep theirs. Passing pip/npm lists replaces those parts of the manifest.
+    """
+    manifest = load_manifest()
+    if request.pip is not None:
+        manifest["pip"] = request.pip
+    if request.npm is not None:
+        manifest["npm"] = request.npm
+    save_manifest(manifest)
+
+    if package_cache_state["refreshing"]:
+        return {"status": "already_refreshing", "manifest": manifest}
+
+    run_in_background(refresh_package_cache())
+
+    return {"status": "refreshing", "manifest": manifest}
+
+
+@router.post("/snapshot_workspace")
+async def post_snapshot_workspace(
+    request: SnapshotRequest, _: str = Depends(verify_api_key)
+):
+    """Snapshot a VM's workspace now (only changed files are downloaded)"""
+    if request.user_id not in microvms:
+        raise HTTPException(404, f"No microVM for {request.user_id}")
+
+    try:
+        return await snapshot_workspace(microvms[request.user_id], request.user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Snapshot failed: {str(e)}")
+
+
+@router.get("/workspace_snapshots")
+async def workspace_snapshots(user_id: str, _: str = Depends(verify_api_key)):
+    """A user's stored workspace snapshots, newest last"""
+    return {"user_id": user_id, "snapshots": list_snapshots(user_id)}
+
+
 @router.get("/list_processes")
 async def list_processes(user_id: str, _: str = Depends(verify_api_key)):
     """List all running processes in the microVM"""
     if user_id not in microvms:
         raise HTTPException(404, f"No microVM for {user_id}")
 
-    vm = microvms[user_id]
-    vm_ip = vm["ip"]
-
-    rpc_client = ConnectClient(f"http://{vm_ip}:49983")
+    rpc_client = guest_rpc_client(microvms[user_id])
 
     request = process_pb2.ListRequest()
 
@@ -92,10 +303,14 @@ async def list_processes(user_id: str, _: str = Depends(verify_api_key)):
 
 @router.post("/kill_microvm")
 async def kill_microvm(
-    request: KillMicroVMRequest, force: bool = False, _: str = Depends(verify_api_key)
+    request: KillMicroVMRequest,
+    force: bool = False,
+    snapshot: bool = True,
+    _: str = Depends(verify_api_key),
 ):
     user_id = request.user_id
     vm_dir = f"{WORK_DIR}/{user_id}"
+    bind_log_context(user_id=user_id)
 
     if user_id not in microvms:
         if not force:
@@ -105,7 +320,7 @@ async def kill_microvm(
             )
 
         # Force mode: cleanup even without tracking
-        print(f"🔪 Force killing microVM for user {user_id}")
+        log.info(f"🔪 Force killing microVM for user {user_id}")
 
         # Kill any firecracker process for this user
         try:
@@ -117,9 +332,9 @@ async def kill_microvm(
             if result.stdout.strip():
                 for pid in result.stdout.strip().split("\n"):
                     subprocess.run(["sudo", "kill", "-9", pid], check=False)
-                    print(f"  ✓ Killed process {pid}")
+                    log.info(f"  ✓ Killed process {pid}")
         except Exception as e:
-            print(f"  ⚠️ Error killing processes: {e}")
+            log.warning(f"  ⚠️ Error killing processes: {e}")
 
         # Find and delete TAP device
         try:
@@ -132,9 +347,9 @@ async def kill_microvm(
                     subprocess.run(
                         ["sudo", "ip", "link", "delete", tap_name], check=False
                     )
-                    print(f"  ✓ Deleted TAP device {tap_name}")
+                    log.info(f"  ✓ Deleted TAP device {tap_name}")
         except Exception as e:
-            print(f"  ⚠️ Error cleaning TAP: {e}")
+            log.warning(f"  ⚠️ Error cleaning TAP: {e}")
 
         # Disconnect any NBD devices (try all, one might be ours)
         for i in range(16):
@@ -149,10 +364,12 @@ async def kill_microvm(
 
             try:
                 shutil.rmtree(vm_dir)
-                print(f"  ✓ Deleted VM directory {vm_dir}")
+                log.info(f"  ✓ Deleted VM directory {vm_dir}")
             except:
                 subprocess.run(["sudo", "rm", "-rf", vm_dir], check=False)
-                print(f"  ✓ Force deleted VM directory")
+                log.info(f"  ✓ Force deleted VM directory")
+
+        release_hugepages(user_id)
 
         return {"status": "force_killed", "user_id": user_id}
 
@@ -161,23 +378,32 @@ async def kill_microvm(
     tap_device = vm["tap_device"]
     nbd_device = vm.get("nbd_device")
 
-    print(f"🔪 Killing microVM for user {user_id} (PID: {proc.pid})")
+    # Step 0: Keep the user's workspace for their next VM
+    if snapshot and proc.poll() is None:
+        try:
+            await asyncio.wait_for(
+                snapshot_workspace(vm, user_id), SNAPSHOT_KILL_TIMEOUT
+            )
+        except Exception as e:
+            log.warning(f"  ⚠️ Workspace snapshot before kill failed: {e}")
+
+    log.info(f"🔪 Killing microVM for user {user_id} (PID: {proc.pid})")
 
     # Step 1: Kill Firecracker process with retries
     for attempt in range(3):
         try:
             if proc.poll() is None:  # Process still running
-                print(f"  Attempt {attempt+1}: Sending SIGKILL to PID {proc.pid}")
+                log.info(f"  Attempt {attempt+1}: Sending SIGKILL to PID {proc.pid}")
                 proc.send_signal(signal.SIGKILL)
                 proc.wait(timeout=3)
-                print(f"  ✓ Process {proc.pid} terminated")
+                log.info(f"  ✓ Process {proc.pid} terminated")
             break
         except subprocess.TimeoutExpired:
-            print(f"  ⚠️ Process {proc.pid} didn't die, retrying...")
+            log.warning(f"  ⚠️ Process {proc.pid} didn't die, retrying...")
             if attempt == 2:
-                print(f"  ⚠️ WARNING: Process {proc.pid} may be stuck")
+                log.warning(f"  ⚠️ WARNING: Process {proc.pid} may be stuck")
         except Exception as e:
-            print(f"  ⚠️ Error killing process: {e}")
+            log.warning(f"  ⚠️ Error killing process: {e}")
 
     # Step 2: Force kill any remaining process by PID
     try:
@@ -189,45 +415,47 @@ async def kill_microvm(
     except:
         pass
 
-    # Step 3: Delete route first (must be done before TAP deletion)
-    vm_ip = vm["ip"]
-    try:
-        subprocess.run(
-            ["sudo", "ip", "route", "del", f"{vm_ip}/32"],
-            capture_output=True,
-            timeout=5,
-            check=False,
-        )
-        print(f"  ✓ Deleted route to {vm_ip}/32")
-    except Exception as e:
-        print(f"  ⚠️ Route delete error (may not exist): {e}")
-
-    # Step 4: Delete TAP network device with retries
-    for attempt in range(3):
+    # vsock VMs without networking have no route or TAP device
+    if tap_device:
+        # Step 3: Delete route first (must be done before TAP deletion)
+        vm_ip = vm["ip"]
         try:
-            result = subprocess.run(
-                ["sudo", "ip", "link", "delete", tap_device],
+            subprocess.run(
+                ["sudo", "ip", "route", "del", f"{vm_ip}/32"],
                 capture_output=True,
-                text=True,
                 timeout=5,
+                check=False,
             )
-            if result.returncode == 0:
-                print(f"  ✓ Deleted TAP device {tap_device}")
-                break
-            elif "Cannot find device" in result.stderr:
-                print(f"  ✓ TAP device {tap_device} already gone")
-                break
-            else:
-                print(
-                    f"  ⚠️ TAP delete attempt {attempt+1} failed: {result.stderr.strip()}"
-                )
-        except subprocess.TimeoutExpired:
-            print(f"  ⚠️ TAP delete timeout on attempt {attempt+1}")
+            log.info(f"  ✓ Deleted route to {vm_ip}/32")
         except Exception as e:
-            print(f"  ⚠️ TAP delete error: {e}")
+            log.warning(f"  ⚠️ Route delete error (may not exist): {e}")
 
-        if attempt < 2:
-            await asyncio.sleep(0.5)
+        # Step 4: Delete TAP network device with retries
+        for attempt in range(3):
+            try:
+                result = subprocess.run(
+                    ["sudo", "ip", "link", "delete", tap_device],
+                    capture_output=True,
+                    text=True,
+                    timeout=5,
+                )
+                if result.returncode == 0:
+                    log.info(f"  ✓ Deleted TAP device {tap_device}")
+                    break
+                elif "Cannot find device" in result.stderr:
+                    log.info(f"  ✓ TAP device {tap_device} already gone")
+                    break
+                else:
+                    log.warning(
+                        f"  ⚠️ TAP delete attempt {attempt+1} failed: {result.stderr.strip()}"
+                    )
+            except subprocess.TimeoutExpired:
+                log.warning(f"  ⚠️ TAP delete timeout on attempt {attempt+1}")
+            except Exception as e:
+                log.warning(f"  ⚠️ TAP delete error: {e}")
+
+            if attempt < 2:
+                await asyncio.sleep(0.5)
 
     # Step 5: Disconnect NBD device
     if nbd_device:
@@ -238,11 +466,11 @@ async def kill_microvm(
                 timeout=5,
                 check=False,
             )
-            print(f"  ✓ Disconnected NBD device {nbd_device}")
+            log.info(f"  ✓ Disconnected NBD device {nbd_device}")
             # Wait for lock file to be fully released
             await asyncio.sleep(0.5)
         except Exception as e:
-            print(f"  ⚠️ NBD disconnect error: {e}")
+            log.warning(f"  ⚠️ NBD disconnect error: {e}")
 
     # Step 6: Clean up VM directory with retries
     for attempt in range(3):
@@ -251,10 +479,10 @@ async def kill_microvm(
 
             if os.path.exists(vm_dir):
                 shutil.rmtree(vm_dir)
-                print(f"  ✓ Deleted VM directory {vm_dir}")
+                log.info(f"  ✓ Deleted VM directory {vm_dir}")
             break
         except Exception as e:
-            print(f"  ⚠️ Directory cleanup attempt {attempt+1} failed: {e}")
+            log.warning(f"  ⚠️ Directory cleanup attempt {attempt+1} failed: {e}")
             if attempt < 2:
                 await asyncio.sleep(0.5)
             elif attempt == 2:
@@ -263,13 +491,18 @@ async def kill_microvm(
                     subprocess.run(
                         ["sudo", "rm", "-rf", vm_dir], timeout=5, check=False
                     )
-                    print(f"  ✓ Force deleted VM directory")
+                    log.info(f"  ✓ Force deleted VM directory")
                 except:
-                    print(f"  ❌ Could not delete {vm_dir}, manual cleanup required")
+                    log.error(
+                        f"  ❌ Could not delete {vm_dir}, manual cleanup required"
+                    )
 
-    # Step 7: Remove from tracking
+    # Step 7: Remove from tracking, its guest memory is back in the hugepage pool
     del microvms[user_id]
+    release_hugepages(user_id)
+    if vm.get("ksm"):
+        await asyncio.to_thread(tune_ksm)
 
-    print(f"✅ Cleaned up microVM for user {user_id}")
+    log.info(f"✅ Cleaned up microVM for user {user_id}")
 
     return {"status": "killed", "user_id": user_id}
@@ -1,11 +1,32 @@
 import asyncio
-from connectrpc.client import ConnectClient
-from connectrpc.method import MethodInfo, IdempotencyLevel
-import filesystem_pb2
-from fastapi import HTTPException, Request, Depends, APIRouter
-from fastapi.responses import StreamingResponse, Response
-from typing import Dict
-from config import SKIP_DIRS, SKIP_FILES
+from fastapi import HTTPException, Request, Depends, APIRouter, Header
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from typing import Dict, Literal, Optional
+from workspace_index import get_workspace_index
+from workspace_snapshots import restore_workspace
+from streaming import (
+    STREAM_MEDIA_TYPES,
+    STREAM_FLUSH_BYTES,
+    negotiate_encoding,
+    compress_stream,
+)
+from tasks import Task, tasks, start_task, cancel_task
+from hugepages import reserve_hugepages, release_hugepages
+from ksm import ksm_support, mergeable_command, tune_ksm
+from metrics import (
+    BOOT_PHASE_SECONDS,
+    STREAM_DURATION_SECONDS,
+    STREAM_SENT_BYTES,
+    UPLOAD_BYTES,
+    boot_span,
+)
+from guest_transport import (
+    ENVD_PORT,
+    FASTAPI_PORT,
+    VSOCK_GUEST_CID,
+    guest_address,
+    guest_client,
+)
 import subprocess
 import httpx
 import json
@@ -14,16 +35,25 @@ import time
 from auth import verify_api_key
 from models import (
     microvms,
+    creating_microvms,
     CreateMicroVMRequest,
     TaskRequest,
     KillMicroVMRequest,
+    CancelTaskRequest,
     FIRECRACKER_BIN,
     KERNEL_PATH,
     WORK_DIR,
     ROOTFS_IMAGES,
+    RESOURCE_PROFILES,
+    DEFAULT_RESOURCE_PROFILE,
+    WORKSPACE_TEMPLATES_DIR,
+    PACKAGE_CACHE_IMAGE,
+    GUEST_BOOT_FILE,
     next_ip,
     START_METHOD,
+    run_in_background,
 )
+from log import bind_log_context, log
 
 router = APIRouter()
 
@@ -39,6 +69,11 @@ async def create_microvm(
         user_id: User identifier
         runtime: Runtime environment ("python", "node", "python-data-science")
         env_vars: Environment variables to inject (API keys, etc.)
+        transport: "tap" (default) or "vsock" for host <-> guest traffic
+        network: Give the VM a TAP device and IP (vsock VMs can skip it)
+        hugepages: Back guest memory with 2 MiB hugepages (default: runtime profile)
+        ksm: Density mode, identical guest memory pages are merged across VMs
+        guest_init: "systemd" (default) or "minimal" init inside the VM
 
     Returns:
         {"status": "created", "vm_ip": "10.0.1.100"}
@@ -47,25 +82,35 @@ async def create_microvm(
 
     user_id = request.user_id
     runtime = request.runtime
+    bind_log_context(user_id=user_id)
     env_vars = request.env_vars
+    use_vsock = request.transport == "vsock"
+
+    if not request.network and not use_vsock:
+        raise HTTPException(
+            status_code=400,
+            detail="network=false needs transport=vsock, the host can't reach the VM otherwise",
+        )
 
     start_time = time.time()
-    print(
-        f"[DEBUG] [{time.time()-start_time:.3f}s] create_microvm called for user_id={user_id}, runtime={runtime}"
+    # Seconds per boot phase, kept as the VM's boot_phases
+    phases = {}
+    log.debug(
+        f"[{time.time()-start_time:.3f}s] create_microvm called for user_id={user_id}, runtime={runtime}"
     )
 
     if user_id in microvms:
-        print(
-            f"[DEBUG] [{time.time()-start_time:.3f}s] microVM already exists for {user_id}"
+        log.debug(
+            f"[{time.time()-start_time:.3f}s] microVM already exists for {user_id}"
         )
         return {"status": "already_exists", "vm_ip": microvms[user_id]["ip"]}
 
-    print(
+    log.info(
         f"🚀 [{time.time()-start_time:.3f}s] Creating microVM for user {user_id} with runtime: {runtime}"
     )
 
     # Validate runtime and get rootfs path
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Validating runtime {runtime}")
+    log.debug(f"[{time.time()-start_time:.3f}s] Validating runtime {runtime}")
     if runtime not in ROOTFS_IMAGES:
         raise HTTPException(
             status_code=400,
@@ -73,232 +118,478 @@ async def create_microvm(
         )
 
     rootfs_path = ROOTFS_IMAGES[runtime]
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Using rootfs: {rootfs_path}")
-
-    # Allocate IP
-    vm_ip = f"10.0.1.{next_ip}"
-    vm_ip_last_octet = next_ip
-    next_ip += 1
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Allocated IP {vm_ip}")
-
-    # Create short TAP device name (max 15 chars: "tap-" + 11 chars)
-    # Use hash of user_id to create unique but short name
-    import hashlib
-
-    tap_suffix = hashlib.md5(user_id.encode()).hexdigest()[:11]
-    tap_name = f"tap-{tap_suffix}"
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] TAP device: {tap_name}")
-
-    # Create working directory for this microVM
-    vm_dir = f"{WORK_DIR}/{user_id}"
-    os.makedirs(vm_dir, exist_ok=True)
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Created VM dir {vm_dir}")
-
-    # Create qcow2 overlay backed by base image (instant copy-on-write)
-    user_qcow2 = f"{vm_dir}/rootfs.qcow2"
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Creating qcow2 overlay")
-
-    qcow2_result = subprocess.run(
-        [
-            "qemu-img",
-            "create",
-            "-f",
-            "qcow2",
-            "-b",
-            rootfs_path,
-            "-F",
-            "raw",
-            user_qcow2,
-        ],
-        capture_output=True,
-        text=True,
+    log.debug(f"[{time.time()-start_time:.3f}s] Using rootfs: {rootfs_path}")
+
+    profile = RESOURCE_PROFILES.get(runtime, DEFAULT_RESOURCE_PROFILE)
+    use_hugepages = (
+        profile["hugepages"] if request.hugepages is None else request.hugepages
     )
-    if qcow2_result.returncode != 0:
+
+    if request.ksm and use_hugepages:
         raise HTTPException(
-            status_code=500, detail=f"Failed to create qcow2: {qcow2_result.stderr}"
-        )
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] qcow2 created")
-
-    # Find available NBD device
-    nbd_device = None
-    for i in range(32):  ##########corresponds to max nbd in .service
-        dev = f"/dev/nbd{i}"
-        check = subprocess.run(
-            ["sudo", "blockdev", "--getsize64", dev], capture_output=True
+            status_code=400,
+            detail="ksm can't merge hugepage memory, create the VM with hugepages=false",
         )
-        if check.returncode != 0 or check.stdout.strip() == b"0":
-            nbd_device = dev
-            break
-
-    if not nbd_device:
-        raise HTTPException(status_code=500, detail="No free NBD devices available")
 
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Using NBD device {nbd_device}")
-
-    # Connect qcow2 to NBD device
-    nbd_result = subprocess.run(
-        ["sudo", "qemu-nbd", "-c", nbd_device, user_qcow2],
-        capture_output=True,
-        text=True,
-    )
-    if nbd_result.returncode != 0:
+    if request.ksm and ksm_support() != "supported":
         raise HTTPException(
-            status_code=500, detail=f"Failed to connect NBD: {nbd_result.stderr}"
+            status_code=400, detail=f"ksm on this host is {ksm_support()}"
         )
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] NBD connected")
-
-    user_rootfs = nbd_device
-
-    # Clean up any existing socket files
-    socket_path = f"{vm_dir}/firecracker.sock"
-    if os.path.exists(socket_path):
-        os.remove(socket_path)
-        print(f"[DEBUG] [{time.time()-start_time:.3f}s] Removed old socket file")
-
-    # Create Firecracker config
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Creating Firecracker config")
-    config = {
-        "boot-source": {
-            "kernel_image_path": KERNEL_PATH,
-            "boot_args": f"console=ttyS0 reboot=k panic=1 root=/dev/vda rw init=/sbin/init random.trust_cpu=on ip={vm_ip}::10.0.1.1:255.255.255.0:vm:eth0:off:{tap_name}",
-        },
-        "drives": [
-            {
-                "drive_id": "rootfs",
-                "path_on_host": user_rootfs,
-                "is_root_device": True,
-                "is_read_only": False,
-            }
-        ],
-        "machine-config": {
-            "vcpu_count": 2,
-            "mem_size_mib": 2048 if runtime == "claude-agent" else 1024,
-        },
-        "network-interfaces": [
-            {
-                "iface_id": "eth0",
-                "guest_mac": f"AA:FC:00:00:00:{vm_ip_last_octet:02x}",
-                "host_dev_name": tap_name,
-            }
-        ],
-    }
 
-    config_path = f"{vm_dir}/config.json"
-    with open(config_path, "w") as f:
-        json.dump(config, f)
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Wrote config to {config_path}")
+    if user_id in creating_microvms:
+        raise HTTPException(
+            status_code=409, detail=f"microVM for {user_id} is already being created"
+        )
 
-    # Create TAP device for networking (async to avoid blocking)
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Starting TAP device creation")
+    # /maintenance leaves the hugepages of VMs still being created alone
+    creating_microvms.add(user_id)
+    metadata_path = None
     try:
-        proc = await asyncio.create_subprocess_exec(
-            "sudo", "ip", "tuntap", "add", tap_name, "mode", "tap"
-        )
-        await proc.wait()
-        print(f"[DEBUG] [{time.time()-start_time:.3f}s] TAP device created")
+        # Hugepage memory can't be overcommitted, admit the VM only if the pool has room
+        if use_hugepages and not await reserve_hugepages(
+            user_id, profile["mem_size_mib"]
+        ):
+            raise HTTPException(
+                status_code=503,
+                detail="Hugepage pool exhausted, retry later or create the VM with hugepages=false",
+            )
 
-        proc = await asyncio.create_subprocess_exec(
-            "sudo", "ip", "addr", "add", "10.0.1.1/32", "dev", tap_name
-        )
-        await proc.wait()
-        print(f"[DEBUG] [{time.time()-start_time:.3f}s] TAP IP configured as /32")
+        vm_ip = None
+        tap_name = None
+        if request.network:
+            # Allocate IP
+            vm_ip = f"10.0.1.{next_ip}"
+            vm_ip_last_octet = next_ip
+            next_ip += 1
+            bind_log_context(vm_ip=vm_ip)
+            log.debug(f"[{time.time()-start_time:.3f}s] Allocated IP {vm_ip}")
+
+            # Create short TAP device name (max 15 chars: "tap-" + 11 chars)
+            # Use hash of user_id to create unique but short name
+            import hashlib
+
+            tap_suffix = hashlib.md5(user_id.encode()).hexdigest()[:11]
+            tap_name = f"tap-{tap_suffix}"
+            log.debug(f"[{time.time()-start_time:.3f}s] TAP device: {tap_name}")
+
+        # Create working directory for this microVM
+        vm_dir = f"{WORK_DIR}/{user_id}"
+        os.makedirs(vm_dir, exist_ok=True)
+        log.debug(f"[{time.time()-start_time:.3f}s] Created VM dir {vm_dir}")
+
+        workspace_drive = None
+        if request.rootfs_mode == "shared":
+            # Every VM boots the base image read-only, its writes go to a small per-VM
+            # drive that overlay-init in the guest stacks on top (no qcow2/NBD)
+            nbd_device = None
+            user_rootfs = rootfs_path
+            workspace_drive = f"{vm_dir}/workspace.ext4"
+            with boot_span(phases, "workspace_drive"):
+                create_workspace_drive(workspace_drive, request.workspace_size_mib)
+            log.debug(f"[{time.time()-start_time:.3f}s] Workspace drive created")
+        else:
+            # Create qcow2 overlay backed by base image (instant copy-on-write)
+            user_qcow2 = f"{vm_dir}/rootfs.qcow2"
+            log.debug(f"[{time.time()-start_time:.3f}s] Creating qcow2 overlay")
+
+            with boot_span(phases, "qcow2"):
+                qcow2_result = subprocess.run(
+                    [
+                        "qemu-img",
+                        "create",
+                        "-f",
+                        "qcow2",
+                        "-b",
+                        rootfs_path,
+                        "-F",
+                        "raw",
+                        user_qcow2,
+                    ],
+                    capture_output=True,
+                    text=True,
+                )
+                if qcow2_result.returncode != 0:
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Failed to create qcow2: {qcow2_result.stderr}",
+                    )
+            log.debug(f"[{time.time()-start_time:.3f}s] qcow2 created")
+
+            # Find available NBD device and connect the qcow2 to it
+            with boot_span(phases, "nbd"):
+                nbd_device = None
+                for i in range(32):  ##########corresponds to max nbd in .service
+                    dev = f"/dev/nbd{i}"
+                    check = subprocess.run(
+                        ["sudo", "blockdev", "--getsize64", dev], capture_output=True
+                    )
+                    if check.returncode != 0 or check.stdout.strip() == b"0":
+                        nbd_device = dev
+                        break
 
-        proc = await asyncio.create_subprocess_exec(
-            "sudo", "ip", "link", "set", tap_name, "up"
-        )
-        await proc.wait()
-        print(f"[DEBUG] [{time.time()-start_time:.3f}s] TAP link up")
+                if not nbd_device:
+                    raise HTTPException(
+                        status_code=500, detail="No free NBD devices available"
+                    )
 
-        proc = await asyncio.create_subprocess_exec(
-            "sudo", "ip", "route", "add", f"{vm_ip}/32", "dev", tap_name
-        )
-        await proc.wait()
-        print(f"[DEBUG] [{time.time()-start_time:.3f}s] Route to {vm_ip}/32 added")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Network setup failed: {e}")
-
-    # Start Firecracker process
-    print(f"[DEBUG] [{time.time()-start_time:.3f}s] Preparing to start Firecracker")
-    socket_path = f"{vm_dir}/firecracker.sock"
-    log_path = f"{vm_dir}/firecracker.log"
-    print(
-        f"[DEBUG] [{time.time()-start_time:.3f}s] Socket: {socket_path}, Log: {log_path}"
-    )
+                log.debug(
+                    f"[{time.time()-start_time:.3f}s] Using NBD device {nbd_device}"
+                )
 
-    try:
-        print(f"[DEBUG] [{time.time()-start_time:.3f}s] Opening log file {log_path}")
-        log_file = open(log_path, "w")
-        print(
-            f"[DEBUG] [{time.time()-start_time:.3f}s] Log file opened, starting Popen"
-        )
-        proc = subprocess.Popen(
-            [FIRECRACKER_BIN, "--api-sock", socket_path, "--config-file", config_path],
-            stdout=log_file,
-            stderr=log_file,
-            start_new_session=True,
-        )
-        print(
-            f"[DEBUG] [{time.time()-start_time:.3f}s] Popen returned, PID: {proc.pid}"
+                # Connect qcow2 to NBD device
+                nbd_result = subprocess.run(
+                    ["sudo", "qemu-nbd", "-c", nbd_device, user_qcow2],
+                    capture_output=True,
+                    text=True,
+                )
+                if nbd_result.returncode != 0:
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Failed to connect NBD: {nbd_result.stderr}",
+                    )
+                log.debug(f"[{time.time()-start_time:.3f}s] NBD connected")
+
+            user_rootfs = nbd_device
+
+        # Clean up any existing socket files
+        socket_path = f"{vm_dir}/firecracker.sock"
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+            log.debug(f"[{time.time()-start_time:.3f}s] Removed old socket file")
+
+        vsock_path = f"{vm_dir}/vsock.sock" if use_vsock else None
+        if vsock_path and os.path.exists(vsock_path):
+            os.remove(vsock_path)
+
+        # Create Firecracker config
+        log.debug(f"[{time.time()-start_time:.3f}s] Creating Firecracker config")
+        guest_init = (
+            "/sbin/mini-init" if request.guest_init == "minimal" else "/sbin/init"
         )
+        if workspace_drive:
+            root_args = (
+                f"root=/dev/vda ro init=/sbin/overlay-init next_init={guest_init}"
+            )
+        else:
+            root_args = f"root=/dev/vda rw init={guest_init}"
+        boot_args = f"console=ttyS0 reboot=k panic=1 {root_args} random.trust_cpu=on"
+        if vm_ip:
+            boot_args += f" ip={vm_ip}::10.0.1.1:255.255.255.0:vm:eth0:off:{tap_name}"
+
+        config = {
+            "boot-source": {
+                "kernel_image_path": KERNEL_PATH,
+                "boot_args": boot_args,
+            },
+            "drives": [
+                {
+                    "drive_id": "rootfs",
+                    "path_on_host": user_rootfs,
+                    "is_root_device": True,
+                    "is_read_only": workspace_drive is not None,
+                }
+            ],
+            "machine-config": {
+                "vcpu_count": profile["vcpu_count"],
+                "mem_size_mib": profile["mem_size_mib"],
+            },
+        }
+
+        if use_hugepages:
+            config["machine-config"]["huge_pages"] = "2M"
+
+        if workspace_drive:
+            config["drives"].append(
+                {
+                    "drive_id": "workspace",
+                    "path_on_host": workspace_drive,
+                    "is_root_device": False,
+                    "is_read_only": False,
+                }
+            )
+
+        # Package cache goes last, the guest finds it by its "pkgcache" label
+        if request.package_cache and os.path.exists(PACKAGE_CACHE_IMAGE):
+            config["drives"].append(
+                {
+                    "drive_id": "package_cache",
+                    "path_on_host": PACKAGE_CACHE_IMAGE,
+                    "is_root_device": False,
+                    "is_read_only": True,
+                }
+            )
+
+        if tap_name:
+            config["network-interfaces"] = [
+                {
+                    "iface_id": "eth0",
+                    "guest_mac": f"AA:FC:00:00:00:{vm_ip_last_octet:02x}",
+                    "host_dev_name": tap_name,
+                }
+            ]
+
+        if vsock_path:
+            config["vsock"] = {"guest_cid": VSOCK_GUEST_CID, "uds_path": vsock_path}
+
+        # envd's boot config (env vars/API keys) goes into Firecracker's MMDS, so it is
+        # there when the guest starts instead of being POSTed to envd after boot. MMDS
+        # is served on the network interface, VMs without one still get /init.
+        if tap_name:
+            config["mmds-config"] = {"version": "V2", "network_interfaces": ["eth0"]}
+            metadata_path = f"{vm_dir}/metadata.json"
+            fd = os.open(metadata_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"envd": {"envVars": env_vars}}, f)
+
+        config_path = f"{vm_dir}/config.json"
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+        log.debug(f"[{time.time()-start_time:.3f}s] Wrote config to {config_path}")
+
+        # Create TAP device for networking (async to avoid blocking)
+        if tap_name:
+            log.debug(f"[{time.time()-start_time:.3f}s] Starting TAP device creation")
+            with boot_span(phases, "tap"):
+                try:
+                    proc = await asyncio.create_subprocess_exec(
+                        "sudo", "ip", "tuntap", "add", tap_name, "mode", "tap"
+                    )
+                    await proc.wait()
+                    log.debug(f"[{time.time()-start_time:.3f}s] TAP device created")
 
-        print(
-            f"✅ Started Firecracker for user {user_id} (PID: {proc.pid}), logs: {log_path}"
+                    proc = await asyncio.create_subprocess_exec(
+                        "sudo", "ip", "addr", "add", "10.0.1.1/32", "dev", tap_name
+                    )
+                    await proc.wait()
+                    log.debug(
+                        f"[{time.time()-start_time:.3f}s] TAP IP configured as /32"
+                    )
+
+                    proc = await asyncio.create_subprocess_exec(
+                        "sudo", "ip", "link", "set", tap_name, "up"
+                    )
+                    await proc.wait()
+                    log.debug(f"[{time.time()-start_time:.3f}s] TAP link up")
+
+                    proc = await asyncio.create_subprocess_exec(
+                        "sudo", "ip", "route", "add", f"{vm_ip}/32", "dev", tap_name
+                    )
+                    await proc.wait()
+                    log.debug(
+                        f"[{time.time()-start_time:.3f}s] Route to {vm_ip}/32 added"
+                    )
+                except Exception as e:
+                    raise HTTPException(
+                        status_code=500, detail=f"Network setup failed: {e}"
+                    )
+
+        # Start Firecracker process
+        log.debug(f"[{time.time()-start_time:.3f}s] Preparing to start Firecracker")
+        socket_path = f"{vm_dir}/firecracker.sock"
+        log_path = f"{vm_dir}/firecracker.log"
+        log.debug(
+            f"[{time.time()-start_time:.3f}s] Socket: {socket_path}, Log: {log_path}"
         )
 
-        # Store microVM info
-        microvms[user_id] = {
-            "process": proc,
-            "ip": vm_ip,
-            "runtime": runtime,
-            "socket": socket_path,
-            "tap_device": tap_name,
-            "nbd_device": nbd_device,  # NBD device for qcow2 overlay
-            "running_process_pid": None,  # REPL kernel PID
-            "background_process_pid": None,  # Background server PID (only one)
-            "created_at": time.time(),  # Track creation timestamp
-        }
+        try:
+            log.debug(f"[{time.time()-start_time:.3f}s] Opening log file {log_path}")
+            log_file = open(log_path, "w")
+            log.debug(
+                f"[{time.time()-start_time:.3f}s] Log file opened, starting Popen"
+            )
+            firecracker_args = [
+                FIRECRACKER_BIN,
+                "--api-sock",
+                socket_path,
+                "--config-file",
+                config_path,
+            ]
+            if metadata_path:
+                firecracker_args += ["--metadata", metadata_path]
+            if request.ksm:
+                firecracker_args = mergeable_command(firecracker_args)
+
+            with boot_span(phases, "firecracker_spawn"):
+                proc = subprocess.Popen(
+                    firecracker_args,
+                    stdout=log_file,
+                    stderr=log_file,
+                    start_new_session=True,
+                )
+            log.debug(
+                f"[{time.time()-start_time:.3f}s] Popen returned, PID: {proc.pid}"
+            )
+
+            log.info(
+                f"✅ Started Firecracker for user {user_id} (PID: {proc.pid}), logs: {log_path}"
+            )
+
+            # Store microVM info
+            microvms[user_id] = {
+                "process": proc,
+                "ip": vm_ip,
+                "runtime": runtime,
+                "socket": socket_path,
+                "vsock_path": vsock_path,  # Set when host <-> guest traffic uses vsock
+                "tap_device": tap_name,
+                "nbd_device": nbd_device,  # NBD device for qcow2 overlay (None when shared)
+                "rootfs_mode": request.rootfs_mode,
+                "hugepages": use_hugepages,
+                "ksm": request.ksm,
+                "guest_init": request.guest_init,
+                "guest_boot": None,  # Boot milestones reported by the minimal init
+                "guest_startup": None,  # Agent server startup phases (from its /health)
+                "boot_phases": phases,  # Host-side seconds per create_microvm phase
+                "vcpu_count": profile["vcpu_count"],
+                "mem_size_mib": profile["mem_size_mib"],
+                "running_process_pid": None,  # REPL kernel PID
+                "background_process_pid": None,  # Background server PID (only one)
+                "workspace_index": None,  # WorkspaceIndex, created on first use
+                "created_at": time.time(),  # Track creation timestamp
+            }
+
+            vm = microvms[user_id]
+
+            if request.ksm:
+                await asyncio.to_thread(tune_ksm)
+
+            # Wait for envd to start inside microVM (usually 200-500ms)
+            with boot_span(phases, "envd_ready"):
+                await wait_for_envd(vm)
 
-        # Wait for envd to start inside microVM (usually 200-500ms)
-        await wait_for_envd(vm_ip)
+            if not metadata_path:
+                with boot_span(phases, "envd_init"):
+                    await init_envd(vm, env_vars)
 
-        # Always initialize envd
-        await init_envd(vm_ip, env_vars)
+            async def fastapi_ready():
+                with boot_span(phases, "fastapi_ready"):
+                    await wait_for_fastapi(vm)
 
-        await wait_for_fastapi(vm_ip)
+            async def workspace_restore():
+                with boot_span(phases, "workspace_restore"):
+                    return await restore_user_workspace(vm, user_id)
 
-        return {"status": "created", "vm_ip": vm_ip, "pid": proc.pid}
+            # Bring the user's workspace back while the agent server starts
+            restored = None
+            if request.restore_workspace:
+                restored, _ = await asyncio.gather(workspace_restore(), fastapi_ready())
+            else:
+                await fastapi_ready()
+
+            phases["total"] = round(time.time() - start_time, 4)
+            BOOT_PHASE_SECONDS.observe(time.time() - start_time, phase="total")
+            log.info(
+                f"⏱️ Boot phases for {user_id}: "
+                + ", ".join(f"{phase} {seconds}s" for phase, seconds in phases.items())
+            )
+
+            if request.guest_init == "minimal":
+                run_in_background(fetch_guest_boot(vm))
 
+            return {
+                "status": "created",
+                "vm_ip": vm_ip,
+                "transport": request.transport,
+                "pid": proc.pid,
+                "restored_files": restored["files"] if restored else 0,
+            }
+
+        except Exception as e:
+            # Cleanup on failure
+            if proc:
+                proc.kill()
+            raise HTTPException(
+                status_code=500, detail=f"Failed to start Firecracker: {e}"
+            )
+    except BaseException:
+        # Any failure after the reservation, including the early HTTPExceptions
+        release_hugepages(user_id)
+        raise
+    finally:
+        creating_microvms.discard(user_id)
+        # Firecracker reads the MMDS config at startup, don't keep the secrets on
+        # disk once it has them or the boot failed
+        if metadata_path:
+            try:
+                os.remove(metadata_path)
+            except FileNotFoundError:
+                pass
+
+
+async def restore_user_workspace(vm: dict, user_id: str) -> Optional[dict]:
+    """Restore the latest workspace snapshot, a failure just means an empty workspace"""
+    try:
+        return await restore_workspace(vm, user_id)
     except Exception as e:
-        # Cleanup on failure
-        if proc:
-            proc.kill()
-        raise HTTPException(status_code=500, detail=f"Failed to start Firecracker: {e}")
+        log.warning(f"⚠️ Failed to restore workspace for {user_id}: {e}")
+        return None
+
+
+def create_workspace_drive(path: str, size_mib: int):
+    """
+    Create an empty, sparse ext4 drive for a shared-rootfs VM's writable state.
+
+    mkfs runs once per size into a template, VMs get a sparse (or reflinked) copy.
+    """
+    template = f"{WORKSPACE_TEMPLATES_DIR}/workspace-{size_mib}M.ext4"
+
+    if not os.path.exists(template):
+        os.makedirs(WORKSPACE_TEMPLATES_DIR, exist_ok=True)
+        tmp_template = f"{template}.{os.getpid()}.tmp"
+        with open(tmp_template, "wb") as f:
+            f.truncate(size_mib * 1024 * 1024)
+
+        mkfs_result = subprocess.run(
+            ["mkfs.ext4", "-q", "-F", "-m", "0", tmp_template],
+            capture_output=True,
+            text=True,
+        )
+        if mkfs_result.returncode != 0:
+            os.remove(tmp_template)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to format workspace drive: {mkfs_result.stderr}",
+            )
+        os.replace(tmp_template, template)
 
+    cp_result = subprocess.run(
+        ["cp", "--sparse=always", "--reflink=auto", template, path],
+        capture_output=True,
+        text=True,
+    )
+    if cp_result.returncode != 0:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to create workspace drive: {cp_result.stderr}",
+        )
 
-async def wait_for_envd(vm_ip: str, timeout: int = 30):
+
+async def wait_for_envd(vm: dict, timeout: int = 30):
     """
     Wait for envd to start inside the microVM.
 
     envd listens on port 49983. Check /health endpoint with fast retries.
     Retry w/ 5ms delays.
     """
-    print(f"⏳ Waiting for envd to start at {vm_ip}:49983...", flush=True)
+    address = guest_address(vm, ENVD_PORT)
+    log.info(f"⏳ Waiting for envd to start at {address}...")
 
     max_attempts = timeout * 200
     for i in range(max_attempts):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"http://{vm_ip}:49983/health", timeout=2.0)
+            async with guest_client(vm, ENVD_PORT) as client:
+                response = await client.get("/health", timeout=2.0)
                 if response.status_code == 204 or response.status_code == 200:
-                    print(
-                        f"✅ envd is ready at {vm_ip}:49983 (attempt {i+1}/{max_attempts})",
-                        flush=True,
+                    log.info(
+                        f"✅ envd is ready at {address} (attempt {i+1}/{max_attempts})"
                     )
                     return
         except Exception as e:
             if i % 200 == 0 and i > 0:
-                print(f"   Still waiting... attempt {i+1}/{max_attempts}", flush=True)
-            pass
+                log.info(
+                    f"   Still waiting... attempt {i+1}/{max_attempts}",
+                    extra={"sample": "wait_for_envd"},
+                )
 
         await asyncio.sleep(0.005)
 
@@ -307,92 +598,123 @@ async def wait_for_envd(vm_ip: str, timeout: int = 30):
     )
 
 
-async def init_envd(vm_ip: str, env_vars: Dict[str, str] = {}):
+async def init_envd(vm: dict, env_vars: Dict[str, str] = {}):
     """
     Initialize envd with environment variables and timestamp.
 
     This is how we inject API keys, etc. into the microVM.
     """
     try:
-        async with httpx.AsyncClient() as client:
+        async with guest_client(vm, ENVD_PORT) as client:
             payload = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
             if env_vars:
                 payload["envVars"] = env_vars
 
-            response = await client.post(
-                f"http://{vm_ip}:49983/init", json=payload, timeout=5.0
-            )
+            response = await client.post("/init", json=payload, timeout=5.0)
             if response.status_code != 200 and response.status_code != 204:
-                print(f"⚠️ Failed to initialize envd: {response.text}")
+                log.warning(f"⚠️ Failed to initialize envd: {response.text}")
     except Exception as e:
-        print(f"⚠️ Failed to initialize envd: {e}")
+        log.warning(f"⚠️ Failed to initialize envd: {e}")
 
 
-async def wait_for_fastapi(vm_ip: str, timeout: int = 60):
+async def wait_for_fastapi(vm: dict, timeout: int = 60):
     """
     Wait for FastAPI wrapper to be fully ready inside the microVM.
 
     FastAPI listens on port 49999.
     """
-    print(
-        f"⏳ [HOST] Waiting for FastAPI to start at {vm_ip}:49999...",
-        flush=True,
-    )
+    address = guest_address(vm, FASTAPI_PORT)
+    log.info(f"⏳ [HOST] Waiting for FastAPI to start at {address}...")
 
     max_attempts = timeout * 10
     for i in range(max_attempts):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"http://{vm_ip}:49999/health", timeout=2.0)
+            async with guest_client(vm, FASTAPI_PORT) as client:
+                response = await client.get("/health", timeout=2.0)
                 if response.status_code == 200:
 
                     health_data = response.json()
                     agent_ready = health_data.get("agent") == "ready"
+                    # Time per startup phase in the guest server
+                    vm["guest_startup"] = health_data.get("startup")
+
+                    if health_data.get("agent") == "failed":
+                        error = (health_data.get("startup") or {}).get("error")
+                        raise HTTPException(
+                            status_code=500,
+                            detail=f"Claude Agent failed to start: {error}",
+                        )
 
                     if agent_ready:
                         backend = "Claude Agent"
-                        print(
-                            f"✅ [HOST] FastAPI and {backend} are ready at {vm_ip}:49999 (attempt {i+1}/{max_attempts})",
-                            flush=True,
+                        log.info(
+                            f"✅ [HOST] FastAPI and {backend} are ready at {address} (attempt {i+1}/{max_attempts})"
                         )
                         return
                     else:
                         # FastAPI is up but backend not ready yet
                         if i % 100 == 0 and i > 0:
-                            print(
+                            log.info(
                                 f"   [HOST] FastAPI up, waiting for backend... attempt {i+1}/{max_attempts}",
-                                flush=True,
+                                extra={"sample": "wait_for_agent"},
                             )
+        except HTTPException:
+            raise
         except Exception as e:
             if i % 100 == 0 and i > 0:
-                print(
+                log.info(
                     f"   [HOST] Still waiting for FastAPI... attempt {i+1}/{max_attempts}, last error: {type(e).__name__}",
-                    flush=True,
+                    extra={"sample": "wait_for_fastapi"},
                 )
 
         await asyncio.sleep(0.1)
 
-    print(
-        f"❌ [HOST] FastAPI did not start within {timeout} seconds after {max_attempts} attempts",
-        flush=True,
+    log.error(
+        f"❌ [HOST] FastAPI did not start within {timeout} seconds after {max_attempts} attempts"
     )
     raise HTTPException(
         status_code=500, detail=f"FastAPI did not start within {timeout} seconds"
     )
 
 
+async def fetch_guest_boot(vm: dict):
+    """Read the boot milestones mini-init wrote (seconds since the guest kernel started)"""
+    try:
+        async with guest_client(vm, ENVD_PORT) as client:
+            response = await client.get(
+                "/files", params={"path": GUEST_BOOT_FILE}, timeout=5.0
+            )
+            response.raise_for_status()
+            vm["guest_boot"] = response.json()
+    except Exception as e:
+        log.warning(f"⚠️ Could not read guest boot milestones: {e}")
+        return
+
+    milestones = vm["guest_boot"].get("milestones", {})
+    log.info(
+        f"🥾 Guest boot: init at {milestones.get('init_started')}s, "
+        f"envd listening at {milestones.get('envd_listening')}s, "
+        f"FastAPI listening at {milestones.get('claude-fastapi_listening')}s"
+    )
+
+
 @router.post("/claude_in_the_box")
-async def claude_in_the_box(request: TaskRequest, _: str = Depends(verify_api_key)):
+async def claude_in_the_box(
+    request: TaskRequest,
+    accept_encoding: Optional[str] = Header(None),
+    _: str = Depends(verify_api_key),
+):
     """
     Send task to claude agent in microvm
 
-    Streams output back to caller in real-time.
+    Streams output back to caller in real-time. With stream_format "ndjson" or
+    "sse" the stream carries typed events and is compressed when the caller's
+    Accept-Encoding allows it. The X-Task-Id response header identifies the task
+    for /task_stream if the connection drops.
     """
     user_id = request.user_id
-    task = request.task
-    context = request.context
     files = request.files
-    filenames = list(files.keys())  # Extract filenames for claude agent
+    bind_log_context(user_id=user_id)
 
     # Check if microVM exists
     if user_id not in microvms:
@@ -401,13 +723,194 @@ async def claude_in_the_box(request: TaskRequest, _: str = Depends(verify_api_ke
         )
 
     vm = microvms[user_id]
-    vm_ip = vm["ip"]
     runtime = vm["runtime"]
+    address = guest_address(vm, FASTAPI_PORT)
+
+    log.info(f"▶️ Starting {runtime} code for user {user_id} on {address}")
+
+    await prepare_task(vm, files)
+
+    # =========================================================================
+    # Claude mode run in persisten sesion
+    # =========================================================================
+
+    log.info(f"🔧 Sending {runtime} code to FastAPI at {address}")
+
+    # Output is pumped into a replay buffer in the background, so the caller can
+    # reconnect through /task_stream with X-Task-Id if this connection drops
+    task_run = start_task(
+        user_id,
+        vm,
+        task_payload(request),
+        callback_url=request.callback_url,
+        cancel_on_disconnect=request.cancel_on_disconnect,
+        flush_ms=request.flush_ms,
+    )
+
+    return task_stream_response(task_run, 0, accept_encoding)
+
 
-    print(f"▶️ Starting {runtime} code for user {user_id} on {vm_ip}")
+@router.post("/submit_task")
+async def submit_task(request: TaskRequest, _: str = Depends(verify_api_key)):
+    """
+    Submit task to claude agent in microvm without waiting for it.
+
+    The task (including file uploads) runs on the host independently of this
+    request. Follow it with /task_stream, poll /task_status and fetch the output
+    with /task_result, or pass callback_url to get the final status POSTed.
+
+    Returns:
+        {"task_id": "...", "status": "running"}
+    """
+    user_id = request.user_id
+    bind_log_context(user_id=user_id)
+
+    if user_id not in microvms:
+        raise HTTPException(
+            status_code=404, detail=f"No microVM found for user {user_id}"
+        )
+
+    vm = microvms[user_id]
+
+    log.info(
+        f"📨 Task submitted for user {user_id} on {guest_address(vm, FASTAPI_PORT)}"
+    )
+
+    task_run = start_task(
+        user_id,
+        vm,
+        task_payload(request),
+        prepare=prepare_task(vm, request.files),
+        callback_url=request.callback_url,
+        flush_ms=request.flush_ms,
+    )
+
+    return {"task_id": task_run.task_id, "status": task_run.status}
+
+
+@router.get("/task_status")
+async def task_status(task_id: str, _: str = Depends(verify_api_key)):
+    """Status of a task started by /claude_in_the_box or /submit_task"""
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail=f"No task found with id {task_id}")
+
+    return tasks[task_id].info()
+
+
+@router.post("/cancel_task")
+async def cancel_task_route(
+    request: CancelTaskRequest, _: str = Depends(verify_api_key)
+):
+    """
+    Cancel a task. The agent in the microVM is interrupted, so the session is
+    ready for the next task.
+    """
+    if request.task_id not in tasks:
+        raise HTTPException(
+            status_code=404, detail=f"No task found with id {request.task_id}"
+        )
+
+    task_run = tasks[request.task_id]
+    if task_run.status != "running":
+        raise HTTPException(
+            status_code=409, detail=f"Task {request.task_id} already {task_run.status}"
+        )
 
+    await cancel_task(task_run)
+
+    return {"status": "cancelling", "task_id": request.task_id}
+
+
+@router.get("/task_result")
+async def task_result(task_id: str, _: str = Depends(verify_api_key)):
+    """
+    Full output of a finished task.
+
+    Returns 409 while the task is still running - use /task_stream to follow it.
+    """
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail=f"No task found with id {task_id}")
+
+    task_run = tasks[task_id]
+    if task_run.status == "running":
+        raise HTTPException(status_code=409, detail=f"Task {task_id} is still running")
+
+    return FileResponse(
+        task_run.output.path,
+        media_type=STREAM_MEDIA_TYPES[task_run.stream_format],
+        headers={"X-Task-Id": task_run.task_id, "X-Task-Status": task_run.status},
+    )
+
+
+@router.get("/task_queue")
+async def task_queue(user_id: str, _: str = Depends(verify_api_key)):
+    """Running and waiting tasks per agent session inside the microVM"""
+    if user_id not in microvms:
+        raise HTTPException(404, f"No microVM for {user_id}")
+
+    async with guest_client(microvms[user_id], FASTAPI_PORT) as http_client:
+        try:
+            response = await http_client.get("/queue", timeout=5.0)
+            return response.json()
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"Failed to get task queue: {str(e)}"
+            )
+
+
+@router.get("/tool_payload")
+async def tool_payload(
+    user_id: str,
+    tool_use_id: str,
+    part: Literal["input", "output"] = "input",
+    _: str = Depends(verify_api_key),
+):
+    """Full tool input or output that a task stream only previewed or summarized"""
+    if user_id not in microvms:
+        raise HTTPException(404, f"No microVM for {user_id}")
+
+    async with guest_client(microvms[user_id], FASTAPI_PORT) as http_client:
+        try:
+            response = await http_client.get(
+                "/tool_payload",
+                params={"tool_use_id": tool_use_id, "part": part},
+                timeout=30.0,
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"Failed to get tool payload: {str(e)}"
+            )
+
+    if response.status_code != 200:
+        # FastAPI returns {"detail": "error message"}, proxies and crashes don't
+        try:
+            detail = response.json().get("detail", response.text)
+        except (ValueError, AttributeError):
+            detail = response.text
+        raise HTTPException(response.status_code, detail)
+
+    return Response(content=response.content, media_type="application/json")
+
+
+def task_payload(request: TaskRequest) -> dict:
+    """Body for the claude FastAPI server's /execute_task"""
+    return {
+        "task": request.task,
+        "context": request.context,
+        "files": list(request.files.keys()),  # Extract filenames for claude agent
+        "stream_format": request.stream_format,
+        "session_id": request.session_id,
+        "timeout_seconds": request.timeout_seconds,
+        "reset_context": request.reset_context,
+        "flush_ms": request.flush_ms,
+        "tool_verbosity": request.tool_verbosity,
+    }
+
+
+async def prepare_task(vm: dict, files: Dict[str, str]):
+    """Upload the task's files and mark the workspace index before the task runs"""
     if files:
-        async with httpx.AsyncClient() as http_client:
+        async with guest_client(vm, ENVD_PORT) as http_client:
             for filename, content in files.items():
                 try:
                     # Decode content properly
@@ -424,57 +927,99 @@ async def claude_in_the_box(request: TaskRequest, _: str = Depends(verify_api_ke
                         file_content = content
 
                     await http_client.post(
-                        f"http://{vm_ip}:49983/files",
+                        "/files",
                         params={"path": f"/workspace/{filename}"},
                         files={"file": file_content},
                     )
-                    print(f"📤 Uploaded {filename} to microVM")
+                    UPLOAD_BYTES.observe(len(file_content))
+                    log.debug(f"📤 Uploaded {filename} to microVM")
                 except Exception as e:
-                    print(f"⚠️ Failed to upload {filename}: {e}")
+                    log.warning(f"⚠️ Failed to upload {filename}: {e}")
 
-    # =========================================================================
-    # Claude mode run in persisten sesion
-    # =========================================================================
+    # Mark where this task starts so /workspace_changes can return just its output
+    index = get_workspace_index(vm)
+    try:
+        index.task_cursor = await index.sync()
+    except Exception as e:
+        log.warning(f"⚠️ Failed to sync workspace index: {e}")
 
-    print(f"🔧 Sending {runtime} code to FastAPI at {vm_ip}:49999")
 
-    # Stream response from Claude FastAPI
-    async def stream_from_claude_fastapi():
-        try:
-            async with httpx.AsyncClient(timeout=1800.0) as http_client:
-                async with http_client.stream(
-                    "POST",
-                    f"http://{vm_ip}:49999/execute_task",
-                    json={"task": task, "context": context, "files": filenames},
-                ) as response:
-                    # Check for errors
-                    if response.status_code != 200:
-                        error_msg = await response.aread()
-                        # FastAPI returns {"detail": "error message"}, extract just the detail
-                        try:
-                            error_data = json.loads(error_msg)
-                            error_detail = error_data.get("detail", error_msg.decode())
-                        except:
-                            error_detail = error_msg.decode()
-                        raise HTTPException(500, error_detail)
+@router.get("/task_stream")
+async def task_stream(
+    task_id: str,
+    offset: int = 0,
+    accept_encoding: Optional[str] = Header(None),
+    _: str = Depends(verify_api_key),
+):
+    """
+    Resume a task's output stream without re-running the task.
 
-                    # Stream output as bytes
-                    async for chunk in response.aiter_bytes():
-                        if chunk:
-                            yield chunk
+    Args:
+        task_id: X-Task-Id returned when the task was started
+        offset: Byte offset into the (uncompressed) output to resume from
 
-        except httpx.TimeoutException:
-            raise HTTPException(500, "Request timed out after 1800 seconds")
-        except httpx.ConnectError:
-            raise HTTPException(
-                500, f"Cannot connect to Claude FastAPI at {vm_ip}:49999"
-            )
-        except Exception as e:
-            raise HTTPException(
-                500, f"Error communicating with Claude FastAPI: {type(e).__name__}"
+    Streams output from offset until the task finishes.
+    """
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail=f"No task found with id {task_id}")
+
+    task_run = tasks[task_id]
+    if offset < 0 or offset > task_run.output.size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid offset {offset}, task has {task_run.output.size} bytes of output",
+        )
+
+    return task_stream_response(task_run, offset, accept_encoding)
+
+
+def task_stream_response(
+    task_run: Task, offset: int, accept_encoding: Optional[str]
+) -> StreamingResponse:
+    """Follow a task's output from offset as a streaming response"""
+
+    async def follow_output():
+        task_run.attach()
+        start = time.time()
+        try:
+            async for chunk in task_run.output.follow(
+                offset, STREAM_FLUSH_BYTES, task_run.flush_ms / 1000
+            ):
+                STREAM_SENT_BYTES.inc(len(chunk), format=task_run.stream_format)
+                yield chunk
+        finally:
+            # Last reader gone: task is cancelled unless someone resumes in time
+            task_run.detach()
+            STREAM_DURATION_SECONDS.observe(
+                time.time() - start, format=task_run.stream_format
             )
 
-    return StreamingResponse(stream_from_claude_fastapi(), media_type="text/plain")
+        # Break the stream like a failed proxy would, so callers see the error
+        if task_run.error:
+            raise HTTPException(500, task_run.error)
+
+    media_type = STREAM_MEDIA_TYPES[task_run.stream_format]
+    headers = {"X-Task-Id": task_run.task_id}
+
+    # Structured streams are opt-in, so only they get compressed - plain text
+    # clients keep the exact bytes they always got
+    encoding = (
+        negotiate_encoding(accept_encoding)
+        if task_run.stream_format != "text"
+        else None
+    )
+    if encoding:
+        return StreamingResponse(
+            compress_stream(follow_output(), encoding),
+            media_type=media_type,
+            headers={
+                **headers,
+                "Content-Encoding": encoding,
+                "Vary": "Accept-Encoding",
+            },
+        )
+
+    return StreamingResponse(follow_output(), media_type=media_type, headers=headers)
 
 
 @router.get(
@@ -482,78 +1027,71 @@ async def claude_in_the_box(request: TaskRequest, _: str = Depends(verify_api_ke
 )
 async def list_workspace_files(user_id: str, _: str = Depends(verify_api_key)):
     """
-    List all files in /workspace directory inside the microVM using filesystem gRPC API.
+    List all files in /workspace directory inside the microVM.
+
+    Answered from the VM's workspace index, which is kept current from envd
+    watcher events instead of re-listing the whole directory on every call.
 
     Args:
         user_id: User identifier
 
     Returns:
-        List of file paths relative to /workspace
+        List of file paths relative to /workspace and the index cursor
     """
     if user_id not in microvms:
         raise HTTPException(404, f"No microVM for {user_id}")
 
-    vm = microvms[user_id]
-    vm_ip = vm["ip"]
-
-    rpc_client = ConnectClient(f"http://{vm_ip}:49983")
-
-    LIST_DIR_METHOD = MethodInfo(
-        name="ListDir",
-        service_name="filesystem.Filesystem",
-        input=filesystem_pb2.ListDirRequest,
-        output=filesystem_pb2.ListDirResponse,
-        idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
-    )
-
-    list_request = filesystem_pb2.ListDirRequest(
-        path="/workspace",
-        depth=10,
-    )
+    index = get_workspace_index(microvms[user_id])
 
     try:
-        response = await rpc_client.execute_unary(
-            request=list_request, method=LIST_DIR_METHOD
+        cursor = await index.sync()
+        return {"files": index.list_files(), "cursor": cursor}
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to list workspace files: {str(e)}"
         )
 
-        files = []
-        for entry in response.entries:
-            if entry.type == filesystem_pb2.FileType.FILE_TYPE_FILE:
-                filename = entry.path.replace("/workspace/", "", 1)
 
-                # Skip dependency/cache directories (not user output)
-                # Check if ANY skip pattern appears in the path (handles subfolders)
-                skip_dirs = SKIP_DIRS
-                if any(
-                    f"/{d}" in f"/{filename}" or filename.startswith(d)
-                    for d in skip_dirs
-                ):
-                    continue
+@router.get("/workspace_changes")
+async def workspace_changes(
+    user_id: str, cursor: Optional[int] = None, _: str = Depends(verify_api_key)
+):
+    """
+    List files created or modified in /workspace since a cursor.
 
-                # Skip lock files and intermediate artifacts
-                skip_files = SKIP_FILES
-                if filename in skip_files:
-                    continue
+    Args:
+        user_id: User identifier
+        cursor: Cursor from a previous listing. Defaults to the cursor taken when
+            the latest task started, i.e. only that task's output.
 
-                files.append(filename)
+    Returns:
+        {"cursor": N, "files": [...], "removed": [...]}
+    """
+    if user_id not in microvms:
+        raise HTTPException(404, f"No microVM for {user_id}")
 
-        return {"files": files}
+    index = get_workspace_index(microvms[user_id])
 
+    try:
+        await index.sync()
     except Exception as e:
         raise HTTPException(
-            status_code=500, detail=f"Failed to list workspace files: {str(e)}"
+            status_code=500, detail=f"Failed to sync workspace index: {str(e)}"
         )
 
+    return index.changes_since(index.task_cursor if cursor is None else cursor)
+
 
 @router.get("/download_file")
 async def download_file(user_id: str, filename: str, _: str = Depends(verify_api_key)):
+    bind_log_context(user_id=user_id)
     if user_id not in microvms:
         raise HTTPException(
             status_code=404, detail=f"No microVM found for user {user_id}"
         )
 
     vm = microvms[user_id]
-    vm_ip = vm["ip"]
 
     # Validate filename to prevent path traversal attacks
     if ".." in filename or filename.startswith("/"):
@@ -568,16 +1106,16 @@ async def download_file(user_id: str, filename: str, _: str = Depends(verify_api
             status_code=400, detail="Invalid filename: must be within /workspace"
         )
 
-    print(f"📥 Downloading file {filename} from microVM {user_id} ({vm_ip})")
+    log.info(
+        f"📥 Downloading file {filename} from microVM {user_id} ({guest_address(vm, ENVD_PORT)})"
+    )
 
-    async with httpx.AsyncClient() as http_client:
+    async with guest_client(vm, ENVD_PORT) as http_client:
         try:
-            response = await http_client.get(
-                f"http://{vm_ip}:49983/files", params={"path": full_path}
-            )
+            response = await http_client.get("/files", params={"path": full_path})
 
             if response.status_code == 200:
-                print(f"◉ Downloaded {filename} ({len(response.content)} bytes)")
+                log.info(f"◉ Downloaded {filename} ({len(response.content)} bytes)")
                 return Response(
                     content=response.content, media_type="application/octet-stream"
                 )
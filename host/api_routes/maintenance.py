@@ -4,9 +4,24 @@ from auth import verify_api_key
 import os
 from models import (
     microvms,
+    creating_microvms,
     WORK_DIR,
+    run_in_background,
+)
+from tasks import cleanup_finished_tasks
+from hugepages import hugepage_reservations, release_hugepages
+from ksm import tune_ksm
+from metrics import RECONCILE_ACTIONS
+from boot_prefetch import boot_prefetch_state, prefetch_boot_images
+from workspace_snapshots import (
+    SNAPSHOT_INTERVAL_SECONDS,
+    snapshot_locks,
+    snapshot_workspace,
+    gc_snapshot_chunks,
 )
 import asyncio
+import time
+from log import log
 
 router = APIRouter()
 
@@ -20,18 +35,26 @@ async def maintenance(_: str = Depends(verify_api_key)):
     - TAP devices not in our tracking dict
     - Firecracker processes not in our tracking dict
     - VM directories without active VMs
+    - Finished task output past its retention period
+    - Workspace snapshot chunks no snapshot uses any more
+    - Hugepage reservations of VMs that are gone
+
+    Also starts periodic workspace snapshots of running VMs, retunes ksmd's
+    scan rate to the current load, traces the boot of rebuilt images and reads
+    boot blocks that fell out of the page cache back in.
     """
     try:
-        print("🧹 Running orphan cleanup...")
+        log.info("🧹 Running orphan cleanup...")
 
         # Get list of tracked TAP devices and IPs
         tracked_taps = set()
         tracked_pids = set()
         tracked_ips = set()
         for user_id, vm in microvms.items():
-            tracked_taps.add(vm["tap_device"])  # Use actual tap_device name!
             tracked_pids.add(vm["process"].pid)
-            tracked_ips.add(vm["ip"])
+            if vm["tap_device"]:  # vsock VMs without networking have none
+                tracked_taps.add(vm["tap_device"])  # Use actual tap_device name!
+                tracked_ips.add(vm["ip"])
 
         # Find and delete orphaned routes (must be done before TAP deletion)
         try:
@@ -48,19 +71,22 @@ async def maintenance(_: str = Depends(verify_api_key)):
                         route_ip_clean = route_ip.replace("/32", "")
 
                         if route_ip_clean not in tracked_ips:
-                            print(f"  Found orphaned route: {route_ip}")
+                            log.info(f"  Found orphaned route: {route_ip}")
                             try:
                                 subprocess.run(
                                     ["sudo", "ip", "route", "del", route_ip],
                                     timeout=5,
                                     check=False,
                                 )
-                                print(f"  ✓ Deleted orphaned route: {route_ip}")
+                                log.info(f"  ✓ Deleted orphaned route: {route_ip}")
+                                RECONCILE_ACTIONS.inc(action="delete_route")
                             except Exception as e:
-                                print(f"  ⚠️ Failed to delete route {route_ip}: {e}")
+                                log.warning(
+                                    f"  ⚠️ Failed to delete route {route_ip}: {e}"
+                                )
 
         except Exception as e:
-            print(f"  ⚠️ Route cleanup error: {e}")
+            log.warning(f"  ⚠️ Route cleanup error: {e}")
 
         # Find and delete orphaned TAP devices
         try:
@@ -74,19 +100,20 @@ async def maintenance(_: str = Depends(verify_api_key)):
                     if len(parts) >= 2:
                         tap_name = parts[1].rstrip(":")
                         if tap_name.startswith("tap-") and tap_name not in tracked_taps:
-                            print(f"  Found orphaned TAP device: {tap_name}")
+                            log.info(f"  Found orphaned TAP device: {tap_name}")
                             try:
                                 subprocess.run(
                                     ["sudo", "ip", "link", "delete", tap_name],
                                     timeout=5,
                                     check=False,
                                 )
-                                print(f"  ✓ Deleted orphaned TAP device: {tap_name}")
+                                log.info(f"  ✓ Deleted orphaned TAP device: {tap_name}")
+                                RECONCILE_ACTIONS.inc(action="delete_tap")
                             except Exception as e:
-                                print(f"  ⚠️ Failed to delete {tap_name}: {e}")
+                                log.warning(f"  ⚠️ Failed to delete {tap_name}: {e}")
 
         except Exception as e:
-            print(f"  ⚠️ TAP cleanup error: {e}")
+            log.warning(f"  ⚠️ TAP cleanup error: {e}")
 
         # Find and kill orphaned Firecracker processes
         try:
@@ -102,22 +129,23 @@ async def maintenance(_: str = Depends(verify_api_key)):
                     try:
                         pid = int(pid_str)
                         if pid not in tracked_pids:
-                            print(f"  Found orphaned Firecracker process: PID {pid}")
+                            log.info(f"  Found orphaned Firecracker process: PID {pid}")
                             subprocess.run(
                                 ["sudo", "kill", "-9", str(pid)],
                                 timeout=5,
                                 check=False,
                             )
-                            print(f"  ✓ Killed orphaned process: PID {pid}")
+                            log.info(f"  ✓ Killed orphaned process: PID {pid}")
+                            RECONCILE_ACTIONS.inc(action="kill_process")
                     except ValueError:
                         pass
                     except Exception as e:
-                        print(f"  ⚠️ Failed to kill PID {pid_str}: {e}")
+                        log.warning(f"  ⚠️ Failed to kill PID {pid_str}: {e}")
 
         except subprocess.CalledProcessError:
             pass  # No firecracker processes found
         except Exception as e:
-            print(f"  ⚠️ Process cleanup error: {e}")
+            log.warning(f"  ⚠️ Process cleanup error: {e}")
 
         # Clean up orphaned VM directories
         try:
@@ -127,21 +155,88 @@ async def maintenance(_: str = Depends(verify_api_key)):
                 for user_dir in os.listdir(WORK_DIR):
                     if user_dir not in tracked_users:
                         orphaned_dir = os.path.join(WORK_DIR, user_dir)
-                        print(f"  Found orphaned VM directory: {orphaned_dir}")
+                        log.info(f"  Found orphaned VM directory: {orphaned_dir}")
                         try:
                             import shutil
 
                             shutil.rmtree(orphaned_dir)
-                            print(f"  ✓ Deleted orphaned directory: {orphaned_dir}")
+                            log.info(f"  ✓ Deleted orphaned directory: {orphaned_dir}")
+                            RECONCILE_ACTIONS.inc(action="delete_vm_dir")
                         except Exception as e:
-                            print(f"  ⚠️ Failed to delete {orphaned_dir}: {e}")
+                            log.warning(f"  ⚠️ Failed to delete {orphaned_dir}: {e}")
+
+        except Exception as e:
+            log.warning(f"  ⚠️ Directory cleanup error: {e}")
+
+        # Hugepages promised to VMs that never started or were lost
+        try:
+            for user_id in list(hugepage_reservations):
+                if user_id not in microvms and user_id not in creating_microvms:
+                    release_hugepages(user_id)
+                    log.info(f"  ✓ Released hugepages of {user_id}")
+                    RECONCILE_ACTIONS.inc(action="release_hugepages")
+        except Exception as e:
+            log.warning(f"  ⚠️ Hugepage cleanup error: {e}")
 
+        try:
+            await asyncio.to_thread(tune_ksm)
+        except Exception as e:
+            log.warning(f"  ⚠️ KSM tuning error: {e}")
+
+        # Boot prefetch, in the background so cron isn't held up
+        try:
+            if not boot_prefetch_state["recording"]:
+                run_in_background(prefetch_in_background())
+        except Exception as e:
+            log.warning(f"  ⚠️ Boot prefetch error: {e}")
+
+        # Drop expired task output
+        try:
+            expired = cleanup_finished_tasks()
+            if expired:
+                log.info(f"  ✓ Dropped output of {expired} expired tasks")
+                RECONCILE_ACTIONS.inc(expired, action="drop_task_output")
         except Exception as e:
-            print(f"  ⚠️ Directory cleanup error: {e}")
+            log.warning(f"  ⚠️ Task output cleanup error: {e}")
 
-        print("✅ Orphan cleanup complete")
+        # Periodic workspace snapshots, in the background so cron isn't held up
+        try:
+            now = time.time()
+            for user_id, vm in microvms.items():
+                last = vm.get("last_snapshot_at") or vm.get("created_at", now)
+                lock = snapshot_locks.get(user_id)
+                if now - last > SNAPSHOT_INTERVAL_SECONDS and not (
+                    lock and lock.locked()
+                ):
+                    run_in_background(snapshot_in_background(vm, user_id))
+        except Exception as e:
+            log.warning(f"  ⚠️ Workspace snapshot error: {e}")
+
+        try:
+            removed = await asyncio.to_thread(gc_snapshot_chunks)
+            if removed:
+                log.info(f"  ✓ Deleted {removed} unused snapshot chunks")
+                RECONCILE_ACTIONS.inc(removed, action="delete_snapshot_chunk")
+        except Exception as e:
+            log.warning(f"  ⚠️ Snapshot chunk cleanup error: {e}")
+
+        log.info("✅ Orphan cleanup complete")
         return {"status": "success", "message": "Orphan cleanup completed"}
 
     except Exception as e:
-        print(f"❌ Cleanup task error: {e}")
+        log.error(f"❌ Cleanup task error: {e}")
         return {"status": "error", "message": str(e)}
+
+
+async def snapshot_in_background(vm: dict, user_id: str):
+    try:
+        await snapshot_workspace(vm, user_id)
+    except Exception as e:
+        log.warning(f"⚠️ Periodic snapshot of {user_id}'s workspace failed: {e}")
+
+
+async def prefetch_in_background():
+    try:
+        await asyncio.to_thread(prefetch_boot_images)
+    except Exception as e:
+        log.warning(f"⚠️ Boot prefetch failed: {e}")
@@ -1,11 +1,23 @@
-from fastapi import FastAPI
+import asyncio
+from fastapi import FastAPI, Depends
+from fastapi.responses import PlainTextResponse
 from dotenv import load_dotenv
 from api_routes import execute_routes, admin_routes, maintenance
 from models import (
     microvms,
+    background_tasks,
+    run_in_background,
 )
+from boot_prefetch import prefetch_boot_images
+from metrics import render_metrics
+from vm_telemetry import telemetry_loop
+from ksm import ksm_support
+from loop_monitor import loop_monitor
+from auth import verify_api_key
+from log import setup_logging
 
 load_dotenv()
+setup_logging("firecracker-host")
 
 app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
 
@@ -15,12 +27,37 @@ app.include_router(admin_routes.router)
 app.include_router(maintenance.router)
 
 
+@app.on_event("startup")
+async def startup():
+    # Warm the page cache with the images' boot blocks, without delaying startup
+    run_in_background(asyncio.to_thread(prefetch_boot_images))
+    run_in_background(telemetry_loop())
+    run_in_background(loop_monitor())
+    ksm_support()  # Probe once, logs when ksm VMs can't work here
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Background loops run forever, stop them along with anything still pending
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+
 @app.get("/health")
 async def health():
     """Health check"""
     return {"status": "healthy", "active_microvms": len(microvms)}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(_: str = Depends(verify_api_key)):
+    """Prometheus metrics: boot phase latency, tasks, streams, uploads, cleanup, loop lag"""
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
 
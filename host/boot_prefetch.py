@@ -0,0 +1,316 @@
+"""
+Boot-time block tracing and page cache prefetch for the base rootfs images.
+
+A cold boot reads scattered blocks of the runtime image (through qemu-nbd for
+overlay VMs, directly for shared ones), which on a cold host page cache is
+random IO. A trace records which parts of the image one boot reads: the image
+is dropped from the page cache, a throwaway VM boots until its agent server is
+ready, and what is then resident in the cache (mincore) is what the boot read,
+kernel readahead included.
+
+The host replays traces as sequential reads at startup and from /maintenance
+whenever a traced part of the image has fallen out of the cache. A trace is
+tied to the image's size and mtime; the trace of a rebuilt image is stale and
+isn't replayed until POST /boot_trace records it again, since tracing boots a
+VM and evicts the image under the running ones.
+"""
+
+import asyncio
+import ctypes
+import json
+import os
+import re
+import time
+from typing import Optional
+from models import microvms, BOOT_TRACES_DIR, KERNEL_PATH, ROOTFS_IMAGES
+from log import log
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Traced ranges closer than this are read as one, small gaps are cheaper to
+# read than to seek over
+PREFETCH_MERGE_GAP = 256 * 1024
+PREFETCH_READ_BYTES = 1024 * 1024
+
+# Images whose traced blocks are at least this resident aren't read again
+PREFETCH_RESIDENT_RATIO = 0.9
+
+PROT_READ, MAP_SHARED = 0x1, 0x01
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_size_t,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_long,
+]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+
+# Last prefetch and trace recording per runtime
+boot_prefetch_state = {
+    "recording": None,  # Runtime being traced
+    "runtimes": {},  # {runtime: {"prefetched_at", "bytes", "seconds", ...}}
+}
+
+
+def _trace_path(runtime: str) -> str:
+    return f"{BOOT_TRACES_DIR}/{runtime}.json"
+
+
+def image_identity(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def resident_pages(path: str) -> bytes:
+    """One byte per page of the file, odd when the page is in the page cache"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return b""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr == MAP_FAILED:
+            raise OSError(ctypes.get_errno(), f"mmap {path} failed")
+        try:
+            pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+            vec = (ctypes.c_ubyte * pages)()
+            if libc.mincore(addr, size, vec):
+                raise OSError(ctypes.get_errno(), f"mincore {path} failed")
+            return bytes(vec)
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+def resident_extents(path: str) -> list[list[int]]:
+    """[offset, length] of the file's cached ranges"""
+    pages = resident_pages(path).translate(bytes([0] + [1] * 255))
+    return [
+        [match.start() * PAGE_SIZE, (match.end() - match.start()) * PAGE_SIZE]
+        for match in re.finditer(rb"\x01+", pages)
+    ]
+
+
+def evict(path: str):
+    """Drop a file's clean pages from the page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def merge_extents(extents: list[list[int]], gap: int = 0) -> list[list[int]]:
+    merged = []
+    for offset, length in sorted(extents):
+        if merged and offset <= merged[-1][0] + merged[-1][1] + gap:
+            end = max(merged[-1][0] + merged[-1][1], offset + length)
+            merged[-1][1] = end - merged[-1][0]
+        else:
+            merged.append([offset, length])
+    return merged
+
+
+def load_trace(runtime: str) -> Optional[dict]:
+    try:
+        with open(_trace_path(runtime)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def trace_matches(trace: dict, image: str) -> bool:
+    """Whether the trace was recorded on this build of the image"""
+    return trace.get("image") == image and trace.get("identity") == image_identity(
+        image
+    )
+
+
+def save_trace(runtime: str, extents: list[list[int]], boot: dict) -> dict:
+    """Store a boot's trace, merged with earlier boots of the same image"""
+    image = ROOTFS_IMAGES[runtime]
+    trace = load_trace(runtime)
+    if not trace or not trace_matches(trace, image):
+        trace = {"image": image, "identity": image_identity(image), "boots": []}
+        previous = []
+    else:
+        previous = trace["extents"]
+
+    trace["extents"] = merge_extents(previous + extents)
+    trace["bytes"] = sum(length for _, length in trace["extents"])
+    trace["boots"].append(boot)
+
+    os.makedirs(BOOT_TRACES_DIR, exist_ok=True)
+    path = _trace_path(runtime)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(trace, f)
+    os.replace(f"{path}.tmp", path)
+    return trace
+
+
+def read_extents(path: str, extents: list[list[int]]) -> int:
+    """Read ranges of a file in offset order, returns the bytes read"""
+    buffer = bytearray(PREFETCH_READ_BYTES)
+    total = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                view = memoryview(buffer)[: min(PREFETCH_READ_BYTES, end - offset)]
+                read = os.preadv(fd, [view], offset)
+                if read <= 0:
+                    break
+                offset += read
+                total += read
+    finally:
+        os.close(fd)
+    return total
+
+
+def resident_ratio(path: str, extents: list[list[int]]) -> float:
+    pages = resident_pages(path)
+    traced = cached = 0
+    for offset, length in extents:
+        chunk = pages[offset // PAGE_SIZE : (offset + length) // PAGE_SIZE]
+        traced += len(chunk)
+        cached += len(chunk) - chunk.translate(bytes([0] + [1] * 255)).count(0)
+    return cached / traced if traced else 1.0
+
+
+def prefetch_image(runtime: str, force: bool = False) -> dict:
+    """Replay a runtime's boot trace into the page cache"""
+    image = ROOTFS_IMAGES[runtime]
+    trace = load_trace(runtime)
+    if trace is None:
+        return {"status": "no_trace"}
+    if not os.path.exists(image) or not trace_matches(trace, image):
+        return {"status": "stale_trace"}
+
+    extents = merge_extents(trace["extents"], PREFETCH_MERGE_GAP)
+    ratio = resident_ratio(image, extents)
+    if ratio >= PREFETCH_RESIDENT_RATIO and not force:
+        return {"status": "resident", "resident_ratio": round(ratio, 3)}
+
+    start = time.time()
+    read = read_extents(image, extents)
+    if os.path.exists(KERNEL_PATH):
+        read += read_extents(KERNEL_PATH, [[0, os.path.getsize(KERNEL_PATH)]])
+
+    result = {
+        "status": "prefetched",
+        "prefetched_at": time.time(),
+        "bytes": read,
+        "extents": len(extents),
+        "seconds": round(time.time() - start, 3),
+        "resident_ratio_before": round(ratio, 3),
+    }
+    boot_prefetch_state["runtimes"][runtime] = result
+    log.info(
+        f"🔥 Prefetched {read // (1024 * 1024)}MB of {runtime}'s boot blocks "
+        f"({len(extents)} ranges, {result['seconds']}s)"
+    )
+    return result
+
+
+def prefetch_boot_images() -> dict:
+    results = {}
+    for runtime in ROOTFS_IMAGES:
+        try:
+            results[runtime] = prefetch_image(runtime)
+            if results[runtime]["status"] == "stale_trace":
+                log.warning(
+                    f"⚠️ {runtime}'s image changed since its boot trace, "
+                    "POST /boot_trace to trace it again"
+                )
+        except Exception as e:
+            log.warning(f"⚠️ Boot prefetch of {runtime} failed: {e}")
+            results[runtime] = {"status": "error", "error": str(e)}
+    return results
+
+
+async def record_boot_trace(
+    runtime: str,
+    guest_init: str = "systemd",
+    rootfs_mode: str = "overlay",
+    env_vars: dict = {},
+) -> dict:
+    """
+    Boot a throwaway VM on a cold image and record what it read until ready.
+
+    Other VMs reading the image at the same time end up in the trace too, so
+    record on a quiet host.
+    """
+    # Routes import this module
+    from api_routes.execute_routes import create_microvm
+    from api_routes.admin_routes import kill_microvm
+    from models import CreateMicroVMRequest, KillMicroVMRequest
+
+    if boot_prefetch_state["recording"]:
+        raise RuntimeError(f"Already tracing {boot_prefetch_state['recording']}")
+
+    image = ROOTFS_IMAGES[runtime]
+    user_id = f"boot-trace-{runtime}"
+    boot_prefetch_state["recording"] = runtime
+    try:
+        await asyncio.to_thread(evict, image)
+        start = time.time()
+        await create_microvm(
+            CreateMicroVMRequest(
+                user_id=user_id,
+                runtime=runtime,
+                env_vars=env_vars,
+                rootfs_mode=rootfs_mode,
+                guest_init=guest_init,
+                package_cache=False,
+                restore_workspace=False,
+            ),
+            _=None,
+        )
+        ready_seconds = round(time.time() - start, 3)
+        extents = await asyncio.to_thread(resident_extents, image)
+    finally:
+        if user_id in microvms:
+            try:
+                await kill_microvm(
+                    KillMicroVMRequest(user_id=user_id), snapshot=False, _=None
+                )
+            except Exception as e:
+                log.warning(f"⚠️ Failed to remove boot trace VM: {e}")
+        boot_prefetch_state["recording"] = None
+
+    boot = {
+        "recorded_at": time.time(),
+        "guest_init": guest_init,
+        "rootfs_mode": rootfs_mode,
+        "ready_seconds": ready_seconds,
+        "bytes": sum(length for _, length in extents),
+    }
+    trace = await asyncio.to_thread(save_trace, runtime, extents, boot)
+    log.info(
+        f"🧭 Traced {runtime}'s boot: {boot['bytes'] // (1024 * 1024)}MB read in "
+        f"{len(extents)} ranges, ready after {ready_seconds}s"
+    )
+    return {**boot, "trace_bytes": trace["bytes"], "boots": len(trace["boots"])}
+
+
+def boot_prefetch_info() -> dict:
+    traces = {}
+    for runtime, image in ROOTFS_IMAGES.items():
+        trace = load_trace(runtime)
+        traces[runtime] = trace and {
+            "bytes": trace["bytes"],
+            "extents": len(trace["extents"]),
+            "boots": trace["boots"],
+            "current": os.path.exists(image) and trace_matches(trace, image),
+        }
+    return {"traces": traces, **boot_prefetch_state}
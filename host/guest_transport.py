@@ -0,0 +1,97 @@
+"""
+How the host reaches envd and the claude FastAPI server inside a microVM.
+
+By default over the VM's TAP network at {ip}:{port}. VMs created with
+transport="vsock" are reached over Firecracker's virtio-vsock instead: the host
+connects to the VM's vsock Unix socket and sends "CONNECT <port>\n", after which
+the connection is a plain byte stream to that port in the guest (bridged to the
+local TCP servers by the vsock-bridge@ units in the image).
+"""
+
+import httpcore
+import httpx
+from connectrpc.client import ConnectClient
+from typing import Optional
+
+ENVD_PORT = 49983
+FASTAPI_PORT = 49999
+
+# Every VM has its own vsock device, so all guests can use the same CID
+VSOCK_GUEST_CID = 3
+
+
+class VsockBackend(httpcore.AsyncNetworkBackend):
+    """Dials a guest port through a Firecracker vsock Unix socket"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(
+        self, host, port, timeout=None, local_address=None, socket_options=None
+    ):
+        raise httpcore.ConnectError(
+            "vsock VMs are only reachable through their vsock socket"
+        )
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        stream = await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+        await stream.write(f"CONNECT {self.port}\n".encode(), timeout)
+
+        # Firecracker answers "OK <host port>\n", read it byte by byte so no
+        # response bytes get swallowed
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = await stream.read(1, timeout)
+            if not data:
+                break
+            reply += data
+
+        if not reply.startswith(b"OK "):
+            await stream.aclose()
+            raise httpcore.ConnectError(
+                f"vsock connect to guest port {self.port} failed: {reply!r}"
+            )
+
+        return stream
+
+    async def sleep(self, seconds: float):
+        await self.backend.sleep(seconds)
+
+
+class VsockTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, uds_path: str, port: int):
+        super().__init__()
+        # httpx has no network_backend option, swap in a pool that dials via vsock
+        self._pool = httpcore.AsyncConnectionPool(
+            uds=uds_path, network_backend=VsockBackend(port)
+        )
+
+
+def guest_address(vm: dict, port: int) -> str:
+    """host:port of a guest server, for URLs and log lines"""
+    if vm.get("vsock_path"):
+        return f"vsock:{port}"
+    return f"{vm['ip']}:{port}"
+
+
+def guest_client(vm: dict, port: int, **kwargs) -> httpx.AsyncClient:
+    """httpx client for a guest server; request paths are relative to it"""
+    transport: Optional[httpx.AsyncBaseTransport] = None
+    if vm.get("vsock_path"):
+        transport = VsockTransport(vm["vsock_path"], port)
+
+    return httpx.AsyncClient(
+        base_url=f"http://{guest_address(vm, port)}", transport=transport, **kwargs
+    )
+
+
+def guest_rpc_client(vm: dict) -> ConnectClient:
+    """Connect RPC client for the VM's envd"""
+    address = f"http://{guest_address(vm, ENVD_PORT)}"
+    if vm.get("vsock_path"):
+        # Same timeouts ConnectClient gives its own session
+        session = guest_client(vm, ENVD_PORT, timeout=httpx.Timeout(None, connect=30.0))
+        return ConnectClient(address, session=session)
+    return ConnectClient(address)
@@ -0,0 +1,95 @@
+"""
+Host pool of 2 MiB hugepages for VMs whose guest memory is hugepage-backed.
+
+Firecracker (machine-config huge_pages="2M") takes guest memory from the
+kernel's hugetlb pool, it can't fall back to 4K pages. A VM that runs out of
+hugepages dies, so the host keeps its own books: the pool is reserved up front
+(HUGEPAGE_POOL_MIB, the kernel may hand out fewer pages on a fragmented host)
+and a hugepage VM is only admitted when all its memory fits into the pages not
+yet promised to other VMs. The pool is meant for the VMs alone.
+"""
+
+import asyncio
+import os
+import subprocess
+from typing import Dict
+from log import log
+
+HUGEPAGE_SIZE_MIB = 2
+HUGEPAGES_SYSFS = "/sys/kernel/mm/hugepages/hugepages-2048kB"
+
+# Pool reserved for hugepage VMs, 0 = reserve nothing until /hugepage_pool
+HUGEPAGE_POOL_MIB = int(os.getenv("HUGEPAGE_POOL_MIB", "0"))
+
+# Pages promised to hugepage VMs: {user_id: pages}
+hugepage_reservations: Dict[str, int] = {}
+
+
+def _read_counter(name: str) -> int:
+    try:
+        with open(f"{HUGEPAGES_SYSFS}/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def hugepages_for(mem_size_mib: int) -> int:
+    return -(-mem_size_mib // HUGEPAGE_SIZE_MIB)
+
+
+def hugepage_pool_info() -> dict:
+    total = _read_counter("nr_hugepages")
+    reserved = sum(hugepage_reservations.values())
+    return {
+        "page_size_mib": HUGEPAGE_SIZE_MIB,
+        "target_pages": hugepages_for(HUGEPAGE_POOL_MIB),
+        "total_pages": total,
+        "free_pages": _read_counter("free_hugepages"),  # Not faulted in by anyone
+        "reserved_pages": reserved,  # Promised to running VMs
+        "available_pages": max(total - reserved, 0),
+        "vms": len(hugepage_reservations),
+    }
+
+
+def set_hugepage_pool(pages: int) -> int:
+    """Ask the kernel for a pool of this many pages, returns what it gave us"""
+    subprocess.run(
+        ["sudo", "tee", f"{HUGEPAGES_SYSFS}/nr_hugepages"],
+        input=str(pages),
+        text=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=30,
+        check=False,
+    )
+    total = _read_counter("nr_hugepages")
+    if total < pages:
+        log.warning(f"⚠️ Hugepage pool: asked for {pages} pages, kernel gave {total}")
+    else:
+        log.info(f"🧱 Hugepage pool resized to {total} pages")
+    return total
+
+
+def ensure_hugepage_pool():
+    """Grow the pool up to HUGEPAGE_POOL_MIB if it is smaller (e.g. after a reboot)"""
+    target = hugepages_for(HUGEPAGE_POOL_MIB)
+    if _read_counter("nr_hugepages") < target:
+        set_hugepage_pool(target)
+
+
+async def reserve_hugepages(user_id: str, mem_size_mib: int) -> bool:
+    """Promise a VM's memory worth of pages, False when the pool can't cover it"""
+    await asyncio.to_thread(ensure_hugepage_pool)
+
+    # Checked and booked without awaiting in between, so two VMs can't both
+    # get the last pages
+    pages = hugepages_for(mem_size_mib)
+    if hugepage_pool_info()["available_pages"] < pages:
+        return False
+
+    hugepage_reservations[user_id] = pages
+    return True
+
+
+def release_hugepages(user_id: str):
+    hugepage_reservations.pop(user_id, None)
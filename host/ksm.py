@@ -0,0 +1,202 @@
+"""
+Kernel same-page merging (KSM) for density-mode VMs.
+
+All VMs boot the same kernel and image and run the same Python/Node/Claude CLI
+stack, so much of their guest memory is identical. Firecracker for a ksm VM is
+started with prctl(PR_SET_MEMORY_MERGE) (kept across exec since Linux 6.7), which
+makes its guest memory mergeable, and ksmd folds identical pages into one
+copy-on-write page. Hosts without it are detected once and refuse ksm VMs.
+
+ksmd's scan rate is tuned to the mergeable memory on the host: roughly all of it
+per KSM_FULL_SCAN_SECONDS, half as fast while the host is busy, and off when no
+ksm VMs are left. Hugepage memory (hugetlb) is never merged.
+"""
+
+import ctypes
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Optional
+from models import microvms
+from log import log
+
+KSM_SYSFS = "/sys/kernel/mm/ksm"
+PR_SET_MEMORY_MERGE = 67
+PR_GET_MEMORY_MERGE = 68
+
+# PR_SET_MEMORY_MERGE exists since 6.4, but is only kept across exec since 6.7
+MERGE_ACROSS_EXEC_KERNEL = (6, 7)
+
+# Firecracker for ksm VMs is started through this: it marks the process
+# mergeable and execs Firecracker (preexec_fn isn't safe in a threaded process)
+MERGEABLE_EXEC = f"""
+import ctypes, os, sys
+libc = ctypes.CDLL(None, use_errno=True)
+if libc.prctl({PR_SET_MEMORY_MERGE}, 1, 0, 0, 0) != 0:
+    sys.exit(f"PR_SET_MEMORY_MERGE failed: {{os.strerror(ctypes.get_errno())}}")
+os.execv(sys.argv[1], sys.argv[1:])
+"""
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# ksmd wakes up every KSM_SLEEP_MS and scans pages_to_scan pages
+KSM_SLEEP_MS = 20
+KSM_MIN_PAGES_TO_SCAN = 100
+KSM_MAX_PAGES_TO_SCAN = 5000
+
+# Aim to scan all mergeable memory once in this time
+KSM_FULL_SCAN_SECONDS = 300
+
+# 1-minute load average per CPU above which ksmd is slowed down
+KSM_BUSY_LOAD = 0.8
+
+ksm_state = {
+    "support": None,  # "supported" or why not, probed once
+    "tuned_at": None,
+    "pages_to_scan": None,
+    "busy": False,
+}
+
+
+def ksm_available() -> bool:
+    return os.path.exists(f"{KSM_SYSFS}/run")
+
+
+def _probe_support() -> str:
+    if not ksm_available():
+        return f"unsupported: no {KSM_SYSFS} (kernel without KSM)"
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_GET_MEMORY_MERGE, 0, 0, 0, 0) < 0:
+        error = os.strerror(ctypes.get_errno())
+        return f"unsupported: no PR_SET_MEMORY_MERGE ({error}), needs Linux 6.4+"
+
+    release = os.uname().release
+    version = tuple(int(part) for part in re.findall(r"\d+", release)[:2])
+    if version < MERGE_ACROSS_EXEC_KERNEL:
+        return f"unsupported: Linux {release} drops PR_SET_MEMORY_MERGE at exec, needs 6.7+"
+
+    return "supported"
+
+
+def ksm_support() -> str:
+    """ "supported", or why ksm VMs wouldn't get any memory merged on this host"""
+    if ksm_state["support"] is None:
+        ksm_state["support"] = _probe_support()
+        if ksm_state["support"] != "supported":
+            log.warning(f"⚠️ KSM density mode {ksm_state['support']}")
+    return ksm_state["support"]
+
+
+def mergeable_command(args: list[str]) -> list[str]:
+    """Command that runs args with the process's memory marked mergeable"""
+    return [sys.executable, "-I", "-S", "-c", MERGEABLE_EXEC, *args]
+
+
+def _read_counter(name: str) -> Optional[int]:
+    try:
+        with open(f"{KSM_SYSFS}/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_knob(name: str, value: int):
+    subprocess.run(
+        ["sudo", "tee", f"{KSM_SYSFS}/{name}"],
+        input=str(value),
+        text=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=5,
+        check=False,
+    )
+
+
+def ksm_info() -> dict:
+    """Host-wide KSM counters, pages_sharing is what merging saves"""
+    if not ksm_available():
+        return {"available": False, "support": ksm_support()}
+
+    counters = {
+        name: _read_counter(name)
+        for name in (
+            "run",
+            "pages_to_scan",
+            "sleep_millisecs",
+            "pages_shared",
+            "pages_sharing",
+            "pages_unshared",
+            "pages_volatile",
+            "full_scans",
+            "general_profit",
+        )
+    }
+    return {
+        "available": True,
+        **counters,
+        "saved_mib": (counters["pages_sharing"] or 0) * PAGE_SIZE // (1024 * 1024),
+        **ksm_state,
+    }
+
+
+def vm_ksm_info(pid: int) -> Optional[dict]:
+    """Merged pages of one Firecracker process (/proc/<pid>/ksm_stat)"""
+    try:
+        with open(f"/proc/{pid}/ksm_stat") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    stat = {}
+    for line in lines:
+        key, _, value = line.partition(" ")
+        if value.strip().isdigit():
+            stat[key] = int(value)
+
+    merging = stat.get("ksm_merging_pages", 0)
+    return {
+        "merging_pages": merging,
+        "saved_mib": merging * PAGE_SIZE // (1024 * 1024),
+        "profit_bytes": stat.get("ksm_process_profit"),
+    }
+
+
+def mergeable_mib() -> int:
+    return sum(vm["mem_size_mib"] for vm in microvms.values() if vm.get("ksm"))
+
+
+def tune_ksm():
+    """Set ksmd's scan rate for the running ksm VMs' memory, stop it when there are none"""
+    if ksm_support() != "supported":
+        return
+
+    mergeable = mergeable_mib()
+
+    if mergeable == 0:
+        if _read_counter("run") == 1:
+            _write_knob("run", 0)
+            log.info("💤 No ksm VMs left, stopped ksmd")
+        ksm_state.update(tuned_at=time.time(), pages_to_scan=None, busy=False)
+        return
+
+    wakeups = KSM_FULL_SCAN_SECONDS * 1000 // KSM_SLEEP_MS
+    pages = mergeable * 1024 * 1024 // PAGE_SIZE // wakeups
+
+    busy = os.getloadavg()[0] / (os.cpu_count() or 1) > KSM_BUSY_LOAD
+    if busy:
+        pages //= 2
+
+    pages = max(KSM_MIN_PAGES_TO_SCAN, min(pages, KSM_MAX_PAGES_TO_SCAN))
+
+    if _read_counter("pages_to_scan") != pages:
+        _write_knob("pages_to_scan", pages)
+    if _read_counter("sleep_millisecs") != KSM_SLEEP_MS:
+        _write_knob("sleep_millisecs", KSM_SLEEP_MS)
+    if _read_counter("run") != 1:
+        _write_knob("run", 1)
+        log.info(f"🔗 Started ksmd ({pages} pages every {KSM_SLEEP_MS}ms)")
+
+    ksm_state.update(tuned_at=time.time(), pages_to_scan=pages, busy=busy)
@@ -0,0 +1,149 @@
+"""
+Leveled, structured logging that never blocks the event loop.
+
+Records go into a bounded in-memory queue and a writer thread prints them, so a
+slow stdout/journald only ever stalls that thread. When the queue is full new
+records are dropped and counted instead of waiting. LOG_LEVEL sets the level
+(DEBUG shows the step-by-step timings), LOG_FORMAT "text" or "json" the output.
+
+Context fields (user_id, vm_ip, task_id, ...) bound with bind_log_context are
+added to every record logged from the same request or asyncio task, and the
+tasks it starts. Polling loops log with extra={"sample": key}: one record per
+key every LOG_SAMPLE_SECONDS gets through, with the number skipped.
+
+The guest agent server ships this same file: each app calls setup_logging with
+its name once at startup, and its modules log through `log`.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_SECONDS = 5.0
+
+# Configured by setup_logging
+log = logging.getLogger("app")
+
+log_context: contextvars.ContextVar[dict] = contextvars.ContextVar(
+    "log_context", default={}
+)
+
+
+def bind_log_context(**fields):
+    """Add fields to the records of the current request/task (and tasks it starts)"""
+    log_context.set({**log_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.fields = {**log_context.get(), **getattr(record, "fields", {})}
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Let one record per sample key through every LOG_SAMPLE_SECONDS"""
+
+    def __init__(self):
+        super().__init__()
+        self.last: dict = {}  # key -> (emitted at, skipped since)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        emitted_at, skipped = self.last.get(key, (0.0, 0))
+        if now - emitted_at < LOG_SAMPLE_SECONDS:
+            self.last[key] = (emitted_at, skipped + 1)
+            return False
+
+        self.last[key] = (now, 0)
+        if skipped:
+            record.fields = {**getattr(record, "fields", {}), "skipped": skipped}
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0  # Since the last record that got through
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # emit() runs under the handler's lock
+        record = super().prepare(record)
+        if self.dropped:
+            record.fields = {
+                **getattr(record, "fields", {}),
+                "log_dropped": self.dropped,
+            }
+            self.dropped = 0
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = record.getMessage()
+        if record.levelno != logging.INFO:
+            line = f"{record.levelname} {line}"
+        fields = getattr(record, "fields", {})
+        if fields:
+            line += " | " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": self.name,
+            "msg": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(name: str) -> logging.Logger:
+    """Send log's records through the queue to stdout, as the app name"""
+    if log.handlers:
+        return log
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(
+        JsonFormatter(name) if LOG_FORMAT == "json" else TextFormatter()
+    )
+
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SampleFilter())
+    handler.addFilter(ContextFilter())
+    log.addHandler(handler)
+
+    # Writer thread; stopping it at exit flushes what is still queued
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    atexit.register(listener.stop)
+    return log
@@ -0,0 +1,146 @@
+"""
+Event loop lag monitor, for catching blocking calls in async handlers.
+
+A coroutine wakes up every LOOP_LAG_INTERVAL_SECONDS and records how late it
+woke up: that is how long everything else on the loop had to wait, streams
+included. A watchdog thread notices when the loop hasn't come back after
+LOOP_STALL_SECONDS and takes the loop thread's stack while it is still stuck,
+so the stall is attributed to the code blocking it (a subprocess.run, a file
+copy, ...) rather than to whatever runs next.
+
+Lag and stalls go to /metrics; each stall is logged at debug level with the
+handler that caused it and its stack.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from metrics import Counter, Histogram, register
+from log import log
+
+# 0 disables the monitor
+LOOP_STALL_SECONDS = float(os.getenv("LOOP_STALL_SECONDS", "0.1"))
+LOOP_LAG_INTERVAL_SECONDS = 0.05
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Stalls are attributed to the frames of the host's own code
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROUTES_DIR = f"{HOST_DIR}/api_routes"
+MONITOR_FILE = os.path.abspath(__file__)
+
+LOOP_LAG_SECONDS = register(
+    Histogram(
+        "event_loop_lag_seconds",
+        "How late the event loop ran a callback due every "
+        f"{LOOP_LAG_INTERVAL_SECONDS:g}s",
+        LAG_BUCKETS,
+    )
+)
+LOOP_STALLS = register(
+    Counter(
+        "event_loop_stalls_total",
+        "Times the event loop was blocked longer than LOOP_STALL_SECONDS, by handler",
+    )
+)
+LOOP_STALL_SECONDS_TOTAL = register(
+    Counter(
+        "event_loop_stall_seconds_total",
+        "Time the event loop was blocked in stalls, by handler",
+    )
+)
+
+# The last tick of the loop and the stack the watchdog took while it was late
+loop_monitor_state = {"tick": None, "stall": None}
+
+
+def attribute(frame) -> dict:
+    """The route handler (or outermost host function) and host code a frame is in"""
+    host_frames = []
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(HOST_DIR) and filename != MONITOR_FILE:
+            host_frames.append(frame)
+        frame = frame.f_back
+
+    if not host_frames:
+        return {"handler": "unknown", "site": "unknown"}
+
+    # host_frames is innermost first
+    routes = [
+        f
+        for f in host_frames
+        if os.path.abspath(f.f_code.co_filename).startswith(ROUTES_DIR)
+    ]
+    handler = (routes or host_frames)[-1]
+    site = host_frames[0]
+    return {
+        "handler": _frame_name(handler),
+        "site": f"{_frame_name(site)}:{site.f_lineno}",
+    }
+
+
+def _frame_name(frame) -> str:
+    module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return f"{module}.{frame.f_code.co_name}"
+
+
+def _watchdog(loop_thread_id: int):
+    """Take the loop thread's stack once per stall, while it is blocked"""
+    while True:
+        time.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        tick = loop_monitor_state["tick"]
+        stall = loop_monitor_state["stall"]
+        if tick is None or (stall and stall["tick"] == tick):
+            continue
+
+        if time.monotonic() - tick - LOOP_LAG_INTERVAL_SECONDS < LOOP_STALL_SECONDS:
+            continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        loop_monitor_state["stall"] = {
+            "tick": tick,
+            **attribute(frame),
+            "stack": "".join(traceback.format_stack(frame)[-15:]),
+        }
+        del frame
+
+
+def _record_stall(tick: float, lag: float):
+    stall: Optional[dict] = loop_monitor_state["stall"]
+    if not stall or stall["tick"] != tick:
+        # Over before the watchdog looked
+        stall = {"handler": "unknown", "site": "unknown", "stack": ""}
+
+    LOOP_STALLS.inc(handler=stall["handler"])
+    LOOP_STALL_SECONDS_TOTAL.inc(lag, handler=stall["handler"])
+    log.debug(
+        f"🐢 Event loop blocked for {lag:.3f}s in {stall['handler']} "
+        f"at {stall['site']}\n{stall['stack']}".rstrip()
+    )
+
+
+async def loop_monitor():
+    if LOOP_STALL_SECONDS <= 0:
+        return
+
+    threading.Thread(
+        target=_watchdog,
+        args=(threading.get_ident(),),
+        name="loop-watchdog",
+        daemon=True,
+    ).start()
+    log.info(f"⏱️ Watching for event loop stalls over {LOOP_STALL_SECONDS:g}s")
+
+    while True:
+        tick = loop_monitor_state["tick"] = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(time.monotonic() - tick - LOOP_LAG_INTERVAL_SECONDS, 0)
+        LOOP_LAG_SECONDS.observe(lag)
+        if lag >= LOOP_STALL_SECONDS:
+            _record_stall(tick, lag)
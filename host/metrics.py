@@ -0,0 +1,182 @@
+"""
+Host metrics in the Prometheus text format, served by /metrics.
+
+Counters and histograms live in this process only (they start at zero when the
+host restarts), values that can be read from the host's state any time, like the
+number of running VMs, are computed when /metrics is scraped.
+
+create_microvm times each boot phase with boot_span, so boot latency can be
+compared per phase across VMs; the same timings are kept per VM for /status.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+from models import microvms, ROOTFS_IMAGES
+
+# Upper bounds of the histogram buckets, +Inf is implied
+BOOT_PHASE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+SIZE_BUCKETS = (1024, 16 * 1024, 256 * 1024, 1024**2, 16 * 1024**2, 256 * 1024**2)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> ([count per bucket..., +Inf count], sum)
+        self.values: Dict[Labels, tuple] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.values[key] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                le = (("le", f"{bound:g}" if bound != "+Inf" else bound),)
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+class Gauge:
+    """Read from the host's state when scraped: collect() -> [(labels dict, value)]"""
+
+    def __init__(self, name: str, help: str, collect: Callable[[], list]):
+        self.name = name
+        self.help = help
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.collect():
+            lines.append(f"{self.name}{_format_labels(_labels(labels))} {value:g}")
+        return lines
+
+
+registry: list = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+BOOT_PHASE_SECONDS = register(
+    Histogram(
+        "microvm_boot_phase_seconds",
+        "Time spent in each create_microvm phase",
+        BOOT_PHASE_BUCKETS,
+    )
+)
+BOOT_FAILURES = register(
+    Counter("microvm_boot_failures_total", "create_microvm calls failed, by phase")
+)
+TASK_DURATION_SECONDS = register(
+    Histogram(
+        "task_duration_seconds",
+        "Task run time from start to finish, by final status",
+        DURATION_BUCKETS,
+    )
+)
+TASK_OUTPUT_BYTES = register(
+    Counter("task_output_bytes_total", "Task output streamed from the microVMs")
+)
+STREAM_SENT_BYTES = register(
+    Counter(
+        "stream_sent_bytes_total",
+        "Task output sent to callers (before compression), by stream format",
+    )
+)
+STREAM_DURATION_SECONDS = register(
+    Histogram(
+        "stream_duration_seconds",
+        "How long callers followed a task stream, by stream format",
+        DURATION_BUCKETS,
+    )
+)
+UPLOAD_BYTES = register(
+    Histogram("upload_bytes", "Size of files uploaded into microVMs", SIZE_BUCKETS)
+)
+
+
+def _microvms_by_runtime() -> list:
+    counts = dict.fromkeys(ROOTFS_IMAGES, 0)
+    for vm in microvms.values():
+        counts[vm["runtime"]] = counts.get(vm["runtime"], 0) + 1
+    return [({"runtime": runtime}, count) for runtime, count in counts.items()]
+
+
+MICROVMS_ACTIVE = register(
+    Gauge("microvms_active", "Tracked microVMs, by runtime", _microvms_by_runtime)
+)
+RECONCILE_ACTIONS = register(
+    Counter(
+        "maintenance_reconcile_actions_total",
+        "Orphaned resources /maintenance cleaned up, by action",
+    )
+)
+
+
+@contextmanager
+def boot_span(phases: dict, phase: str):
+    """Time one create_microvm phase into phases and the boot phase histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        BOOT_FAILURES.inc(phase=phase)
+        raise
+    seconds = time.perf_counter() - start
+    phases[phase] = round(seconds, 4)
+    BOOT_PHASE_SECONDS.observe(seconds, phase=phase)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
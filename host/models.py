@@ -1,6 +1,8 @@
+import asyncio
 from connectrpc.method import MethodInfo, IdempotencyLevel
 import process_pb2
-from typing import Dict
+import filesystem_pb2
+from typing import Dict, Literal, Optional
 from pydantic import BaseModel
 
 
@@ -8,6 +10,27 @@ class CreateMicroVMRequest(BaseModel):
     user_id: str
     runtime: str = "python"
     env_vars: Dict[str, str] = {}
+    # How the host talks to envd/FastAPI in the VM: over the TAP network or
+    # over Firecracker's virtio-vsock
+    transport: Literal["tap", "vsock"] = "tap"
+    # General networking (TAP device, route, guest IP). Only vsock VMs can go without
+    network: bool = True
+    # "overlay": per-VM qcow2 overlay of the image over NBD. "shared": the image is
+    # attached read-only to every VM, writes go to a per-VM drive of this size
+    rootfs_mode: Literal["overlay", "shared"] = "overlay"
+    workspace_size_mib: int = 2048
+    # Attach the host's read-only pip/npm package cache drive (if one is built)
+    package_cache: bool = True
+    # Upload the user's latest workspace snapshot into the new VM
+    restore_workspace: bool = True
+    # Back guest memory with 2 MiB hugepages, None = the runtime's resource profile
+    hugepages: Optional[bool] = None
+    # Density mode: let the host merge identical guest memory pages across VMs
+    # (KSM). Costs some host CPU, can't be combined with hugepages
+    ksm: bool = False
+    # Guest PID 1: "systemd", or "minimal" (mini-init: starts envd and the agent
+    # server in parallel and reports boot milestones, see /status)
+    guest_init: Literal["systemd", "minimal"] = "systemd"
 
 
 class TaskRequest(BaseModel):
@@ -15,32 +38,110 @@ class TaskRequest(BaseModel):
     task: str
     context: list[dict] = []
     files: Dict[str, str] = {}
+    # "text" is the legacy flattened stream, "ndjson"/"sse" carry typed events
+    stream_format: Literal["text", "ndjson", "sse"] = "text"
+    # Final task status is POSTed here when the task finishes
+    callback_url: Optional[str] = None
+    # Agent session inside the VM: tasks in one session queue, sessions run in parallel
+    session_id: str = "default"
+    # Deadline for the whole task, the agent is interrupted when it passes
+    timeout_seconds: int = 1800
+    # Streamed tasks are cancelled if every reader has been gone for a grace period
+    cancel_on_disconnect: bool = True
+    # The agent session only receives context messages it hasn't seen yet;
+    # set this to start it on a fresh conversation instead
+    reset_context: bool = False
+    # Max time output waits to be batched with more output, None = host default.
+    # Lower it (or 0) for token-by-token interactivity
+    flush_ms: Optional[int] = None
+    # Tool inputs/outputs in the stream: "full", "truncated" (preview + size) or
+    # "summary" (size only). Cut payloads can be fetched from /tool_payload
+    tool_verbosity: Literal["full", "truncated", "summary"] = "full"
+
+
+class PackageCacheRequest(BaseModel):
+    # Replaces the manifest when given, otherwise the current one is refreshed
+    pip: Optional[list[str]] = None
+    npm: Optional[list[str]] = None
+
+
+class SnapshotRequest(BaseModel):
+    user_id: str
+
+
+class HugepagePoolRequest(BaseModel):
+    size_mib: int
+
+
+class BootTraceRequest(BaseModel):
+    runtime: str
+    # Boot the trace VM the way the runtime's VMs usually boot
+    guest_init: Literal["systemd", "minimal"] = "systemd"
+    rootfs_mode: Literal["overlay", "shared"] = "overlay"
+    env_vars: Dict[str, str] = {}
 
 
 class KillMicroVMRequest(BaseModel):
     user_id: str
 
 
+class CancelTaskRequest(BaseModel):
+    task_id: str
+
+
 # In-memory tracking of microVMs:
 # {user_id: {
 #     "process": subprocess.Popen,
-#     "ip": "10.0.1.100",
+#     "ip": "10.0.1.100",  # None for vsock VMs without networking
+#     "vsock_path": None,  # Firecracker vsock socket, set for vsock VMs
 #     "running_process_pid": None,  # REPL kernel PID
 #     "background_process_pid": None  # Background server PID (only one allowed)
+#     "workspace_index": None  # WorkspaceIndex, created on first use
 # }}
 
 microvms: Dict[str, dict] = {}
 
+# Users whose create_microvm is in progress (not in microvms yet)
+creating_microvms: set = set()
+
+# Fire-and-forget tasks (timers, background loops, ...). The loop only keeps
+# weak references, so they are held here until done
+background_tasks: set = set()
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
 # Configuration
 FIRECRACKER_BIN = "/usr/local/bin/firecracker"
 KERNEL_PATH = "/opt/firecracker/kernels/vmlinux"
 WORK_DIR = "/opt/firecracker/vms"
+TASKS_DIR = "/opt/firecracker/tasks"  # Task output spill files
+WORKSPACE_TEMPLATES_DIR = "/opt/firecracker/images/workspace"  # Empty ext4 per size
+PACKAGE_CACHE_DIR = "/opt/firecracker/package-cache"  # Manifest + staging
+PACKAGE_CACHE_IMAGE = "/opt/firecracker/images/package-cache.ext4"
+SNAPSHOTS_DIR = "/opt/firecracker/snapshots"  # Workspace snapshots (chunks + manifests)
+GUEST_BOOT_FILE = "/run/mini-init/boot.json"  # Written by the minimal guest init
+BOOT_TRACES_DIR = (
+    "/opt/firecracker/images/boot-traces"  # Blocks each image's boot reads
+)
 
 # Runtime image mappings ->
 ROOTFS_IMAGES = {
     "claude-agent": "/opt/firecracker/images/claude-agent-runtime.ext4",
 }
 
+# Guest resources per runtime. hugepages: 2 MiB pages from the host's hugepage
+# pool (fewer TLB misses, less host page-table memory), needs HUGEPAGE_POOL_MIB
+RESOURCE_PROFILES = {
+    "claude-agent": {"vcpu_count": 2, "mem_size_mib": 2048, "hugepages": False},
+}
+DEFAULT_RESOURCE_PROFILE = {"vcpu_count": 2, "mem_size_mib": 1024, "hugepages": False}
+
 # IP allocation (simple counter for now)
 next_ip = 100  # Will assign 10.0.1.100, 10.0.1.101, etc.
 
@@ -52,3 +153,43 @@ START_METHOD = MethodInfo(
     output=process_pb2.StartResponse,
     idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
 )
+
+LIST_DIR_METHOD = MethodInfo(
+    name="ListDir",
+    service_name="filesystem.Filesystem",
+    input=filesystem_pb2.ListDirRequest,
+    output=filesystem_pb2.ListDirResponse,
+    idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
+)
+
+STAT_METHOD = MethodInfo(
+    name="Stat",
+    service_name="filesystem.Filesystem",
+    input=filesystem_pb2.StatRequest,
+    output=filesystem_pb2.StatResponse,
+    idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
+)
+
+CREATE_WATCHER_METHOD = MethodInfo(
+    name="CreateWatcher",
+    service_name="filesystem.Filesystem",
+    input=filesystem_pb2.CreateWatcherRequest,
+    output=filesystem_pb2.CreateWatcherResponse,
+    idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
+)
+
+GET_WATCHER_EVENTS_METHOD = MethodInfo(
+    name="GetWatcherEvents",
+    service_name="filesystem.Filesystem",
+    input=filesystem_pb2.GetWatcherEventsRequest,
+    output=filesystem_pb2.GetWatcherEventsResponse,
+    idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
+)
+
+REMOVE_WATCHER_METHOD = MethodInfo(
+    name="RemoveWatcher",
+    service_name="filesystem.Filesystem",
+    input=filesystem_pb2.RemoveWatcherRequest,
+    output=filesystem_pb2.RemoveWatcherResponse,
+    idempotency_level=IdempotencyLevel.NO_SIDE_EFFECTS,
+)
@@ -0,0 +1,206 @@
+"""
+Shared, read-only package cache drive for pip and npm inside the microVMs.
+
+The host keeps a staging directory with a wheel directory (pip find-links) and an
+npm cache (content-addressed cacache). A refresh downloads everything listed in
+the manifest into staging - files already there are kept - and packs staging
+into an ext4 image labelled "pkgcache" that create_microvm attaches read-only.
+The image is replaced atomically, running VMs keep the one they booted with.
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Optional
+from models import PACKAGE_CACHE_DIR, PACKAGE_CACHE_IMAGE
+from log import log
+
+MANIFEST_PATH = f"{PACKAGE_CACHE_DIR}/manifest.json"
+STAGING_DIR = f"{PACKAGE_CACHE_DIR}/staging"
+
+# Wheels are fetched for the guest's interpreter and platform, not the host's.
+# Guests run on the host's architecture (x86_64 or aarch64)
+GUEST_PYTHON_VERSION = "3.11"
+GUEST_ARCH = os.uname().machine
+GUEST_PLATFORMS = [f"manylinux2014_{GUEST_ARCH}", f"manylinux_2_28_{GUEST_ARCH}"]
+
+# Headroom on top of the staged size when sizing the image
+IMAGE_HEADROOM_BYTES = 64 * 1024 * 1024
+
+package_cache_state = {
+    "refreshing": False,
+    "last_refresh": None,
+    "last_error": None,
+    "failed": [],  # Packages that could not be fetched in the last refresh
+}
+
+
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {"pip": [], "npm": []}
+
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(PACKAGE_CACHE_DIR, exist_ok=True)
+    with open(f"{MANIFEST_PATH}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{MANIFEST_PATH}.tmp", MANIFEST_PATH)
+
+
+def package_cache_info() -> dict:
+    image = None
+    if os.path.exists(PACKAGE_CACHE_IMAGE):
+        stat = os.stat(PACKAGE_CACHE_IMAGE)
+        image = {"size_bytes": stat.st_size, "built_at": stat.st_mtime}
+
+    return {"image": image, "manifest": load_manifest(), **package_cache_state}
+
+
+async def run(*args: str, cwd: Optional[str] = None) -> tuple[int, str]:
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+    output, _ = await proc.communicate()
+    return proc.returncode, output.decode(errors="replace")
+
+
+async def fetch_pip(spec: str) -> bool:
+    platform_args = []
+    for platform in GUEST_PLATFORMS:
+        platform_args += ["--platform", platform]
+
+    code, output = await run(
+        "python3",
+        "-m",
+        "pip",
+        "download",
+        "--quiet",
+        "--dest",
+        f"{STAGING_DIR}/pip/wheels",
+        "--only-binary=:all:",
+        "--python-version",
+        GUEST_PYTHON_VERSION,
+        *platform_args,
+        spec,
+    )
+    if code != 0:
+        log.warning(f"  ⚠️ pip download {spec} failed: {output.strip()[-500:]}")
+    return code == 0
+
+
+async def fetch_npm(specs: list[str]) -> list[str]:
+    """Install specs in a throwaway project so their dependencies get cached too"""
+    failed = []
+    with tempfile.TemporaryDirectory() as project:
+        for spec in specs:
+            code, output = await run(
+                "npm",
+                "install",
+                "--cache",
+                f"{STAGING_DIR}/npm",
+                "--ignore-scripts",
+                "--no-audit",
+                "--no-fund",
+                "--no-save",
+                spec,
+                cwd=project,
+            )
+            if code != 0:
+                log.warning(f"  ⚠️ npm install {spec} failed: {output.strip()[-500:]}")
+                failed.append(spec)
+    return failed
+
+
+def staged_bytes() -> int:
+    total = 0
+    for root, _, files in os.walk(STAGING_DIR):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def allocate_image(path: str):
+    """Empty image file sized for staging"""
+    shutil.rmtree(f"{STAGING_DIR}/npm/_logs", ignore_errors=True)
+    # ext4 metadata and per-file block rounding, small files dominate npm caches
+    size = int(staged_bytes() * 1.3) + IMAGE_HEADROOM_BYTES
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+async def build_image():
+    """Pack staging into the cache image (mke2fs -d, no mount needed)"""
+    tmp_image = f"{PACKAGE_CACHE_IMAGE}.tmp"
+    # Walks the whole npm cache, keep it off the event loop
+    await asyncio.to_thread(allocate_image, tmp_image)
+
+    code, output = await run(
+        "mkfs.ext4",
+        "-q",
+        "-F",
+        "-L",
+        "pkgcache",
+        "-m",
+        "0",
+        "-d",
+        STAGING_DIR,
+        tmp_image,
+    )
+    if code != 0:
+        os.remove(tmp_image)
+        raise RuntimeError(f"mkfs.ext4 failed: {output.strip()}")
+
+    os.chmod(tmp_image, 0o644)
+    os.replace(tmp_image, PACKAGE_CACHE_IMAGE)
+
+
+async def refresh_package_cache():
+    """Fetch the manifest's packages into staging and rebuild the image"""
+    if package_cache_state["refreshing"]:
+        return
+
+    package_cache_state["refreshing"] = True
+    start = time.time()
+    manifest = load_manifest()
+    failed = []
+
+    try:
+        log.info(
+            f"📦 Refreshing package cache ({len(manifest['pip'])} pip, {len(manifest['npm'])} npm)"
+        )
+        os.makedirs(f"{STAGING_DIR}/pip/wheels", exist_ok=True)
+        os.makedirs(f"{STAGING_DIR}/npm", exist_ok=True)
+
+        for spec in manifest["pip"]:
+            if not await fetch_pip(spec):
+                failed.append(f"pip:{spec}")
+
+        if manifest["npm"]:
+            if shutil.which("npm"):
+                failed += [f"npm:{spec}" for spec in await fetch_npm(manifest["npm"])]
+            else:
+                log.warning("  ⚠️ npm not installed on the host, skipping npm packages")
+                failed += [f"npm:{spec}" for spec in manifest["npm"]]
+
+        await build_image()
+
+        package_cache_state["last_error"] = None
+        log.info(f"✅ Package cache rebuilt in {time.time() - start:.1f}s")
+
+    except Exception as e:
+        package_cache_state["last_error"] = str(e)
+        log.error(f"❌ Package cache refresh failed: {e}")
+
+    finally:
+        package_cache_state["refreshing"] = False
+        package_cache_state["last_refresh"] = time.time()
+        package_cache_state["failed"] = failed
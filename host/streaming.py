@@ -0,0 +1,70 @@
+"""
+Helpers for proxying task output streams from the microVM to the caller.
+"""
+
+import os
+import zlib
+from typing import AsyncIterator, Optional
+
+# Output is batched until it reaches STREAM_FLUSH_BYTES or has waited
+# STREAM_FLUSH_MS (per request: flush_ms, 0 disables batching)
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "16384"))
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "25"))
+
+STREAM_MEDIA_TYPES = {
+    "text": "text/plain",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+# Content-Encoding -> zlib wbits (gzip header vs zlib header)
+STREAM_ENCODINGS = {
+    "gzip": 31,
+    "deflate": 15,
+}
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick a stream encoding from an Accept-Encoding header.
+
+    Returns the supported encoding with the highest q-value, or None for identity.
+    """
+    if not accept_encoding:
+        return None
+
+    best, best_q = None, 0.0
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+
+        if name in STREAM_ENCODINGS and q > best_q:
+            best, best_q = name, q
+
+    return best
+
+
+async def compress_stream(
+    chunks: AsyncIterator[bytes], encoding: str
+) -> AsyncIterator[bytes]:
+    """
+    Compress a byte stream incrementally.
+
+    Each chunk is sync-flushed so the caller can decode events as they arrive
+    instead of waiting for the end of the stream.
+    """
+    compressor = zlib.compressobj(wbits=STREAM_ENCODINGS[encoding])
+
+    async for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+
+    yield compressor.flush()
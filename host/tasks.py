@@ -0,0 +1,387 @@
+"""
+Host-side task runs and their replayable output.
+
+A task's output is pumped from the microVM by a background asyncio task, not by
+the caller's HTTP response, so a dropped client connection does not lose it. The
+output is kept as a recent in-memory window plus a spill file on disk, and any
+number of readers can follow it from a byte offset.
+"""
+
+import asyncio
+import httpx
+import json
+import os
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Dict, Optional
+from models import TASKS_DIR, run_in_background
+from streaming import STREAM_FLUSH_MS
+from guest_transport import FASTAPI_PORT, guest_address, guest_client
+from metrics import TASK_DURATION_SECONDS, TASK_OUTPUT_BYTES, Gauge, register
+from log import bind_log_context, log
+
+# Recent output kept in memory per task, older bytes are read back from disk
+TASK_MEMORY_BYTES = 1024 * 1024
+
+# Hard cap on stored output per task, anything past it is dropped
+TASK_MAX_OUTPUT_BYTES = 256 * 1024 * 1024
+
+# How long finished tasks stay replayable before /maintenance drops them
+TASK_RETENTION_SECONDS = 3600
+
+TASK_READ_CHUNK = 64 * 1024
+
+# Output is written to the spill file in batches of this size, off the event loop
+TASK_SPILL_BYTES = 256 * 1024
+
+# How long a streamed task may have no readers before it is cancelled
+TASK_DISCONNECT_GRACE_SECONDS = 60
+
+# Extra time the guest gets to end a task cleanly after its deadline
+TASK_DEADLINE_GRACE_SECONDS = 30
+
+
+class TaskOutput:
+    """Append-only task output: memory tail window + full spill file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb", buffering=0)
+        self.size = 0
+        self.spilled = 0  # Bytes written to the spill file, the rest is in memory
+        self.memory = bytearray()
+        self.memory_start = 0  # Byte offset of memory[0]
+        self.truncated = False
+        self.done = False
+        self.changed = asyncio.Condition()
+
+    async def append(self, chunk: bytes):
+        if self.size + len(chunk) > TASK_MAX_OUTPUT_BYTES:
+            self.truncated = True
+            return
+
+        self.memory += chunk
+        self.size += len(chunk)
+        if self.size - self.spilled >= TASK_SPILL_BYTES:
+            await self._spill()
+
+        # Trim in big steps so we don't shift the window on every chunk. Only
+        # bytes already in the spill file leave memory
+        if len(self.memory) > 2 * TASK_MEMORY_BYTES:
+            excess = min(
+                len(self.memory) - TASK_MEMORY_BYTES, self.spilled - self.memory_start
+            )
+            del self.memory[:excess]
+            self.memory_start += excess
+
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def _spill(self):
+        data = bytes(self.memory[self.spilled - self.memory_start :])
+        await asyncio.to_thread(self.file.write, data)
+        self.spilled += len(data)
+
+    async def finish(self):
+        await self._spill()
+        await asyncio.to_thread(self.file.close)
+        self.done = True
+        async with self.changed:
+            self.changed.notify_all()
+
+    def _read_spilled(self, offset: int, limit: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(limit)
+
+    async def read(self, offset: int, limit: int = TASK_READ_CHUNK) -> bytes:
+        if offset >= self.memory_start:
+            start = offset - self.memory_start
+            return bytes(self.memory[start : start + limit])
+
+        # Older than the memory window, read it back from the spill file
+        return await asyncio.to_thread(
+            self._read_spilled, offset, min(limit, self.memory_start - offset)
+        )
+
+    async def follow(
+        self, offset: int = 0, flush_bytes: int = 0, flush_delay: float = 0.0
+    ) -> AsyncIterator[bytes]:
+        """
+        Yield output from offset until the task finishes.
+
+        With flush_delay set, new output waits up to flush_delay seconds for
+        flush_bytes to accumulate, so it goes out as one chunk instead of many.
+        """
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.size > offset or self.done)
+
+                if (
+                    flush_delay > 0
+                    and not self.done
+                    and self.size - offset < flush_bytes
+                ):
+                    try:
+                        await asyncio.wait_for(
+                            self.changed.wait_for(
+                                lambda: self.size - offset >= flush_bytes or self.done
+                            ),
+                            flush_delay,
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+
+            if self.size > offset:
+                data = await self.read(offset)
+                offset += len(data)
+                yield data
+            else:
+                return
+
+    def remove(self):
+        if not self.file.closed:
+            self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Task:
+    """One agent task run against a user's microVM"""
+
+    def __init__(
+        self,
+        user_id: str,
+        vm: dict,
+        stream_format: str,
+        callback_url: Optional[str] = None,
+        cancel_on_disconnect: bool = False,
+        flush_ms: int = STREAM_FLUSH_MS,
+    ):
+        self.task_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.vm = vm
+        self.stream_format = stream_format
+        self.callback_url = callback_url
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self.flush_ms = flush_ms
+        self.readers = 0
+        self.status = "running"  # running | completed | failed | cancelled
+        self.error: Optional[str] = None
+        self.cancel_reason: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        os.makedirs(TASKS_DIR, exist_ok=True)
+        self.output = TaskOutput(f"{TASKS_DIR}/{self.task_id}.out")
+        self.runner: Optional[asyncio.Task] = None
+
+    def info(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "user_id": self.user_id,
+            "status": self.status,
+            "error": self.error,
+            "cancel_reason": self.cancel_reason,
+            "stream_format": self.stream_format,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "output_bytes": self.output.size,
+            "output_truncated": self.output.truncated,
+        }
+
+    def attach(self):
+        self.readers += 1
+
+    def detach(self):
+        self.readers -= 1
+        if self.readers == 0 and self.cancel_on_disconnect and self.status == "running":
+            run_in_background(self._cancel_if_abandoned())
+
+    async def _cancel_if_abandoned(self):
+        await asyncio.sleep(TASK_DISCONNECT_GRACE_SECONDS)
+        if self.readers == 0 and self.status == "running":
+            log.info(f"🔌 All readers of task {self.task_id} left, cancelling it")
+            await cancel_task(self, "disconnected")
+
+
+# In-memory tracking of task runs: {task_id: Task}
+tasks: Dict[str, Task] = {}
+
+register(
+    Gauge(
+        "tasks_running",
+        "Tasks currently running",
+        lambda: [({}, sum(1 for t in tasks.values() if t.status == "running"))],
+    )
+)
+
+
+async def run_task(
+    task: Task, vm: dict, payload: dict, prepare: Optional[Awaitable] = None
+):
+    """Run a task to completion, cancellation or deadline"""
+    bind_log_context(task_id=task.task_id, user_id=task.user_id)
+    timeout = payload.get("timeout_seconds") or 1800
+
+    try:
+        if prepare is not None:
+            await prepare
+
+        # The guest ends the task itself at the deadline, this is the backstop
+        await asyncio.wait_for(
+            stream_task_output(task, vm, payload, timeout),
+            timeout + TASK_DEADLINE_GRACE_SECONDS,
+        )
+
+    except asyncio.TimeoutError:
+        task.error = f"Task did not finish within its {timeout}s deadline"
+    except asyncio.CancelledError:
+        # Closing the stream makes the guest interrupt the agent
+        task.cancel_reason = task.cancel_reason or "cancelled"
+    except httpx.TimeoutException:
+        task.error = f"Request timed out after {timeout} seconds"
+    except httpx.ConnectError:
+        task.error = (
+            f"Cannot connect to Claude FastAPI at {guest_address(vm, FASTAPI_PORT)}"
+        )
+    except Exception as e:
+        task.error = f"Error communicating with Claude FastAPI: {type(e).__name__}"
+
+    # The spill file is complete before /task_result can serve it
+    await task.output.finish()
+    if task.cancel_reason:
+        task.status = "cancelled"
+    else:
+        task.status = "failed" if task.error else "completed"
+    task.finished_at = time.time()
+    TASK_DURATION_SECONDS.observe(
+        task.finished_at - task.created_at, status=task.status
+    )
+
+    log.info(f"🏁 Task {task.task_id} for user {task.user_id} {task.status}")
+
+    if task.callback_url:
+        await notify_callback(task)
+
+
+async def stream_task_output(task: Task, vm: dict, payload: dict, timeout: float):
+    """Stream a task from the claude FastAPI server in the microVM into task.output"""
+    async with guest_client(
+        vm, FASTAPI_PORT, timeout=timeout + TASK_DEADLINE_GRACE_SECONDS
+    ) as http_client:
+        async with http_client.stream(
+            "POST", "/execute_task", json=payload
+        ) as response:
+            # Check for errors
+            if response.status_code != 200:
+                error_msg = await response.aread()
+                # FastAPI returns {"detail": "error message"}, extract just the detail
+                try:
+                    error_data = json.loads(error_msg)
+                    task.error = error_data.get("detail", error_msg.decode())
+                except:
+                    task.error = error_msg.decode()
+                return
+
+            async for chunk in response.aiter_bytes():
+                if chunk:
+                    TASK_OUTPUT_BYTES.inc(len(chunk))
+                    await task.output.append(chunk)
+
+
+async def cancel_task(task: Task, reason: str = "cancelled"):
+    """
+    Cancel a running task.
+
+    The guest is asked to interrupt the agent so the stream ends cleanly. If it
+    doesn't know the task (files still uploading) or can't be reached, the host
+    side run is cancelled instead, which drops the guest stream.
+    """
+    if task.status != "running" or task.cancel_reason:
+        return
+
+    task.cancel_reason = reason
+
+    try:
+        async with guest_client(task.vm, FASTAPI_PORT) as http_client:
+            response = await http_client.post(
+                "/cancel_task",
+                json={"task_id": task.task_id, "reason": reason},
+                timeout=5.0,
+            )
+            if response.status_code == 200:
+                return
+    except Exception as e:
+        log.warning(f"⚠️ Guest cancel for task {task.task_id} failed: {e}")
+
+    if task.runner:
+        task.runner.cancel()
+
+
+async def notify_callback(task: Task):
+    """POST the final task status to the task's callback_url"""
+    try:
+        async with httpx.AsyncClient() as http_client:
+            response = await http_client.post(
+                task.callback_url, json=task.info(), timeout=10.0
+            )
+            if response.status_code >= 400:
+                log.warning(
+                    f"⚠️ Callback for task {task.task_id} returned {response.status_code}"
+                )
+    except Exception as e:
+        log.warning(f"⚠️ Callback for task {task.task_id} failed: {e}")
+
+
+def start_task(
+    user_id: str,
+    vm: dict,
+    payload: dict,
+    prepare: Optional[Awaitable] = None,
+    callback_url: Optional[str] = None,
+    cancel_on_disconnect: bool = False,
+    flush_ms: Optional[int] = None,
+) -> Task:
+    """
+    Register a task and run it in the background.
+
+    prepare (e.g. file uploads) is awaited inside the background run, before the
+    task is sent to the microVM.
+    """
+    task = Task(
+        user_id,
+        vm,
+        payload.get("stream_format", "text"),
+        callback_url,
+        cancel_on_disconnect,
+        STREAM_FLUSH_MS if flush_ms is None else flush_ms,
+    )
+    payload["task_id"] = task.task_id
+    tasks[task.task_id] = task
+    task.runner = asyncio.create_task(run_task(task, vm, payload, prepare))
+    return task
+
+
+def cleanup_finished_tasks(max_age: float = TASK_RETENTION_SECONDS) -> int:
+    """Drop finished tasks older than max_age along with their spill files"""
+    now = time.time()
+    expired = [
+        task_id
+        for task_id, task in tasks.items()
+        if task.finished_at and now - task.finished_at > max_age
+    ]
+    for task_id in expired:
+        tasks.pop(task_id).output.remove()
+
+    # Spill files left over from a previous host process
+    if os.path.exists(TASKS_DIR):
+        for filename in os.listdir(TASKS_DIR):
+            if filename.removesuffix(".out") not in tasks:
+                try:
+                    os.remove(os.path.join(TASKS_DIR, filename))
+                except OSError:
+                    pass
+
+    return len(expired)
@@ -0,0 +1,225 @@
+"""
+Per-VM resource telemetry, for finding noisy tenants and right-sizing profiles.
+
+Every TELEMETRY_INTERVAL_SECONDS the host samples each Firecracker process from
+procfs (CPU time, RSS, hugepage memory, disk IO), its TAP device's counters
+from sysfs, and the guest's own view from envd's /metrics (CPU, memory, disk),
+all VMs at once. Firecracker runs in the host service's cgroup, so procfs is
+where the per-VM numbers are.
+
+Samples are kept for TELEMETRY_WINDOW_SECONDS; /telemetry summarizes any
+window up to that (averages, peaks and rates from the counters' deltas).
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+from models import microvms
+from guest_transport import ENVD_PORT, guest_client
+from log import log
+
+# 0 disables the collector
+TELEMETRY_INTERVAL_SECONDS = float(os.getenv("TELEMETRY_INTERVAL_SECONDS", "15"))
+TELEMETRY_WINDOW_SECONDS = int(os.getenv("TELEMETRY_WINDOW_SECONDS", "3600"))
+
+# envd gets this long to answer, a busy guest just misses the sample
+GUEST_METRICS_TIMEOUT = 2.0
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Samples per VM, oldest first: {user_id: deque of samples}
+vm_samples: Dict[str, deque] = {}
+
+
+def _read_proc(pid: int) -> Optional[dict]:
+    """CPU seconds, memory and IO counters of a Firecracker process"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+
+    sample = {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        "rss_bytes": int(fields[21]) * PAGE_SIZE,
+        "hugetlb_bytes": int(status.get("HugetlbPages", "0 kB").split()[0]) * 1024,
+        "threads": int(fields[17]),
+    }
+
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            io = dict(line.split(": ", 1) for line in f)
+        sample["read_bytes"] = int(io["read_bytes"])
+        sample["write_bytes"] = int(io["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        pass  # /proc/<pid>/io needs the same user or CAP_SYS_PTRACE
+
+    return sample
+
+
+def _read_tap(tap_device: str) -> dict:
+    """TAP counters, seen from the host: rx is what the guest sent"""
+    counters = {}
+    for name in ("rx_bytes", "tx_bytes", "rx_packets", "tx_packets", "rx_dropped"):
+        try:
+            with open(f"/sys/class/net/{tap_device}/statistics/{name}") as f:
+                counters[f"tap_{name}"] = int(f.read())
+        except (OSError, ValueError):
+            pass
+    return counters
+
+
+async def _guest_metrics(vm: dict) -> Optional[dict]:
+    try:
+        async with guest_client(vm, ENVD_PORT) as client:
+            response = await client.get("/metrics", timeout=GUEST_METRICS_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+    except Exception:
+        return None
+
+
+async def sample_vm(user_id: str, vm: dict):
+    pid = vm["process"].pid
+    if vm["process"].poll() is not None:
+        return
+
+    sample = {"t": time.time()}
+    host = await asyncio.to_thread(_read_proc, pid)
+    if host is None:
+        return
+    sample.update(host)
+    if vm.get("tap_device"):
+        sample.update(_read_tap(vm["tap_device"]))
+    sample["guest"] = await _guest_metrics(vm)
+
+    samples = vm_samples.get(user_id)
+    # A new VM for the same user starts a new series
+    if samples is None or (samples and samples[-1]["pid"] != pid):
+        interval = TELEMETRY_INTERVAL_SECONDS or 1
+        samples = vm_samples[user_id] = deque(
+            maxlen=int(TELEMETRY_WINDOW_SECONDS / interval) + 1
+        )
+    sample["pid"] = pid
+    samples.append(sample)
+
+
+async def collect_telemetry():
+    """Take one sample of every running VM"""
+    for user_id in list(vm_samples):
+        if user_id not in microvms:
+            del vm_samples[user_id]
+
+    await asyncio.gather(
+        *(sample_vm(user_id, vm) for user_id, vm in list(microvms.items())),
+        return_exceptions=True,
+    )
+
+
+async def telemetry_loop():
+    if TELEMETRY_INTERVAL_SECONDS <= 0:
+        return
+
+    log.info(f"📈 Sampling VM telemetry every {TELEMETRY_INTERVAL_SECONDS:g}s")
+    while True:
+        started = time.time()
+        try:
+            await collect_telemetry()
+        except Exception as e:
+            log.warning(f"⚠️ Telemetry collection failed: {e}")
+        await asyncio.sleep(
+            max(TELEMETRY_INTERVAL_SECONDS - (time.time() - started), 0)
+        )
+
+
+def _stats(values: list) -> Optional[dict]:
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {
+        "avg": round(sum(values) / len(values), 2),
+        "max": round(max(values), 2),
+        "last": round(values[-1], 2),
+    }
+
+
+def _rate(first: dict, last: dict, key: str) -> Optional[dict]:
+    if key not in first or key not in last:
+        return None
+    seconds = last["t"] - first["t"]
+    total = last[key] - first[key]
+    return {
+        "total": total,
+        "per_second": round(total / seconds, 1) if seconds > 0 else None,
+    }
+
+
+def summarize(vm: dict, samples: list) -> dict:
+    """Averages, peaks and rates over a VM's samples"""
+    # CPU between consecutive samples, 100 = one host core busy
+    cpu_percent = [
+        (b["cpu_seconds"] - a["cpu_seconds"]) / (b["t"] - a["t"]) * 100
+        for a, b in zip(samples, samples[1:])
+        if b["t"] > a["t"]
+    ]
+    guests = [s["guest"] for s in samples if s.get("guest")]
+    first, last = samples[0], samples[-1]
+
+    return {
+        "samples": len(samples),
+        "from": first["t"],
+        "to": last["t"],
+        "vcpu_count": vm.get("vcpu_count"),
+        "mem_size_mib": vm.get("mem_size_mib"),
+        "cpu_percent": _stats(cpu_percent),
+        "rss_mib": _stats([s["rss_bytes"] / (1024 * 1024) for s in samples]),
+        "hugetlb_mib": _stats([s["hugetlb_bytes"] / (1024 * 1024) for s in samples]),
+        "disk_read_bytes": _rate(first, last, "read_bytes"),
+        "disk_write_bytes": _rate(first, last, "write_bytes"),
+        "net_sent_bytes": _rate(first, last, "tap_rx_bytes"),
+        "net_received_bytes": _rate(first, last, "tap_tx_bytes"),
+        "net_dropped_packets": _rate(first, last, "tap_rx_dropped"),
+        "guest": (
+            {
+                "cpu_percent": _stats([g.get("cpu_used_pct") for g in guests]),
+                "mem_used_mib": _stats(
+                    [g["mem_used"] / (1024 * 1024) for g in guests if "mem_used" in g]
+                ),
+                "disk_used_mib": _stats(
+                    [g["disk_used"] / (1024 * 1024) for g in guests if "disk_used" in g]
+                ),
+                "disk_total_mib": guests[-1].get("disk_total", 0) // (1024 * 1024),
+            }
+            if guests
+            else None
+        ),
+    }
+
+
+def telemetry_summary(window_seconds: float, user_id: Optional[str] = None) -> dict:
+    """Per-VM summaries over the last window_seconds, busiest CPU first"""
+    cutoff = time.time() - window_seconds
+    summaries = {}
+    for uid, samples in list(vm_samples.items()):
+        if user_id and uid != user_id:
+            continue
+        window = [s for s in samples if s["t"] >= cutoff]
+        if window and uid in microvms:
+            summaries[uid] = summarize(microvms[uid], window)
+
+    busiest = sorted(
+        summaries,
+        key=lambda uid: (summaries[uid]["cpu_percent"] or {}).get("avg", 0),
+        reverse=True,
+    )
+    return {
+        "interval_seconds": TELEMETRY_INTERVAL_SECONDS,
+        "window_seconds": window_seconds,
+        "microvms": {uid: summaries[uid] for uid in busiest},
+    }
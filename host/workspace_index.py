@@ -0,0 +1,219 @@
+"""
+Live index of a microVM's /workspace, kept up to date from envd watcher events.
+
+The first sync lists /workspace once and registers a recursive envd watcher. Later
+syncs only drain the watcher's buffered events and stat the paths they name, so
+answering "what is in the workspace" no longer walks the guest filesystem.
+
+Every sync that changes something bumps the index cursor. Files remember the cursor
+they were last written at, so clients can ask for just the changes since a cursor.
+"""
+
+import asyncio
+from connectrpc.client import ConnectClient
+import filesystem_pb2
+from guest_transport import guest_rpc_client
+from typing import Dict, Optional
+from config import SKIP_DIRS, SKIP_FILES
+from models import (
+    LIST_DIR_METHOD,
+    STAT_METHOD,
+    CREATE_WATCHER_METHOD,
+    GET_WATCHER_EVENTS_METHOD,
+    REMOVE_WATCHER_METHOD,
+)
+from log import log
+
+WORKSPACE_DIR = "/workspace"
+
+# Max concurrent Stat calls while applying one batch of watcher events
+STAT_CONCURRENCY = 16
+
+REMOVE_EVENTS = (
+    filesystem_pb2.EventType.EVENT_TYPE_REMOVE,
+    filesystem_pb2.EventType.EVENT_TYPE_RENAME,
+)
+
+
+def is_user_file(filename: str) -> bool:
+    """Skip dependency/cache directories and lock files (not user output)"""
+    # Check if ANY skip pattern appears in the path (handles subfolders)
+    if any(f"/{d}" in f"/{filename}" or filename.startswith(d) for d in SKIP_DIRS):
+        return False
+
+    return filename not in SKIP_FILES
+
+
+def _entry_info(entry) -> dict:
+    return {
+        "size": entry.size,
+        "modified": entry.modified_time.seconds + entry.modified_time.nanos / 1e9,
+        "mode": entry.mode & 0o777,
+    }
+
+
+async def list_workspace_entries(rpc_client: ConnectClient) -> Dict[str, dict]:
+    """Full ListDir of /workspace -> {path relative to /workspace: entry info}"""
+    response = await rpc_client.execute_unary(
+        request=filesystem_pb2.ListDirRequest(path=WORKSPACE_DIR, depth=10),
+        method=LIST_DIR_METHOD,
+    )
+
+    entries = {}
+    for entry in response.entries:
+        if entry.type == filesystem_pb2.FileType.FILE_TYPE_FILE:
+            filename = entry.path.replace(f"{WORKSPACE_DIR}/", "", 1)
+            if is_user_file(filename):
+                entries[filename] = _entry_info(entry)
+
+    return entries
+
+
+class WorkspaceIndex:
+    """In-memory index of one microVM's /workspace"""
+
+    def __init__(self, vm: dict):
+        self.rpc_client = guest_rpc_client(vm)
+        self.files: Dict[str, dict] = {}  # path -> {"size", "modified", "mode", "seq"}
+        self.removed: Dict[str, int] = {}  # path -> cursor it was removed at
+        self.cursor = 0
+        self.task_cursor = 0  # Cursor taken right before the latest task started
+        self.watcher_id: Optional[str] = None
+        self.lock = asyncio.Lock()
+
+    async def sync(self) -> int:
+        """Bring the index up to date with the guest and return the current cursor"""
+        async with self.lock:
+            if self.watcher_id is None:
+                await self._resync()
+                return self.cursor
+
+            try:
+                response = await self.rpc_client.execute_unary(
+                    request=filesystem_pb2.GetWatcherEventsRequest(
+                        watcher_id=self.watcher_id
+                    ),
+                    method=GET_WATCHER_EVENTS_METHOD,
+                )
+            except Exception as e:
+                # Watcher overflowed or envd restarted - fall back to a full listing
+                log.warning(f"⚠️ Workspace watcher lost, resyncing: {e}")
+                await self._resync()
+                return self.cursor
+
+            await self._apply(response.events)
+            return self.cursor
+
+    def list_files(self) -> list[str]:
+        return sorted(self.files)
+
+    def changes_since(self, cursor: int) -> dict:
+        return {
+            "cursor": self.cursor,
+            "files": sorted(
+                path for path, info in self.files.items() if info["seq"] > cursor
+            ),
+            "removed": sorted(
+                path for path, seq in self.removed.items() if seq > cursor
+            ),
+        }
+
+    async def _resync(self):
+        """Re-register the watcher and diff a full listing against the index"""
+        if self.watcher_id is not None:
+            try:
+                await self.rpc_client.execute_unary(
+                    request=filesystem_pb2.RemoveWatcherRequest(
+                        watcher_id=self.watcher_id
+                    ),
+                    method=REMOVE_WATCHER_METHOD,
+                )
+            except Exception:
+                pass
+            self.watcher_id = None
+
+        # Watch before listing so nothing written in between is missed
+        try:
+            response = await self.rpc_client.execute_unary(
+                request=filesystem_pb2.CreateWatcherRequest(
+                    path=WORKSPACE_DIR, recursive=True
+                ),
+                method=CREATE_WATCHER_METHOD,
+            )
+            self.watcher_id = response.watcher_id
+        except Exception as e:
+            log.warning(f"⚠️ No workspace watcher, index will use full listings: {e}")
+
+        entries = await list_workspace_entries(self.rpc_client)
+
+        self.cursor += 1
+        for path in self.files.keys() - entries.keys():
+            self._remove(path)
+        for path, info in entries.items():
+            current = self.files.get(path)
+            if current is None or (current["size"], current["modified"]) != (
+                info["size"],
+                info["modified"],
+            ):
+                self._store(path, info)
+
+    async def _apply(self, events):
+        # Only the last event per path matters
+        latest = {}
+        for event in events:
+            latest[event.name] = event.type
+
+        if not latest:
+            return
+
+        self.cursor += 1
+
+        to_stat = []
+        for path, event_type in latest.items():
+            if event_type in REMOVE_EVENTS:
+                self._remove_tree(path)
+            elif is_user_file(path):
+                to_stat.append(path)
+
+        semaphore = asyncio.Semaphore(STAT_CONCURRENCY)
+
+        async def stat(path: str):
+            async with semaphore:
+                response = await self.rpc_client.execute_unary(
+                    request=filesystem_pb2.StatRequest(path=f"{WORKSPACE_DIR}/{path}"),
+                    method=STAT_METHOD,
+                )
+                return response.entry
+
+        results = await asyncio.gather(
+            *(stat(path) for path in to_stat), return_exceptions=True
+        )
+
+        for path, entry in zip(to_stat, results):
+            if isinstance(entry, Exception):
+                # Gone again before we could stat it
+                self._remove(path)
+            elif entry.type == filesystem_pb2.FileType.FILE_TYPE_FILE:
+                self._store(path, _entry_info(entry))
+            # Directories are not indexed, their contents arrive as separate events
+
+    def _store(self, path: str, info: dict):
+        self.files[path] = {**info, "seq": self.cursor}
+        self.removed.pop(path, None)
+
+    def _remove(self, path: str):
+        if self.files.pop(path, None) is not None:
+            self.removed[path] = self.cursor
+
+    def _remove_tree(self, path: str):
+        """Remove path and, if it was a directory, everything below it"""
+        prefix = f"{path}/"
+        for indexed in [p for p in self.files if p == path or p.startswith(prefix)]:
+            self._remove(indexed)
+
+
+def get_workspace_index(vm: dict) -> WorkspaceIndex:
+    """Return the VM's workspace index, creating it on first use"""
+    if vm.get("workspace_index") is None:
+        vm["workspace_index"] = WorkspaceIndex(vm)
+    return vm["workspace_index"]
@@ -0,0 +1,344 @@
+"""
+Incremental, deduplicated snapshots of microVM workspaces.
+
+A snapshot is a manifest {path: {"size", "modified", "mode", "chunks": [sha256,
+...]}}. File contents are cut into fixed-size chunks and stored zlib-compressed
+under their SHA-256 in a chunk store shared by all users, so identical content
+is kept once. Only files whose size or mtime changed since the user's previous
+snapshot (according to the workspace index) are downloaded again.
+
+Like the workspace index, snapshots cover user files - dependency and cache
+directories (SKIP_DIRS) are left out and get reinstalled.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from typing import Dict, Optional
+import process_pb2
+from models import SNAPSHOTS_DIR, START_METHOD
+from guest_transport import ENVD_PORT, guest_client
+from workspace_index import WORKSPACE_DIR, get_workspace_index
+from log import log
+
+CHUNKS_DIR = f"{SNAPSHOTS_DIR}/chunks"
+USERS_DIR = f"{SNAPSHOTS_DIR}/users"
+
+SNAPSHOT_CHUNK_BYTES = 1024 * 1024
+
+# Manifests kept per user, older ones are dropped (their chunks go at next GC)
+SNAPSHOT_KEEP = 5
+
+# /maintenance snapshots running VMs whose last snapshot is older than this
+SNAPSHOT_INTERVAL_SECONDS = 600
+
+# Max time kill_microvm waits for the final snapshot
+SNAPSHOT_KILL_TIMEOUT = 60
+
+# Parallel file downloads/uploads per snapshot or restore
+SNAPSHOT_CONCURRENCY = 8
+
+# envd creates uploaded files with this mode, restores chmod the others back
+UPLOAD_MODE = 0o644
+
+# Paths per chmod a restore runs
+CHMOD_BATCH = 500
+
+# Unreferenced chunks younger than this may belong to a snapshot in progress
+CHUNK_GC_GRACE_SECONDS = 3600
+
+# One snapshot/restore at a time per user: {user_id: Lock}
+snapshot_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _user_dir(user_id: str) -> str:
+    return f"{USERS_DIR}/{user_id}"
+
+
+def _chunk_path(digest: str) -> str:
+    return f"{CHUNKS_DIR}/{digest[:2]}/{digest}"
+
+
+def list_snapshots(user_id: str) -> list[str]:
+    """Manifest names of a user's snapshots, oldest first"""
+    user_dir = _user_dir(user_id)
+    if not os.path.exists(user_dir):
+        return []
+    return sorted(name for name in os.listdir(user_dir) if name.endswith(".json"))
+
+
+def latest_snapshot(user_id: str) -> Optional[dict]:
+    snapshots = list_snapshots(user_id)
+    if not snapshots:
+        return None
+
+    with open(f"{_user_dir(user_id)}/{snapshots[-1]}") as f:
+        return json.load(f)
+
+
+def _write_snapshot(user_id: str, files: Dict[str, dict]) -> dict:
+    user_dir = _user_dir(user_id)
+    os.makedirs(user_dir, exist_ok=True)
+
+    snapshot = {"created_at": time.time(), "files": files}
+    path = f"{user_dir}/{int(snapshot['created_at'] * 1000)}.json"
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+    for name in list_snapshots(user_id)[:-SNAPSHOT_KEEP]:
+        os.remove(f"{user_dir}/{name}")
+
+    return snapshot
+
+
+def _store_chunk(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    path = _chunk_path(digest)
+
+    # Content-addressed: already stored means identical. Touch it so chunk GC
+    # doesn't take it while the snapshot that reuses it is being written
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per call, parallel downloads may store the same chunk at once
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(zlib.compress(data, 6))
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass  # Stored by another download meanwhile, same content
+        finally:
+            os.remove(tmp_path)
+
+    return digest
+
+
+def _read_file(chunks: list[str]) -> bytes:
+    content = bytearray()
+    for digest in chunks:
+        with open(_chunk_path(digest), "rb") as f:
+            content += zlib.decompress(f.read())
+    return bytes(content)
+
+
+async def _download_chunks(http_client, path: str) -> list[str]:
+    """Stream a workspace file from envd into the chunk store"""
+    chunks = []
+    buffer = bytearray()
+
+    async with http_client.stream(
+        "GET", "/files", params={"path": f"{WORKSPACE_DIR}/{path}"}
+    ) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"envd returned {response.status_code} for {path}")
+
+        async for data in response.aiter_bytes():
+            buffer += data
+            while len(buffer) >= SNAPSHOT_CHUNK_BYTES:
+                chunk = bytes(buffer[:SNAPSHOT_CHUNK_BYTES])
+                del buffer[:SNAPSHOT_CHUNK_BYTES]
+                chunks.append(await asyncio.to_thread(_store_chunk, chunk))
+
+    if buffer or not chunks:
+        chunks.append(await asyncio.to_thread(_store_chunk, bytes(buffer)))
+
+    return chunks
+
+
+async def snapshot_workspace(vm: dict, user_id: str) -> dict:
+    """Snapshot the VM's workspace, downloading only files changed since the last one"""
+    async with snapshot_locks.setdefault(user_id, asyncio.Lock()):
+        start = time.time()
+        index = get_workspace_index(vm)
+        await index.sync()
+
+        previous = (latest_snapshot(user_id) or {}).get("files", {})
+        # Files a restore couldn't upload stay in the snapshot until they exist again
+        files = {
+            path: previous[path]
+            for path in vm.get("unrestored_files", ())
+            if path in previous and path not in index.files
+        }
+        changed = []
+        for path, info in index.files.items():
+            entry = previous.get(path)
+            if entry and (entry["size"], entry["modified"]) == (
+                info["size"],
+                info["modified"],
+            ):
+                # chmod doesn't touch the mtime
+                files[path] = {**entry, "mode": info.get("mode")}
+            else:
+                changed.append(path)
+
+        semaphore = asyncio.Semaphore(SNAPSHOT_CONCURRENCY)
+        failed = []
+
+        async with guest_client(vm, ENVD_PORT, timeout=60.0) as http_client:
+
+            async def download(path: str):
+                async with semaphore:
+                    try:
+                        chunks = await _download_chunks(http_client, path)
+                    except Exception as e:
+                        # Vanished or unreadable, the next snapshot retries it.
+                        # Until then the last good copy stays in the snapshot
+                        log.warning(f"  ⚠️ Snapshot of {path} failed: {e}")
+                        failed.append(path)
+                        if path in previous:
+                            files[path] = previous[path]
+                        return
+
+                    info = index.files.get(path, {})
+                    files[path] = {
+                        "size": info.get("size"),
+                        "modified": info.get("modified"),
+                        "mode": info.get("mode"),
+                        "chunks": chunks,
+                    }
+
+            await asyncio.gather(*(download(path) for path in changed))
+
+        vm["last_snapshot_at"] = time.time()
+
+        if files == previous:
+            return {"status": "unchanged", "files": len(files), "failed": failed}
+
+        await asyncio.to_thread(_write_snapshot, user_id, files)
+        log.info(
+            f"📸 Snapshot of {user_id}'s workspace: {len(files)} files, "
+            f"{len(changed) - len(failed)} changed ({time.time() - start:.1f}s)"
+        )
+        return {
+            "status": "created",
+            "files": len(files),
+            "changed": len(changed) - len(failed),
+            "failed": failed,
+        }
+
+
+async def restore_workspace(vm: dict, user_id: str) -> Optional[dict]:
+    """Upload the user's latest snapshot into a fresh VM's workspace"""
+    async with snapshot_locks.setdefault(user_id, asyncio.Lock()):
+        snapshot = latest_snapshot(user_id)
+        if snapshot is None:
+            return None
+
+        start = time.time()
+        semaphore = asyncio.Semaphore(SNAPSHOT_CONCURRENCY)
+        failed = []
+
+        async with guest_client(vm, ENVD_PORT, timeout=60.0) as http_client:
+
+            async def upload(path: str, entry: dict):
+                async with semaphore:
+                    try:
+                        content = await asyncio.to_thread(_read_file, entry["chunks"])
+                        response = await http_client.post(
+                            "/files",
+                            params={"path": f"{WORKSPACE_DIR}/{path}"},
+                            files={"file": content},
+                        )
+                        response.raise_for_status()
+                    except Exception as e:
+                        log.warning(f"  ⚠️ Restore of {path} failed: {e}")
+                        failed.append(path)
+
+            await asyncio.gather(
+                *(upload(path, entry) for path, entry in snapshot["files"].items())
+            )
+
+        index = get_workspace_index(vm)
+        modes = {
+            path: entry["mode"]
+            for path, entry in snapshot["files"].items()
+            if entry.get("mode") not in (None, UPLOAD_MODE) and path not in failed
+        }
+        try:
+            await _restore_modes(index.rpc_client, modes)
+        except Exception as e:
+            log.warning(f"  ⚠️ Restoring file modes failed: {e}")
+
+        # Restored files have new mtimes - rebase the snapshot on them so the
+        # next snapshot doesn't download everything again. Files that failed or
+        # aren't indexed yet keep their entry as it was
+        await index.sync()
+        files = dict(snapshot["files"])
+        for path, entry in snapshot["files"].items():
+            info = index.files.get(path)
+            if path in failed or not info or info["size"] != entry["size"]:
+                continue
+            if info["modified"] != entry["modified"]:
+                files[path] = {**entry, "modified": info["modified"]}
+        if files != snapshot["files"]:
+            await asyncio.to_thread(_write_snapshot, user_id, files)
+        vm["last_snapshot_at"] = time.time()
+        # Not in the workspace, but not deleted by the user either
+        vm["unrestored_files"] = set(failed)
+
+        log.info(
+            f"♻️ Restored {len(snapshot['files']) - len(failed)} files into {user_id}'s workspace "
+            f"({time.time() - start:.1f}s)"
+        )
+        return {"files": len(snapshot["files"]) - len(failed), "failed": failed}
+
+
+async def _restore_modes(rpc_client, modes: Dict[str, int]):
+    """chmod restored files back to their snapshot modes, one process per mode"""
+    by_mode: Dict[int, list[str]] = {}
+    for path, mode in modes.items():
+        by_mode.setdefault(mode, []).append(path)
+
+    for mode, paths in by_mode.items():
+        for i in range(0, len(paths), CHMOD_BATCH):
+            request = process_pb2.StartRequest(
+                process=process_pb2.ProcessConfig(
+                    cmd="chmod",
+                    args=[f"{mode:o}", "--", *paths[i : i + CHMOD_BATCH]],
+                    cwd=WORKSPACE_DIR,
+                )
+            )
+            async for response in rpc_client.execute_server_stream(
+                request=request, method=START_METHOD
+            ):
+                if response.event.HasField("end"):
+                    end = response.event.end
+                    if end.exit_code:
+                        raise RuntimeError(f"chmod {mode:o} failed: {end.error}")
+
+
+def gc_snapshot_chunks() -> int:
+    """Delete chunks no manifest references any more"""
+    if not os.path.exists(CHUNKS_DIR):
+        return 0
+
+    referenced = set()
+    if os.path.exists(USERS_DIR):
+        for user_id in os.listdir(USERS_DIR):
+            for name in list_snapshots(user_id):
+                try:
+                    with open(f"{_user_dir(user_id)}/{name}") as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                for entry in snapshot["files"].values():
+                    referenced.update(entry["chunks"])
+
+    removed = 0
+    cutoff = time.time() - CHUNK_GC_GRACE_SECONDS
+    for prefix in os.listdir(CHUNKS_DIR):
+        prefix_dir = f"{CHUNKS_DIR}/{prefix}"
+        for name in os.listdir(prefix_dir):
+            path = f"{prefix_dir}/{name}"
+            if name not in referenced and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+
+    return removed
@@ -1,9 +1,19 @@
+import time
+
+# Startup profile clock, taken before the heavy imports below
+PROCESS_STARTED = time.monotonic()
+PROCESS_STARTED_UPTIME = time.clock_gettime(time.CLOCK_BOOTTIME)
+
+import asyncio
+import hashlib
 import json
 import os
+import uuid
 import httpx
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
+from typing import Literal, Optional
 from claude_agent_sdk import (
     ClaudeSDKClient,
     ClaudeAgentOptions,
@@ -11,29 +21,367 @@ from claude_agent_sdk import (
     ThinkingBlock,
     TextBlock,
     ToolUseBlock,
+    ToolResultBlock,
     ResultMessage,
+    UserMessage,
 )
+from log import bind_log_context, log, setup_logging
 
+setup_logging("claude-server")
 app = FastAPI()
 
-agent_client = None
+agent_client = None  # Client of the "default" session
 agent_options = None
 
+# Set once the default client has started (or failed to)
+agent_ready = asyncio.Event()
+
+# Seconds per startup phase, served by /health. process_started is seconds since
+# the guest kernel started (same clock as mini-init's boot milestones)
+startup_profile = {
+    "process_started": round(PROCESS_STARTED_UPTIME, 3),
+    "phases": {"imports": round(time.monotonic() - PROCESS_STARTED, 3)},
+    "ready_after": None,
+    "error": None,
+}
+
+# V8 code cache for the Claude CLI (Node >= 22.1), warmed when the image is built
+os.environ.setdefault("NODE_COMPILE_CACHE", "/var/cache/node-compile-cache")
+
+# Waiting tasks per session before /execute_task answers 429
+MAX_QUEUED_TASKS = 8
+
+# Output is batched until it reaches STREAM_FLUSH_BYTES or has waited
+# STREAM_FLUSH_MS (per request: flush_ms, 0 disables batching)
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "16384"))
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "25"))
+
+# How long startup waits for envd (50ms apart)
+ENVD_WAIT_ATTEMPTS = 200
+
+# Full tool inputs/outputs cut from the stream are kept here for /tool_payload
+TOOL_PAYLOAD_DIR = "/tmp/tool_payloads"
+MAX_TOOL_PAYLOADS = 2000
+TOOL_PREVIEW_CHARS = 500
+
+# Input fields short enough to say what a tool call does in summary mode
+TOOL_SUMMARY_FIELDS = ("file_path", "path", "pattern", "command", "url", "description")
+
+# Parallel agent sessions, defaults to one per vCPU (set in startup)
+max_sessions = 1
+
+# Started clients (idle Claude CLI processes) kept ready for new sessions and
+# context resets, so those don't wait for a CLI to spawn. Size is WARM_POOL_SIZE
+# (set in startup, like max_sessions)
+warm_pool_size = 1
+warm_clients: list = []
+warming = 0  # Clients being started for the pool
+
+
+# How long an abandoned task may take to wind down after being interrupted
+ABANDON_DRAIN_SECONDS = 30
+
+# Fire-and-forget tasks (client closes, pool refills, ...). The loop only keeps
+# weak references, so they are held here until done; shutdown waits for them
+background_tasks: set[asyncio.Task] = set()
+SHUTDOWN_WAIT_SECONDS = 10
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def context_chain(messages: list[dict], previous: str = "") -> list[str]:
+    """Running hash of each prefix of messages, continuing from previous"""
+    chain = []
+    for msg in messages:
+        previous = hashlib.sha256(
+            (previous + json.dumps([msg.get("role"), msg.get("content")])).encode()
+        ).hexdigest()
+        chain.append(previous)
+    return chain
+
+
+class Ticket:
+    """A task's place in a session queue"""
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self.moved = asyncio.Event()
+        self.cancel_reason = None  # Set once the task is cancelled
+
+
+class AgentSession:
+    """A ClaudeSDKClient plus the FIFO queue of tasks waiting to use it"""
+
+    def __init__(self, client: ClaudeSDKClient):
+        self.client = client
+        self.queue: list[Ticket] = []  # queue[0] is the running task
+        # context_chain of the messages delivered to this session's conversation
+        self.delivered: list[str] = []
+        # The conversation ends with the session's own reply to the last task
+        self.replied = False
+
+    async def new_context(self, context: list[dict]) -> list[dict]:
+        """
+        Context after what the conversation already has. Context that doesn't
+        continue the conversation is sent in full, into a fresh one.
+        """
+        shared = min(len(context), len(self.delivered))
+        if shared and context_chain(context[:shared])[-1] != self.delivered[shared - 1]:
+            log.info(
+                "📎 Context doesn't continue the session's conversation, "
+                "starting a fresh one"
+            )
+            await self.reset()
+            return context
+
+        # Clients send the assistant's reply back as it came out of this
+        # session, which already has it
+        rest = context[shared:]
+        replies = 0
+        while (
+            self.replied
+            and replies < len(rest)
+            and rest[replies].get("role") == "assistant"
+        ):
+            replies += 1
+        if replies:
+            self.mark_delivered(rest[:replies])
+        return rest[replies:]
+
+    def mark_delivered(self, messages: list[dict], replied: bool = False):
+        self.delivered += context_chain(
+            messages, self.delivered[-1] if self.delivered else ""
+        )
+        self.replied = replied
+
+    async def reset(self):
+        """Start a fresh conversation on a warm client, the old one stops in the background"""
+        global agent_client
+
+        old_client = self.client
+        client = await take_client()
+
+        if self.client is agent_client:
+            agent_client = client
+        self.client = client
+        self.delivered = []
+        self.replied = False
+        run_in_background(close_client(old_client))
+
+    def join(self, task_id: str) -> Ticket:
+        ticket = Ticket(task_id)
+        self.queue.append(ticket)
+        tickets[task_id] = (self, ticket)
+        return ticket
+
+    async def wait_turn(self, ticket: Ticket):
+        """Yield the ticket's queue position each time it moves, until it runs"""
+        while True:
+            # Clear before checking so a leave() during the yield isn't missed
+            ticket.moved.clear()
+            position = self.queue.index(ticket)
+            if position == 0 or ticket.cancel_reason:
+                return
+            yield position
+            await ticket.moved.wait()
+
+    def leave(self, ticket: Ticket):
+        self.queue.remove(ticket)
+        if tickets.get(ticket.task_id, (None, None))[1] is ticket:
+            del tickets[ticket.task_id]
+        for waiting in self.queue:
+            waiting.moved.set()
+
+    def cancel(self, ticket: Ticket, reason: str):
+        """Cancel a queued task, or interrupt it if it is running"""
+        if ticket.cancel_reason or ticket not in self.queue:
+            return
+
+        ticket.cancel_reason = reason
+        if self.queue[0] is ticket:
+            run_in_background(self.interrupt())
+        else:
+            ticket.moved.set()
+
+    async def interrupt(self):
+        try:
+            await self.client.interrupt()
+        except Exception as e:
+            log.warning(f"⚠️ Interrupt failed: {e}")
+
+    async def abandon(self, ticket: Ticket):
+        """Interrupt a running task nobody is reading and drain it, then free the session"""
+        try:
+            await self.interrupt()
+            async with asyncio.timeout(ABANDON_DRAIN_SECONDS):
+                async for _ in self.client.receive_response():
+                    pass
+            log.info(f"🛑 Abandoned task {ticket.task_id} interrupted")
+        except Exception as e:
+            log.warning(f"⚠️ Failed to drain task {ticket.task_id}: {e}")
+        finally:
+            self.leave(ticket)
+
+
+sessions: dict[str, AgentSession] = {}
+# Sessions whose client is still starting: {session_id: Future of the session}
+starting_sessions: dict[str, asyncio.Future] = {}
+sessions_lock = asyncio.Lock()
+
+# Queued and running tasks of all sessions, for /cancel_task:
+# {task_id: (session, ticket)}
+tickets: dict[str, tuple[AgentSession, Ticket]] = {}
+
+
+async def start_client() -> ClaudeSDKClient:
+    client = ClaudeSDKClient(options=agent_options)
+    await client.__aenter__()  # Spawns the CLI
+    return client
+
+
+async def close_client(client: ClaudeSDKClient):
+    try:
+        await client.__aexit__(None, None, None)
+    except Exception as e:
+        log.warning(f"⚠️ Failed to close client: {e}")
+
+
+async def take_client() -> ClaudeSDKClient:
+    """A started client for a new conversation, from the warm pool when it has one"""
+    if warm_clients:
+        client = warm_clients.pop()
+    else:
+        client = await start_client()
+
+    run_in_background(refill_pool())
+    return client
+
+
+async def refill_pool():
+    """Start clients in the background until the warm pool is full"""
+    global warming
+
+    while len(warm_clients) + warming < warm_pool_size:
+        warming += 1
+        try:
+            warm_clients.append(await start_client())
+        except Exception as e:
+            log.warning(f"⚠️ Failed to warm a client: {e}")
+            return
+        finally:
+            warming -= 1
+
+
+async def get_session(session_id: str) -> AgentSession:
+    """Return the session, starting a new ClaudeSDKClient for unknown ids"""
+    await agent_ready.wait()
+    if agent_client is None:
+        raise HTTPException(503, f"Agent failed to start: {startup_profile['error']}")
+
+    async with sessions_lock:
+        if session_id in sessions:
+            return sessions[session_id]
+
+        starting = starting_sessions.get(session_id)
+        if starting is not None:
+            owner = False
+        elif len(sessions) + len(starting_sessions) >= max_sessions:
+            raise HTTPException(
+                429, f"Session limit reached ({max_sessions}), close a session first"
+            )
+        else:
+            starting = asyncio.get_running_loop().create_future()
+            starting_sessions[session_id] = starting
+            owner = True
+
+    # Starting a client can take seconds, other sessions mustn't wait behind it
+    if not owner:
+        return await asyncio.shield(starting)
+
+    try:
+        session = AgentSession(await take_client())
+    except BaseException as e:
+        del starting_sessions[session_id]
+        starting.set_exception(
+            HTTPException(503, f"Session {session_id} failed to start: {e!r}")
+        )
+        starting.exception()  # Retrieved, whether or not anyone else waits
+        raise
+
+    sessions[session_id] = session
+    del starting_sessions[session_id]
+    starting.set_result(session)
+    log.info(f"🆕 Started session {session_id}")
+    return session
+
+
+async def load_envd_env():
+    """
+    Copy envd's env vars (boot config from MMDS or /init) into our environment.
+
+    envd only starts serving once its MMDS config is applied, so wait for it to
+    come up instead of racing it and starting without API keys.
+    """
+    async with httpx.AsyncClient() as client:
+        for _ in range(ENVD_WAIT_ATTEMPTS):
+            try:
+                response = await client.get("http://127.0.0.1:49983/envs", timeout=5.0)
+                if response.status_code == 200:
+                    for key, value in response.json().items():
+                        os.environ[key] = value
+                    return
+            except httpx.TransportError:
+                pass
+
+            await asyncio.sleep(0.05)
+
+    log.warning("⚠️ envd not reachable, starting without its env vars")
+
+
+def record_phase(name: str, started: float):
+    startup_profile["phases"][name] = round(time.monotonic() - started, 3)
+
 
 @app.on_event("startup")
 async def startup():
-    global agent_client, agent_options
+    """
+    Start the agent client in the background so the server binds right away.
+
+    Spawning the Claude CLI is the slowest part of startup, /health reports
+    "initializing" until it is done.
+    """
+    record_phase("app_startup", PROCESS_STARTED)
+    run_in_background(init_agent())
+
+
+async def init_agent():
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get("http://127.0.0.1:49983/envs", timeout=5.0)
-            if response.status_code == 200:
-                env_vars = response.json()
-                for key, value in env_vars.items():
-                    os.environ[key] = value
-            else:
-                pass
+        started = time.monotonic()
+        await load_envd_env()
+        record_phase("envd_env", started)
+        await start_default_client()
+        startup_profile["ready_after"] = round(time.monotonic() - PROCESS_STARTED, 3)
+        log.info(
+            f"✅ Agent ready {startup_profile['ready_after']}s after start "
+            f"{startup_profile['phases']}"
+        )
+
+        # Only now, so warming doesn't compete with the default client's start
+        run_in_background(refill_pool())
     except Exception as e:
-        pass
+        startup_profile["error"] = f"{type(e).__name__}: {e}"
+        log.error(f"❌ Agent failed to start: {e}")
+    finally:
+        agent_ready.set()
+
+
+async def start_default_client():
+    global agent_client, agent_options, max_sessions, warm_pool_size
 
     agent_options = ClaudeAgentOptions(
         # System prompt - using Claude Code preset
@@ -70,15 +418,30 @@ async def startup():
         max_turns=30,
     )
 
-    agent_client = ClaudeSDKClient(options=agent_options)
-    await agent_client.__aenter__()  # Initialize the session
+    max_sessions = int(os.getenv("MAX_AGENT_SESSIONS", os.cpu_count() or 1))
+    warm_pool_size = int(os.getenv("WARM_POOL_SIZE", "1"))
+
+    started = time.monotonic()
+    client = await start_client()
+    record_phase("agent_client", started)
+
+    sessions["default"] = AgentSession(client)
+    agent_client = client
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    global agent_client
-    if agent_client:
-        await agent_client.__aexit__(None, None, None)  # Properly close the session
+    # Let pending closes and refills finish before closing what is left
+    if background_tasks:
+        _, pending = await asyncio.wait(
+            set(background_tasks), timeout=SHUTDOWN_WAIT_SECONDS
+        )
+        for task in pending:
+            task.cancel()
+    for session in sessions.values():
+        await session.client.__aexit__(None, None, None)  # Properly close the session
+    for client in warm_clients:
+        await client.__aexit__(None, None, None)
 
 
 @app.get("/health")
@@ -87,15 +450,256 @@ async def health():
     Health check that verifies Claude Agent SDK is initialized.
     """
     if agent_client is not None:
-        return {"status": "ok", "agent": "ready"}
+        return {"status": "ok", "agent": "ready", "startup": startup_profile}
+    elif startup_profile["error"]:
+        return {"status": "error", "agent": "failed", "startup": startup_profile}
     else:
-        return {"status": "starting", "agent": "initializing"}
+        return {
+            "status": "starting",
+            "agent": "initializing",
+            "startup": startup_profile,
+        }
+
+
+@app.get("/queue")
+async def queue():
+    """Running and waiting tasks per session"""
+    return {
+        "max_sessions": max_sessions,
+        "max_queued_tasks": MAX_QUEUED_TASKS,
+        "warm_clients": len(warm_clients),
+        "sessions": {
+            session_id: {
+                "running": len(session.queue) > 0,
+                "waiting": max(len(session.queue) - 1, 0),
+            }
+            for session_id, session in sessions.items()
+        },
+    }
+
+
+class CloseSessionRequest(BaseModel):
+    session_id: str
+
+
+@app.post("/close_session")
+async def close_session(request: CloseSessionRequest):
+    """Close an idle session to free its slot"""
+    if request.session_id == "default":
+        raise HTTPException(400, "The default session can't be closed")
+
+    async with sessions_lock:
+        session = sessions.get(request.session_id)
+        if session is None:
+            raise HTTPException(404, f"No session {request.session_id}")
+        if session.queue:
+            raise HTTPException(409, f"Session {request.session_id} is busy")
+        del sessions[request.session_id]
+
+    run_in_background(close_client(session.client))
+    return {"status": "closed", "session_id": request.session_id}
+
+
+class CancelTaskRequest(BaseModel):
+    task_id: str
+    reason: str = "cancelled"
+
+
+@app.post("/cancel_task")
+async def cancel_task(request: CancelTaskRequest):
+    """Cancel a queued task or interrupt the running one, its stream ends cleanly"""
+    if request.task_id not in tickets:
+        raise HTTPException(404, f"No queued or running task {request.task_id}")
+
+    session, ticket = tickets[request.task_id]
+    session.cancel(ticket, request.reason)
+    return {"status": "cancelling", "task_id": request.task_id}
+
+
+@app.get("/tool_payload")
+async def tool_payload(tool_use_id: str, part: Literal["input", "output"] = "input"):
+    """Full tool input or output that was cut from a task stream"""
+    path = f"{TOOL_PAYLOAD_DIR}/{os.path.basename(tool_use_id)}.{part}.json"
+    if not os.path.exists(path):
+        raise HTTPException(404, f"No stored {part} for tool use {tool_use_id}")
+
+    with open(path) as f:
+        return Response(content=f.read(), media_type="application/json")
 
 
 class TaskRequest(BaseModel):
     task: str
     context: list[dict] = []
     files: list[str] = []
+    stream_format: Literal["text", "ndjson", "sse"] = "text"
+    # Tasks in one session run one at a time, separate sessions run in parallel
+    session_id: str = "default"
+    task_id: str = ""  # Used by /cancel_task, generated when empty
+    # Cancel the task (queued or running) this long after it was submitted
+    timeout_seconds: Optional[float] = None
+    # Drop the session's conversation (and what context it has seen) first
+    reset_context: bool = False
+    # Max time output waits to be batched with more output, None = default
+    flush_ms: Optional[int] = None
+    # How much of tool inputs/outputs to stream: "full", "truncated" (preview +
+    # size) or "summary" (size only). Cut payloads are kept for /tool_payload
+    tool_verbosity: Literal["full", "truncated", "summary"] = "full"
+
+
+STREAM_MEDIA_TYPES = {
+    "text": "text/plain",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def store_tool_payload(tool_use_id: str, part: str, payload: str):
+    """Keep a full tool input/output on disk, dropping the oldest past the cap"""
+    os.makedirs(TOOL_PAYLOAD_DIR, exist_ok=True)
+    with open(f"{TOOL_PAYLOAD_DIR}/{tool_use_id}.{part}.json", "w") as f:
+        f.write(payload)
+
+    stored = os.listdir(TOOL_PAYLOAD_DIR)
+    if len(stored) > MAX_TOOL_PAYLOADS:
+        paths = sorted(
+            (os.path.join(TOOL_PAYLOAD_DIR, name) for name in stored),
+            key=os.path.getmtime,
+        )
+        for path in paths[: len(stored) - MAX_TOOL_PAYLOADS]:
+            os.remove(path)
+
+
+async def tool_payload_fields(
+    tool_use_id: str, part: str, value, verbosity: str, summary: Optional[dict] = None
+) -> dict:
+    """
+    Event fields for a tool input/output at the requested verbosity.
+
+    "full" sends the value as is. "truncated" sends a preview and "summary" only
+    the size (plus a few telling input fields); in both cases the full value is
+    stored so it can be fetched from /tool_payload.
+    """
+    payload = json.dumps(value)
+    if verbosity == "full" or (
+        verbosity == "truncated" and len(payload) <= TOOL_PREVIEW_CHARS
+    ):
+        return {part: value}
+
+    await asyncio.to_thread(store_tool_payload, tool_use_id, part, payload)
+
+    fields = {f"{part}_size": len(payload), "truncated": True}
+    if verbosity == "truncated":
+        fields[f"{part}_preview"] = payload[:TOOL_PREVIEW_CHARS]
+    elif summary is not None:
+        fields[f"{part}_summary"] = summary
+    return fields
+
+
+def tool_input_summary(tool_input: dict) -> dict:
+    return {
+        key: str(tool_input[key])[:200]
+        for key in TOOL_SUMMARY_FIELDS
+        if key in tool_input
+    }
+
+
+def render_text(event: dict) -> str:
+    """Render an event the way the plain text stream always has"""
+    if event["type"] in ("text", "thinking"):
+        return f"{event[event['type']]}\n"
+    if event["type"] == "tool_use":
+        if "input" in event:
+            tool_input = json.dumps(event["input"])
+        elif "input_preview" in event:
+            tool_input = f"{event['input_preview']}… [{event['input_size']} bytes, id {event['id']}]"
+        else:
+            tool_input = f"{json.dumps(event['input_summary'])} [{event['input_size']} bytes, id {event['id']}]"
+        return f"🔧 Tool: {event['name']}\n   Input: {tool_input}\n"
+    if event["type"] == "tool_result":
+        # Not part of the plain text stream
+        return ""
+    if event["type"] == "result":
+        return f"\n✅ Complete (turns: {event['num_turns']})\n"
+    if event["type"] == "queued":
+        return f"⏳ Queued (position {event['position']})\n"
+    if event["type"] == "cancelled":
+        return f"\n🛑 Cancelled ({event['reason']})\n"
+    return f"Error: {event['error']}\n"
+
+
+async def coalesce(chunks, max_bytes: int, max_delay: float):
+    """
+    Batch small chunks into bigger ones.
+
+    A batch is flushed once it reaches max_bytes or max_delay seconds after its
+    first byte arrived, so a slow trickle of tokens still goes out promptly.
+    """
+    if max_delay <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer = bytearray()
+    flush_at = 0.0
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = max(flush_at - loop.time(), 0) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield bytes(buffer)
+                buffer.clear()
+                continue
+
+            finished, pending = pending, None
+            try:
+                chunk = finished.result()
+            except StopAsyncIteration:
+                break
+
+            if not buffer:
+                flush_at = loop.time() + max_delay
+            buffer += chunk
+            if len(buffer) >= max_bytes:
+                yield bytes(buffer)
+                buffer.clear()
+
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        # Reader went away mid-stream: make sure the source sees it too
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        else:
+            await iterator.aclose()
+
+
+class TaskStreamResponse(StreamingResponse):
+    """StreamingResponse that calls on_close once it is done, sent or not"""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+
+def render_event(event: dict, stream_format: str) -> bytes:
+    if stream_format == "ndjson":
+        return f"{json.dumps(event)}\n".encode()
+    if stream_format == "sse":
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+    return render_text(event).encode()
 
 
 @app.post("/execute_task")
@@ -103,48 +707,174 @@ async def execute_task(request: TaskRequest):
     """
     Execute task by CC inside dedicated microvm
     """
-    global agent_client
+    bind_log_context(session_id=request.session_id)
+    log.info(f"🔔 New task: {request.task[:50]}...")
+
+    session = await get_session(request.session_id)
+
+    def build_query(context: list[dict]) -> str:
+        context_parts = []
+
+        if context:
+            context_parts.append("Context from previous work:")
+            for msg in context:
+                context_parts.append(f"  {msg['role']}: {msg['content']}")
 
-    print(f"[CLAUDE-SERVER] 🔔 New task: {request.task[:50]}...", flush=True)
+        if request.files:
+            context_parts.append(
+                f"\nFiles available in /workspace/: {', '.join(request.files)}"
+            )
 
-    if not agent_client:
-        raise HTTPException(500, "Agent not initialized")
+        context_str = "\n".join(context_parts)
 
-    context_parts = []
+        return f"{context_str}\n\n{request.task}" if context_str else request.task
 
-    if request.context:
-        context_parts.append("Context from previous work:")
-        for msg in request.context:
-            context_parts.append(f"  {msg['role']}: {msg['content']}")
+    task_id = request.task_id or uuid.uuid4().hex
+    bind_log_context(task_id=task_id)
 
-    if request.files:
-        context_parts.append(
-            f"\nFiles available in /workspace/: {', '.join(request.files)}"
+    # Checked and joined with no await in between, so concurrent requests can't
+    # all slip under the limit
+    if len(session.queue) > MAX_QUEUED_TASKS:
+        raise HTTPException(
+            429,
+            f"Session {request.session_id} already has {MAX_QUEUED_TASKS} queued tasks",
         )
+    ticket = session.join(task_id)
+    events_started = False
 
-    context_str = "\n".join(context_parts)
+    async def agent_events():
+        nonlocal events_started
+        events_started = True
+        turn = 1
 
-    full_query = f"{context_str}\n\n{request.task}" if context_str else request.task
+        def event(event_type: str, **fields) -> dict:
+            return {"type": event_type, "ts": time.time(), "turn": turn, **fields}
 
-    async def stream_response():
+        deadline = None
+        if request.timeout_seconds:
+            deadline = asyncio.get_running_loop().call_later(
+                request.timeout_seconds, session.cancel, ticket, "deadline"
+            )
+
+        started = finished = False
         try:
-            await agent_client.query(full_query)
+            async for position in session.wait_turn(ticket):
+                yield event("queued", position=position)
+
+            if ticket.cancel_reason:
+                finished = True
+                yield event("cancelled", reason=ticket.cancel_reason)
+                return
+
+            if request.reset_context:
+                await session.reset()
+
+            # The session is persistent, so earlier turns are already in its
+            # history - only send the context that comes after them
+            new_context = await session.new_context(request.context)
+            if len(new_context) < len(request.context):
+                log.info(
+                    f"📎 Sending {len(new_context)}/{len(request.context)} context messages"
+                )
 
-            async for message in agent_client.receive_response():
+            started = True
+            await session.client.query(build_query(new_context))
+            session.mark_delivered(
+                new_context + [{"role": "user", "content": request.task}],
+                replied=True,
+            )
+
+            async for message in session.client.receive_response():
                 if isinstance(message, AssistantMessage):
                     for block in message.content:
                         if isinstance(block, TextBlock):
-                            yield f"{block.text}\n".encode()
+                            yield event("text", text=block.text)
                         elif isinstance(block, ThinkingBlock):
-                            yield f"{block.thinking}\n".encode()
+                            yield event("thinking", thinking=block.thinking)
                         elif isinstance(block, ToolUseBlock):
-                            yield f"🔧 Tool: {block.name}\n".encode()
-                            yield f"   Input: {json.dumps(block.input)}\n".encode()
+                            yield event(
+                                "tool_use",
+                                id=block.id,
+                                name=block.name,
+                                **await tool_payload_fields(
+                                    block.id,
+                                    "input",
+                                    block.input,
+                                    request.tool_verbosity,
+                                    tool_input_summary(block.input),
+                                ),
+                            )
+
+                elif isinstance(message, UserMessage):
+                    # Tool results go back to the model, next output is a new turn
+                    if not isinstance(message.content, str):
+                        for block in message.content:
+                            if isinstance(block, ToolResultBlock):
+                                yield event(
+                                    "tool_result",
+                                    tool_use_id=block.tool_use_id,
+                                    is_error=block.is_error,
+                                    **await tool_payload_fields(
+                                        block.tool_use_id,
+                                        "output",
+                                        block.content,
+                                        request.tool_verbosity,
+                                    ),
+                                )
+                        turn += 1
 
                 elif isinstance(message, ResultMessage):
-                    yield f"\n✅ Complete (turns: {message.num_turns})\n".encode()
+                    finished = True
+                    yield event(
+                        "result",
+                        num_turns=message.num_turns,
+                        is_error=message.is_error,
+                        duration_ms=message.duration_ms,
+                        duration_api_ms=message.duration_api_ms,
+                        total_cost_usd=message.total_cost_usd,
+                        usage=message.usage,
+                        session_id=message.session_id,
+                    )
+
+            finished = True
+            if ticket.cancel_reason:
+                yield event("cancelled", reason=ticket.cancel_reason)
 
         except Exception as e:
-            yield f"Error: {str(e)}\n".encode()
+            finished = True
+            yield event("error", error=str(e))
+        finally:
+            if deadline:
+                deadline.cancel()
+            if finished or not started:
+                session.leave(ticket)
+            else:
+                # Stream dropped mid-task: stop the agent instead of letting it
+                # run for nobody, and keep the session until it has wound down
+                run_in_background(session.abandon(ticket))
+
+    async def rendered_events():
+        async for event in agent_events():
+            rendered = render_event(event, request.stream_format)
+            if rendered:
+                yield rendered
 
-    return StreamingResponse(stream_response(), media_type="text/plain")
+    flush_ms = STREAM_FLUSH_MS if request.flush_ms is None else request.flush_ms
+
+    async def stream_response():
+        async for chunk in coalesce(
+            rendered_events(), STREAM_FLUSH_BYTES, flush_ms / 1000
+        ):
+            yield chunk
+
+    def release_unstarted():
+        # The client went away before the stream started, so agent_events never
+        # ran to leave the queue
+        if not events_started:
+            session.leave(ticket)
+
+    return TaskStreamResponse(
+        stream_response(),
+        on_close=release_unstarted,
+        media_type=STREAM_MEDIA_TYPES[request.stream_format],
+    )